@@ -0,0 +1,421 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Batched, pooled and cached queries against the data broker
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import collections
+import copy
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+import six
+from six.moves import queue
+from vistrails.core.modules.vistrails_module import Module, ModuleError
+from vistrails.core.modules.config import IPort, OPort, ModuleSettings
+from .local_broker import LocalBroker
+logger = logging.getLogger(__name__)
+
+# defaults, NSLS2_BROKER_POOL_SIZE and NSLS2_BROKER_TTL override them
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TTL = 60.
+# how long the first query of a batch waits for others to join it
+DEFAULT_BATCH_WINDOW = 0.005
+DEFAULT_MAX_BATCH = 64
+
+
+def query_key(query):
+    """
+    Hashable key of a query dict, independent of the key order
+    """
+    return json.dumps(query, sort_keys=True, default=str)
+
+
+class ConnectionPool(object):
+    """
+    Up to size backend connections shared between threads
+
+    Connections are created with factory() the first time they are
+    needed and reused afterwards, so a workflow with many broker modules
+    opens a handful of connections instead of one per module.
+    """
+    def __init__(self, factory, size=DEFAULT_POOL_SIZE):
+        self.factory = factory
+        self.size = int(size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return self.factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def release(self, conn):
+        self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self._created -= 1
+
+
+class TTLCache(object):
+    """
+    Thread safe cache whose entries expire ttl seconds after they are
+    stored, the oldest entries are dropped past max_entries
+
+    Values are deep copied on the way in and out, so callers that modify
+    the headers or events they get back never change the cached ones.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=1024):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value = entry[1]
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        stored = copy.deepcopy(value)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), stored)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _Slot(object):
+    # result of one request of a batch
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class _Batch(object):
+    # requests sent together, (arg, _Slot) by key, full once it holds
+    # max_batch of them
+    def __init__(self):
+        self.slots = collections.OrderedDict()
+        self.full = threading.Event()
+
+
+class QueryBatcher(object):
+    """
+    Coalesces concurrent requests into batched backend calls
+
+    The first request to arrive opens a batch and, when other callers
+    are in flight, waits up to window seconds for them to add theirs,
+    then sends the whole batch through one pooled connection with
+    getattr(conn, method)(args). A lone caller is sent at once and pays
+    no window. A batch holds at most max_batch requests: it is sent as
+    soon as it is full and the next request opens a new one. Identical
+    requests within a batch are sent once. Callers block until their
+    batches are answered.
+    """
+    def __init__(self, pool, method, window=DEFAULT_BATCH_WINDOW,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.pool = pool
+        self.method = method
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending = None
+        # callers inside submit_many
+        self._callers = 0
+        self.batches = 0
+        self.requests = 0
+
+    def submit_many(self, keys, args):
+        """
+        Submit several requests at once, returns their results in order
+        """
+        # the batches this caller opened and has to send
+        led = []
+        slots = []
+        with self._lock:
+            self._callers += 1
+            for key, arg in zip(keys, args):
+                batch = self._pending
+                if batch is None:
+                    batch = self._pending = _Batch()
+                    led.append(batch)
+                if key not in batch.slots:
+                    batch.slots[key] = (arg, _Slot())
+                slots.append(batch.slots[key][1])
+                if len(batch.slots) >= self.max_batch:
+                    # closed, the next request opens a new batch
+                    self._pending = None
+                    batch.full.set()
+            self.requests += len(slots)
+            alone = self._callers == 1
+        try:
+            for batch in led:
+                if not alone and self.window > 0:
+                    # cut short when the batch fills up
+                    batch.full.wait(self.window)
+                self._dispatch(batch)
+            results = []
+            for slot in slots:
+                slot.done.wait()
+                if slot.error is not None:
+                    raise slot.error
+                results.append(slot.value)
+            return results
+        finally:
+            with self._lock:
+                self._callers -= 1
+
+    def submit(self, key, arg):
+        return self.submit_many([key], [arg])[0]
+
+    def _dispatch(self, batch):
+        with self._lock:
+            if self._pending is batch:
+                self._pending = None
+            self.batches += 1
+        args = [arg for arg, slot in six.itervalues(batch.slots)]
+        try:
+            conn = self.pool.acquire()
+            try:
+                values = getattr(conn, self.method)(args)
+            finally:
+                self.pool.release(conn)
+        except Exception as e:
+            for arg, slot in six.itervalues(batch.slots):
+                slot.error = e
+                slot.done.set()
+            return
+        for (arg, slot), value in zip(six.itervalues(batch.slots), values):
+            slot.value = value
+            slot.done.set()
+
+
+class BrokerService(object):
+    """
+    Header and event queries through a connection pool, coalesced into
+    batches and cached for ttl seconds
+
+    Parameters
+    ----------
+    factory : callable
+        Returns a backend connection. Backends answer batches:
+        find_headers(queries) -> list of headers per query,
+        find_events(uids) -> list of events per header uid, and close().
+        LocalBroker is the file backed one.
+    """
+    def __init__(self, factory, pool_size=DEFAULT_POOL_SIZE,
+                 ttl=DEFAULT_TTL, window=DEFAULT_BATCH_WINDOW,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.pool = ConnectionPool(factory, pool_size)
+        self.cache = TTLCache(ttl)
+        self.headers = QueryBatcher(self.pool, 'find_headers', window,
+                                    max_batch)
+        self.events = QueryBatcher(self.pool, 'find_events', window,
+                                   max_batch)
+
+    @classmethod
+    def from_environ(cls):
+        """
+        Service for the broker named by NSLS2_BROKER: the path of a
+        LocalBroker directory or 'package.module:factory'. None when it
+        is not set.
+        """
+        target = os.environ.get('NSLS2_BROKER')
+        if not target:
+            return None
+        if os.path.isdir(target):
+            factory = lambda: LocalBroker(target)
+        else:
+            module_name, _, attr = target.partition(':')
+            factory = getattr(importlib.import_module(module_name), attr)
+        return cls(factory,
+                   pool_size=int(os.environ.get('NSLS2_BROKER_POOL_SIZE',
+                                                DEFAULT_POOL_SIZE)),
+                   ttl=float(os.environ.get('NSLS2_BROKER_TTL',
+                                            DEFAULT_TTL)))
+
+    def find_headers(self, query, ttl=None):
+        key = ('headers', query_key(query))
+        headers = self.cache.get(key, ttl)
+        if headers is None:
+            headers = self.cache.put(key, self.headers.submit(key, query))
+        return headers
+
+    def find_events(self, headers, ttl=None):
+        """
+        Events of each header, the uncached ones fetched in one batch
+        """
+        keys = [('events', h['uid']) for h in headers]
+        events = [self.cache.get(key, ttl) for key in keys]
+        todo = [i for i, ev in enumerate(events) if ev is None]
+        if todo:
+            fetched = self.events.submit_many(
+                [keys[i] for i in todo], [headers[i]['uid'] for i in todo])
+            for i, ev in zip(todo, fetched):
+                events[i] = self.cache.put(keys[i], ev)
+        return events
+
+    def query(self, query, ttl=None):
+        """
+        Headers matching query, as new dicts. With query['data'] true,
+        each carries its events under 'events'.
+        """
+        query = dict(query)
+        data = query.pop('data', False)
+        headers = [dict(h) for h in self.find_headers(query, ttl)]
+        if data:
+            for header, events in zip(headers,
+                                      self.find_events(headers, ttl)):
+                header['events'] = events
+        return headers
+
+    def stats(self):
+        return {'cache_hits': self.cache.hits,
+                'cache_misses': self.cache.misses,
+                'header_requests': self.headers.requests,
+                'header_batches': self.headers.batches,
+                'event_requests': self.events.requests,
+                'event_batches': self.events.batches}
+
+    def close(self):
+        self.pool.close()
+        self.cache.clear()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """
+    Process wide BrokerService, see BrokerService.from_environ
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = BrokerService.from_environ()
+        return _service
+
+
+class PooledBrokerQuery(Module):
+    """
+    Query the data broker through the shared, batched and cached
+    BrokerService. Set NSLS2_BROKER to a LocalBroker directory to work
+    offline.
+    """
+    _settings = ModuleSettings(namespace="broker")
+
+    _input_ports = [
+        IPort(name="query_dict", label="Query, 'data': True adds events",
+              signature="basic:Dictionary"),
+        IPort(name="unique_query_dict",
+              label="Query that must match exactly one run",
+              signature="basic:Dictionary", optional=True),
+        IPort(name="ttl", label="Reuse results younger than (s)",
+              signature="basic:Float", optional=True),
+        ]
+
+    _output_ports = [
+        OPort(name="query_result", signature="basic:List"),
+        OPort(name="broker_stats", signature="basic:Dictionary"),
+        ]
+
+    # the broker changes between executions, the TTL cache decides reuse
+    def is_cacheable(self):
+        return False
+
+    def compute(self):
+        service = get_service()
+        if service is None:
+            raise ModuleError(self, 'No broker configured, set NSLS2_BROKER')
+        ttl = self.force_get_input("ttl", None)
+        query = dict(self.force_get_input("query_dict", None) or {})
+        unique = self.force_get_input("unique_query_dict", None)
+        if unique is not None:
+            query.update(unique)
+        try:
+            result = service.query(query, ttl)
+        except Exception as e:
+            raise ModuleError(self, 'Broker query {0} failed: {1}'
+                                    ''.format(query, e))
+        if unique is not None and len(result) != 1:
+            raise ModuleError(self, 'Query {0} matched {1} runs, expected '
+                                    'one'.format(query, len(result)))
+        self.set_output("query_result", result)
+        self.set_output("broker_stats", service.stats())
+
+
+def vistrails_modules():
+    return [PooledBrokerQuery]
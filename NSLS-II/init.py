@@ -41,39 +41,60 @@ import six
 import logging
 import sys
 import yaml
-import importlib
 import collections
 import os
-from vttools import wrap_lib
 from vttools.wrap_lib import AutowrapError
+from .registry import ModuleRegistry
+from . import version
+from .profiling import StartupProfiler
 logger = logging.getLogger(__name__)
 
+# off unless NSLS2_PROFILE_STARTUP is set
+profiler = StartupProfiler.from_environ()
 
 # read yaml modules
-with open(os.path.join((os.path.dirname(os.path.realpath(__file__))),
-                       'modules.yaml'), 'r') as modules:
-    import_dict = yaml.load(modules)
-    print('import_dict: {0}'.format(import_dict))
+with profiler.measure('yaml', 'modules.yaml'):
+    with open(os.path.join((os.path.dirname(os.path.realpath(__file__))),
+                           'modules.yaml'), 'rb') as modules:
+        modules_yaml = modules.read()
+        import_dict = yaml.load(modules_yaml)
+        logger.debug('import_dict: {0}'.format(import_dict))
 
 
 def get_modules():
     # set defaults
     try:
-        # import the hand-built VisTrails modules
         module_list = import_dict['import_modules']
-        pymods = [importlib.import_module(module_name, module_path)
-                  for module_path, mod_lst in six.iteritems(module_list)
-                  for module_name in mod_lst]
-        # autowrap functions
+        import_list = []
+        for module_path, mod_lst in six.iteritems(module_list):
+            if module_path == '.':
+                module_path = __name__.rpartition('.')[0]
+            import_list.extend((module_name, module_path)
+                               for module_name in mod_lst)
         func_list = import_dict['autowrap_func']
-        vtfuncs = [wrap_lib.wrap_function(**func_dict)
-                   for func_dict in func_list]
+        # both kinds of modules are registered as stubs from the
+        # registration cache while it matches modules.yaml and the
+        # installed libraries, and only imported when first executed
+        registry = ModuleRegistry(modules_yaml, func_list, import_list)
+        # the hand-built VisTrails modules
+        vtmods = []
+        for module_name, module_path in import_list:
+            with profiler.measure('import', module_path + module_name):
+                vtmods.extend(registry.import_modules(module_name,
+                                                      module_path))
+        # autowrap functions
+        vtfuncs = []
+        for func_dict in func_list:
+            with profiler.measure('autowrap', '{module_path}.{func_name}'
+                                              ''.format(**func_dict)):
+                vtfuncs.append(registry.wrap_function(func_dict))
+        registry.save()
         # autowrap classes
         # class_list = import_dict['autowrap_classes']
         # vtclasses = [wrap_lib.wrap_function(**func_dict)
         #              for func_dict in class_list]
     except ImportError as ie:
-        msg = ('importing {0} failed\nOriginal Error: {1}'
+        msg = ('importing {0} from {1} failed\nOriginal Error: {2}'
                ''.format(module_name, module_path, ie))
         print(msg)
         logging.error(msg)
@@ -85,8 +106,6 @@ def get_modules():
         logging.error(msg)
         six.reraise(*sys.exc_info())
 
-    vtmods = [vtmod for mod in pymods for vtmod in mod.vistrails_modules()]
-
     all_mods = vtmods + vtfuncs  # + vtclasses
     if len(all_mods) != len(set(all_mods)):
         raise ValueError('Some modules have been imported multiple times.\n'
@@ -101,3 +120,4 @@ def get_modules():
 
 # # init the modules list
 _modules = get_modules()
+profiler.report(nsls2_version=version)
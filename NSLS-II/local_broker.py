@@ -0,0 +1,124 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+File backed stand-in for the data broker, for working offline
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import threading
+import six
+from .fileio import write_json
+
+
+def _matches(header, query):
+    for key, value in six.iteritems(query):
+        if key not in header:
+            return False
+        # scan ids are written as strings in some of our workflows
+        if header[key] != value and str(header[key]) != str(value):
+            return False
+    return True
+
+
+class LocalBroker(object):
+    """
+    Broker backend reading headers and events from a directory
+
+    Every run is one JSON file, root/headers/<uid>.json, holding the
+    header dict, and its events are a JSON list in root/events/<uid>.json.
+    Headers match a query when every key of the query is in the header
+    with an equal value. Both calls take a batch of requests and answer
+    them in one pass, like a remote broker answering a batched query.
+
+    Parameters
+    ----------
+    root : str
+        Broker directory, see write_run()
+    """
+    def __init__(self, root):
+        self.root = root
+        self._headers = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _load_headers(self):
+        header_dir = os.path.join(self.root, 'headers')
+        mtime = os.path.getmtime(header_dir)
+        with self._lock:
+            if self._headers is None or mtime != self._mtime:
+                headers = []
+                for name in sorted(os.listdir(header_dir)):
+                    if name.endswith('.json'):
+                        with open(os.path.join(header_dir, name)) as f:
+                            headers.append(json.load(f))
+                self._headers = headers
+                self._mtime = mtime
+            return self._headers
+
+    def find_headers(self, queries):
+        """
+        List of the matching headers for each query in queries
+        """
+        headers = self._load_headers()
+        return [[h for h in headers if _matches(h, q)] for q in queries]
+
+    def find_events(self, uids):
+        """
+        List of events for each header uid in uids
+        """
+        events = []
+        for uid in uids:
+            path = os.path.join(self.root, 'events', uid + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    events.append(json.load(f))
+            else:
+                events.append([])
+        return events
+
+    def close(self):
+        pass
+
+
+def write_run(root, header, events=()):
+    """
+    Add a run to a LocalBroker directory, e.g. one exported from the real
+    broker. header must have a 'uid'.
+    """
+    # headers last, a reader never sees a header without its events
+    for sub, content in (('events', list(events)), ('headers', header)):
+        write_json(os.path.join(root, sub, header['uid'] + '.json'), content)
@@ -0,0 +1,199 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Load time profiling of the NSLS2 package
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+logger = logging.getLogger(__name__)
+
+
+def source_commit():
+    """
+    The git commit this package is loaded from, None outside a checkout
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_versions(names):
+    """
+    __version__ of the imported top level package of each dotted name,
+    None for packages without one
+    """
+    versions = {}
+    for name in names:
+        top = name.split('.')[0]
+        if top in sys.modules and top not in versions:
+            versions[top] = getattr(sys.modules[top], '__version__', None)
+    return versions
+
+
+def rss_bytes():
+    """
+    Resident set size of this process, the peak RSS where /proc is missing
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class StartupProfiler(object):
+    """
+    Wall time and RSS delta of each step of get_modules()
+
+    Set NSLS2_PROFILE_STARTUP to turn it on: '1' appends the report to
+    ~/.cache/userpackages/nsls2_startup_profile.jsonl, anything else is
+    taken as the path of the report file. Each startup appends one JSON
+    line stamped with the time, the NSLS2 and library versions, the git
+    commit and the Python version, so loads can be compared over time.
+    Either way the table, slowest step first, is printed and logged. When
+    off, measure() only yields.
+
+    Parameters
+    ----------
+    json_path : str, optional
+        The JSON lines file to append to, None turns the profiler off
+    """
+    def __init__(self, json_path=None):
+        self.json_path = json_path
+        self.enabled = json_path is not None
+        self.records = []
+        self.started = time.time()
+
+    @classmethod
+    def from_environ(cls):
+        setting = os.environ.get('NSLS2_PROFILE_STARTUP', '')
+        if not setting or setting == '0':
+            return cls()
+        if setting == '1':
+            setting = os.path.join(os.path.expanduser('~'), '.cache',
+                                   'userpackages',
+                                   'nsls2_startup_profile.jsonl')
+        return cls(setting)
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        """
+        Record the step 'name' of the given kind ('yaml', 'import',
+        'autowrap', ...) run inside the with block
+        """
+        if not self.enabled:
+            yield
+            return
+        rss = rss_bytes()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.records.append({'kind': kind,
+                                 'name': name,
+                                 'wall_s': time.time() - start,
+                                 'rss_delta_bytes': rss_bytes() - rss})
+
+    def table(self):
+        """
+        The records as a text table, slowest first
+        """
+        records = sorted(self.records, key=lambda r: r['wall_s'],
+                         reverse=True)
+        width = max([len(r['name']) for r in records] + [4])
+        lines = ['{0:<10} {1:<{w}} {2:>10} {3:>12}'.format(
+            'kind', 'name', 'wall [s]', 'rss [MB]', w=width)]
+        for r in records:
+            lines.append('{0:<10} {1:<{w}} {2:>10.3f} {3:>12.1f}'.format(
+                r['kind'], r['name'], r['wall_s'],
+                r['rss_delta_bytes'] / 2 ** 20, w=width))
+        lines.append('{0:<10} {1:<{w}} {2:>10.3f}'.format(
+            'total', '', time.time() - self.started, w=width))
+        return '\n'.join(lines)
+
+    def report(self, nsls2_version=None):
+        """
+        Print and log the table and append the JSON record
+
+        Parameters
+        ----------
+        nsls2_version : str, optional
+            Version of the NSLS2 package being loaded
+        """
+        if not self.enabled:
+            return
+        table = self.table()
+        print(table)
+        logger.info('NSLS2 package load profile\n%s', table)
+        report = {'timestamp': time.time(),
+                  'nsls2_version': nsls2_version,
+                  'versions': package_versions(
+                      [r['name'] for r in self.records
+                       if r['kind'] in ('import', 'autowrap')]),
+                  'commit': source_commit(),
+                  'python': sys.version,
+                  'platform': platform.platform(),
+                  'total_s': time.time() - self.started,
+                  'records': sorted(self.records, key=lambda r: r['wall_s'],
+                                    reverse=True)}
+        try:
+            report_dir = os.path.dirname(self.json_path)
+            if report_dir and not os.path.isdir(report_dir):
+                os.makedirs(report_dir)
+            with open(self.json_path, 'a') as f:
+                f.write(json.dumps(report, sort_keys=True) + '\n')
+        except (IOError, OSError) as err:
+            logger.warning('could not write load profile %s: %s',
+                           self.json_path, err)
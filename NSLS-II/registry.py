@@ -0,0 +1,338 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Cached registration of the autowrapped and hand-built NSLS2 modules
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import pkgutil
+import sys
+import threading
+from vistrails.core.modules.vistrails_module import Module
+from vistrails.core.modules.config import IPort, OPort, ModuleSettings
+from vttools import wrap_lib
+from .fileio import write_json
+try:
+    from importlib.util import find_spec
+except ImportError:
+    # Python 2
+    find_spec = None
+logger = logging.getLogger(__name__)
+
+REGISTRY_VERSION = 2
+
+
+def default_registry_path():
+    """
+    Location of the registration cache, NSLS2_MODULE_CACHE overrides it and
+    an empty NSLS2_MODULE_CACHE turns the cache off
+    """
+    return os.environ.get(
+        'NSLS2_MODULE_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'userpackages',
+                     'nsls2_modules.json'))
+
+
+def library_stamp(module_path):
+    """
+    Identity of the installed copy of module_path: the __version__ of its
+    top level package and the path and mtime of the module's own file,
+    so that both an upgrade and an edit of the wrapped module change it.
+    Finding the module imports the packages above it, as importing it
+    would, but not the module itself.
+    """
+    package = module_path.split('.')[0]
+    try:
+        if find_spec is not None:
+            path = getattr(find_spec(module_path), 'origin', None)
+        else:
+            path = getattr(pkgutil.find_loader(module_path), 'filename',
+                           None)
+    except (ImportError, ValueError, AttributeError):
+        path = None
+    version = getattr(sys.modules.get(package), '__version__', None)
+    mtime = None
+    if path is not None:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            pass
+    return [module_path, version, path, mtime]
+
+
+def _port_spec(port):
+    """
+    JSON form of an IPort/OPort or a plain port tuple, raises TypeError
+    for ports that do not survive a round trip
+    """
+    if hasattr(port, '_asdict'):
+        spec = dict(port._asdict())
+    elif isinstance(port, (tuple, list)):
+        spec = list(port)
+    else:
+        raise TypeError('cannot serialize port {0!r}'.format(port))
+    json.dumps(spec)
+    return spec
+
+
+def _absolute_name(module_name, package):
+    if module_name.startswith('.'):
+        return package + module_name
+    return module_name
+
+
+def _module_class(module_name, package, name):
+    """
+    The VisTrails module called name of a hand-built module
+    """
+    module = importlib.import_module(module_name, package)
+    for vtmod in module.vistrails_modules():
+        if vtmod.__name__ == name:
+            return vtmod
+    raise ImportError('{0} has no VisTrails module {1}'
+                      ''.format(_absolute_name(module_name, package), name))
+
+
+def _port(spec, port_type):
+    if isinstance(spec, dict):
+        return port_type(**dict((str(k), v) for k, v in spec.items()))
+    return tuple(spec)
+
+
+def describe(module_class):
+    """
+    Everything VisTrails needs to register module_class, as JSON, and the
+    names of the methods it defines. Raises TypeError for classes with
+    static or class methods or properties, which a stub cannot defer.
+    """
+    methods = set()
+    mro = module_class.__mro__
+    for cls in mro[:mro.index(Module)]:
+        for name, value in vars(cls).items():
+            if name.startswith('__'):
+                continue
+            if isinstance(value, (staticmethod, classmethod, property)):
+                raise TypeError('cannot defer {0}.{1}'.format(
+                    module_class.__name__, name))
+            if inspect.isfunction(value):
+                methods.add(name)
+    settings = getattr(module_class, '_settings', None)
+    if settings is not None:
+        settings = dict((k, v) for k, v in settings._asdict().items()
+                        if v is not None)
+    description = {
+        'name': module_class.__name__,
+        'doc': module_class.__doc__,
+        'settings': settings,
+        'input_ports': [_port_spec(p) for p in
+                        getattr(module_class, '_input_ports', [])],
+        'output_ports': [_port_spec(p) for p in
+                         getattr(module_class, '_output_ports', [])],
+        'methods': sorted(methods),
+    }
+    json.dumps(description)
+    return description
+
+
+def make_stub(description, load):
+    """
+    Module class with the ports of a described module that only loads
+    the real class, load(), when one of its methods is first called
+
+    The first call copies the attributes of the real class onto the
+    stub, so from then on the stub behaves exactly like it.
+    """
+    lock = threading.Lock()
+    loaded = []
+    deferred = {}
+
+    def resolve():
+        with lock:
+            if loaded:
+                return
+            logger.debug('loading %s on first use', description['name'])
+            real = load()
+            mro = real.__mro__
+            for cls in reversed(mro[:mro.index(Module)]):
+                for name, value in vars(cls).items():
+                    if not name.startswith('__'):
+                        setattr(stub, name, value)
+            # methods the real class no longer has fall back to Module's
+            for name, method in deferred.items():
+                if vars(stub).get(name) is method:
+                    delattr(stub, name)
+            loaded.append(real)
+
+    def defer(name):
+        def method(self, *args, **kwargs):
+            resolve()
+            return getattr(stub, name)(self, *args, **kwargs)
+        method.__name__ = str(name)
+        deferred[name] = method
+        return method
+
+    attrs = {
+        '__doc__': description['doc'],
+        '_input_ports': [_port(p, IPort)
+                         for p in description['input_ports']],
+        '_output_ports': [_port(p, OPort)
+                          for p in description['output_ports']],
+    }
+    for name in description['methods']:
+        attrs[str(name)] = defer(name)
+    if description['settings'] is not None:
+        attrs['_settings'] = ModuleSettings(**dict(
+            (str(k), v) for k, v in description['settings'].items()))
+    stub = type(str(description['name']), (Module,), attrs)
+    return stub
+
+
+class ModuleRegistry(object):
+    """
+    Registration cache of the modules of modules.yaml
+
+    The port signatures that wrap_lib derives from the docstrings, and
+    the ports of the hand-built modules, are stored in a JSON file keyed
+    by the contents of modules.yaml, the installed copies of the wrapped
+    libraries and hand-built modules and the Python version. While the
+    key matches, modules are registered as stubs and the libraries are
+    only imported when a module is first executed; otherwise they are
+    imported and wrapped as before and the cache is rewritten.
+
+    Parameters
+    ----------
+    modules_yaml : bytes
+        Contents of modules.yaml
+    func_list : list
+        The autowrap_func entries of modules.yaml
+    import_list : list, optional
+        (module_name, package) of each hand-built module of modules.yaml
+    path : str, optional
+        Cache file, defaults to default_registry_path()
+    """
+    def __init__(self, modules_yaml, func_list, import_list=(), path=None):
+        self.path = default_registry_path() if path is None else path
+        self.key = self._key(modules_yaml, func_list, import_list)
+        self.entries = {}
+        self._dirty = False
+        if self.path:
+            self._load()
+
+    @staticmethod
+    def _key(modules_yaml, func_list, import_list):
+        stamps = [library_stamp(f['module_path']) for f in func_list]
+        stamps.extend(library_stamp(_absolute_name(module_name, package))
+                      for module_name, package in import_list)
+        stamps.append(library_stamp(wrap_lib.__name__))
+        digest = hashlib.sha1(modules_yaml)
+        digest.update(json.dumps([REGISTRY_VERSION, sys.version,
+                                  stamps]).encode('utf-8'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def _entry_key(func_dict):
+        return json.dumps(func_dict, sort_keys=True)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if stored.get('key') == self.key:
+            self.entries = stored['entries']
+        else:
+            logger.info('module registration cache %s is stale', self.path)
+
+    def wrap_function(self, func_dict):
+        """
+        Stub from the cache, or the wrapped function on a cache miss
+        """
+        description = self.entries.get(self._entry_key(func_dict))
+        if description is not None:
+            return make_stub(description,
+                             lambda: wrap_lib.wrap_function(**func_dict))
+        vtfunc = wrap_lib.wrap_function(**func_dict)
+        if self.path:
+            try:
+                self.entries[self._entry_key(func_dict)] = describe(vtfunc)
+                self._dirty = True
+            except (TypeError, ValueError) as err:
+                # registered eagerly on every startup
+                logger.info('not caching %s: %s', func_dict, err)
+        return vtfunc
+
+    def import_modules(self, module_name, package):
+        """
+        The VisTrails modules of a hand-built module: stubs from the cache,
+        or the vistrails_modules() of the imported module on a cache miss
+        """
+        key = json.dumps({'import': module_name, 'package': package},
+                         sort_keys=True)
+        descriptions = self.entries.get(key)
+        if descriptions is not None:
+            return [make_stub(d, lambda name=d['name']: _module_class(
+                module_name, package, name)) for d in descriptions]
+        vtmods = importlib.import_module(module_name,
+                                         package).vistrails_modules()
+        if self.path:
+            try:
+                self.entries[key] = [describe(m) for m in vtmods]
+                self._dirty = True
+            except (TypeError, ValueError, AttributeError) as err:
+                # imported on every startup
+                logger.info('not caching %s: %s',
+                            _absolute_name(module_name, package), err)
+        return vtmods
+
+    def save(self):
+        """
+        Write the cache if any function was wrapped since it was loaded
+        """
+        if not self._dirty:
+            return
+        try:
+            # a concurrent startup never reads half a file
+            write_json(self.path, {'key': self.key, 'entries': self.entries})
+            self._dirty = False
+        except (IOError, OSError) as err:
+            logger.warning('could not save module registration cache %s: %s',
+                           self.path, err)
@@ -0,0 +1,270 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the batched, pooled and cached broker queries
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import threading
+import time
+import pytest
+
+pytest.importorskip('vistrails')
+from nsls2.broker_query import (BrokerService, ConnectionPool,  # noqa: E402
+                                QueryBatcher, TTLCache, query_key)
+from nsls2.local_broker import LocalBroker, write_run  # noqa: E402
+
+
+class RecordingBroker(LocalBroker):
+    """
+    LocalBroker recording the size of every batch, the first batch waits
+    for release() so that later callers pile up behind it
+    """
+    def __init__(self, root, hold_first=False):
+        LocalBroker.__init__(self, root)
+        self.sizes = []
+        self.gate = threading.Event()
+        if not hold_first:
+            self.gate.set()
+
+    def find_headers(self, queries):
+        first = not self.sizes
+        self.sizes.append(len(queries))
+        if first:
+            self.gate.wait(10)
+        return LocalBroker.find_headers(self, queries)
+
+    def release(self):
+        self.gate.set()
+
+
+@pytest.fixture
+def broker_dir(tmpdir):
+    root = str(tmpdir.join('broker'))
+    for scan_id in range(10):
+        write_run(root, {'uid': 'run{0}'.format(scan_id),
+                         'scan_id': scan_id, 'owner': 'xf23id'},
+                  [{'seq_num': i, 'data': {'I0': i * scan_id}}
+                   for i in range(3)])
+    return root
+
+
+def query_many(batcher, scan_ids):
+    # one thread per query, results by scan id
+    results = {}
+
+    def run(scan_id):
+        query = {'scan_id': scan_id}
+        results[scan_id] = batcher.submit(query_key(query), query)
+    threads = [threading.Thread(target=run, args=(scan_id,))
+               for scan_id in scan_ids]
+    for t in threads:
+        t.start()
+    return threads, results
+
+
+def test_concurrent_queries_are_coalesced(broker_dir):
+    broker = RecordingBroker(broker_dir, hold_first=True)
+    batcher = QueryBatcher(ConnectionPool(lambda: broker, 2),
+                           'find_headers', window=0.5)
+    # a lone caller goes out at once and holds the backend
+    first, results = query_many(batcher, [0])
+    while not broker.sizes:
+        time.sleep(0.001)
+    threads, later = query_many(batcher, range(1, 9))
+    broker.release()
+    for t in first + threads:
+        t.join(10)
+    results.update(later)
+    assert broker.sizes == [1, 8]
+    assert batcher.batches == 2
+    assert batcher.requests == 9
+    for scan_id in range(9):
+        assert [h['uid'] for h in results[scan_id]] == \
+            ['run{0}'.format(scan_id)]
+
+
+def test_batches_are_capped_at_max_batch(broker_dir):
+    broker = RecordingBroker(broker_dir, hold_first=True)
+    batcher = QueryBatcher(ConnectionPool(lambda: broker, 4),
+                           'find_headers', window=0.5, max_batch=3)
+    first, results = query_many(batcher, [0])
+    while not broker.sizes:
+        time.sleep(0.001)
+    threads, later = query_many(batcher, range(1, 10))
+    broker.release()
+    for t in first + threads:
+        t.join(10)
+    results.update(later)
+    assert broker.sizes[0] == 1
+    assert max(broker.sizes) <= 3
+    assert sum(broker.sizes) == 10
+    assert sorted(results) == list(range(10))
+
+
+def test_one_caller_is_split_into_full_batches(broker_dir):
+    broker = RecordingBroker(broker_dir)
+    batcher = QueryBatcher(ConnectionPool(lambda: broker, 1),
+                           'find_headers', window=5, max_batch=3)
+    queries = [{'scan_id': scan_id} for scan_id in range(7)]
+    start = time.time()
+    results = batcher.submit_many([query_key(q) for q in queries], queries)
+    assert time.time() - start < 2
+    assert broker.sizes == [3, 3, 1]
+    assert [r[0]['scan_id'] for r in results] == list(range(7))
+
+
+def test_lone_caller_skips_the_window(broker_dir):
+    broker = RecordingBroker(broker_dir)
+    batcher = QueryBatcher(ConnectionPool(lambda: broker, 1),
+                           'find_headers', window=5)
+    start = time.time()
+    assert batcher.submit('q', {'owner': 'xf23id'})[0]['uid'] == 'run0'
+    assert time.time() - start < 2
+    assert batcher.batches == 1
+
+
+def test_identical_requests_are_sent_once(broker_dir):
+    broker = RecordingBroker(broker_dir)
+    batcher = QueryBatcher(ConnectionPool(lambda: broker, 1),
+                           'find_headers')
+    query = {'scan_id': 3}
+    results = batcher.submit_many([query_key(query)] * 4, [query] * 4)
+    assert broker.sizes == [1]
+    assert len(results) == 4
+
+
+def test_backend_errors_reach_every_caller():
+    class Failing(object):
+        def find_headers(self, queries):
+            raise IOError('broker down')
+
+    batcher = QueryBatcher(ConnectionPool(Failing, 1), 'find_headers')
+    with pytest.raises(IOError):
+        batcher.submit('q', {})
+    # the connection went back to the pool
+    with pytest.raises(IOError):
+        batcher.submit('q', {})
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(ttl=0.05)
+    cache.put('k', [1])
+    assert cache.get('k') == [1]
+    time.sleep(0.1)
+    assert cache.get('k') is None
+    # a longer ttl for this read
+    assert cache.get('k', ttl=60) == [1]
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_ttl_cache_drops_the_oldest_entries():
+    cache = TTLCache(max_entries=2)
+    for key in 'abc':
+        cache.put(key, key)
+    assert cache.get('a') is None
+    assert cache.get('b') == 'b'
+    assert cache.get('c') == 'c'
+
+
+def test_ttl_cache_hands_out_copies():
+    cache = TTLCache()
+    headers = [{'uid': 'run0', 'scan_id': 0}]
+    returned = cache.put('k', headers)
+    headers[0]['scan_id'] = 'changed by the caller'
+    returned.append('added by the caller')
+    got = cache.get('k')
+    assert got == [{'uid': 'run0', 'scan_id': 0}]
+    got[0]['scan_id'] = 'changed again'
+    assert cache.get('k') == [{'uid': 'run0', 'scan_id': 0}]
+
+
+def test_pool_reuses_returned_connections():
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+    pool = ConnectionPool(factory, size=2)
+    a = pool.acquire()
+    b = pool.acquire()
+    assert a is not b and len(created) == 2
+    pool.release(b)
+    assert pool.acquire() is b
+    assert len(created) == 2
+
+
+def test_exhausted_pool_blocks_until_a_release():
+    pool = ConnectionPool(object, size=1)
+    conn = pool.acquire()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.acquire()))
+    t.start()
+    t.join(0.1)
+    assert got == []
+    pool.release(conn)
+    t.join(10)
+    assert got == [conn]
+
+
+def test_failed_connection_frees_its_place():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) == 1:
+            raise IOError('refused')
+        return object()
+    pool = ConnectionPool(factory, size=1)
+    with pytest.raises(IOError):
+        pool.acquire()
+    assert pool.acquire() is not None
+
+
+def test_service_queries_the_local_broker(broker_dir):
+    service = BrokerService(lambda: LocalBroker(broker_dir), ttl=60)
+    result = service.query({'scan_id': 4, 'data': True})
+    assert [h['uid'] for h in result] == ['run4']
+    assert [e['data']['I0'] for e in result[0]['events']] == [0, 4, 8]
+    # callers changing the result do not change the cached one
+    result[0]['events'].pop()
+    result[0]['scan_id'] = -1
+    again = service.query({'scan_id': 4, 'data': True})
+    assert again[0]['scan_id'] == 4
+    assert len(again[0]['events']) == 3
+    stats = service.stats()
+    assert stats['cache_hits'] == 2
+    assert stats['header_batches'] == stats['event_batches'] == 1
+    service.close()
@@ -0,0 +1,63 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the atomic file writes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import pytest
+from nsls2 import fileio
+
+
+def test_write_json_replaces_the_file(tmpdir):
+    path = str(tmpdir.join('sub', 'out.json'))
+    fileio.write_json(path, {'a': 1})
+    fileio.write_json(path, {'a': 2})
+    with open(path) as f:
+        assert json.load(f) == {'a': 2}
+    # no temporary files left behind
+    assert os.listdir(os.path.dirname(path)) == ['out.json']
+
+
+def test_same_as_the_specdata_copy():
+    here = os.path.abspath(fileio.__file__).replace('.pyc', '.py')
+    other = os.path.join(os.path.dirname(os.path.dirname(here)), 'SpecData',
+                         'fileio.py')
+    if not os.path.exists(other):
+        pytest.skip('SpecData is not installed next to NSLS-II')
+    with open(here, 'rb') as a, open(other, 'rb') as b:
+        assert a.read() == b.read()
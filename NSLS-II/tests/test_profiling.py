@@ -0,0 +1,128 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the startup profiler
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import os
+import re
+import sys
+import pytest
+from nsls2.profiling import StartupProfiler, package_versions
+
+
+@pytest.mark.parametrize('setting', [None, '', '0'])
+def test_off_unless_set(monkeypatch, setting):
+    if setting is None:
+        monkeypatch.delenv('NSLS2_PROFILE_STARTUP', raising=False)
+    else:
+        monkeypatch.setenv('NSLS2_PROFILE_STARTUP', setting)
+    profiler = StartupProfiler.from_environ()
+    assert not profiler.enabled
+    assert profiler.json_path is None
+
+
+def test_one_means_the_default_path(monkeypatch, tmpdir):
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setenv('NSLS2_PROFILE_STARTUP', '1')
+    profiler = StartupProfiler.from_environ()
+    assert profiler.enabled
+    assert profiler.json_path == os.path.join(
+        str(tmpdir), '.cache', 'userpackages', 'nsls2_startup_profile.jsonl')
+
+
+def test_explicit_path(monkeypatch, tmpdir):
+    path = str(tmpdir.join('profile.jsonl'))
+    monkeypatch.setenv('NSLS2_PROFILE_STARTUP', path)
+    assert StartupProfiler.from_environ().json_path == path
+
+
+def test_measure_is_a_no_op_when_off():
+    profiler = StartupProfiler()
+    ran = []
+    with profiler.measure('import', 'numpy'):
+        ran.append(1)
+    with pytest.raises(KeyError):
+        with profiler.measure('import', 'broken'):
+            raise KeyError('broken')
+    assert ran == [1]
+    assert profiler.records == []
+    # nothing is printed or written
+    profiler.report('0.0.0')
+
+
+def test_measure_records_failed_steps_too():
+    profiler = StartupProfiler(os.devnull)
+    with profiler.measure('import', 'ok'):
+        pass
+    with pytest.raises(KeyError):
+        with profiler.measure('autowrap', 'broken'):
+            raise KeyError('broken')
+    assert [(r['kind'], r['name']) for r in profiler.records] == \
+        [('import', 'ok'), ('autowrap', 'broken')]
+    assert all(r['wall_s'] >= 0 for r in profiler.records)
+
+
+def test_report_appends_one_line_per_startup(tmpdir):
+    path = str(tmpdir.join('cache', 'profile.jsonl'))
+    for version in ('1.0', '1.1'):
+        profiler = StartupProfiler(path)
+        with profiler.measure('yaml', 'modules.yaml'):
+            pass
+        with profiler.measure('import', 'pytest.mark'):
+            pass
+        profiler.report(nsls2_version=version)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    reports = [json.loads(line) for line in lines]
+    assert [r['nsls2_version'] for r in reports] == ['1.0', '1.1']
+    assert reports[0]['timestamp'] <= reports[1]['timestamp']
+    for report in reports:
+        assert report['python'] == sys.version
+        # only imported and autowrapped libraries are versioned
+        assert report['versions'] == {'pytest': pytest.__version__}
+        assert report['commit'] is None or \
+            re.match('^[0-9a-f]{40}$', report['commit'])
+        assert sorted(r['name'] for r in report['records']) == \
+            ['modules.yaml', 'pytest.mark']
+
+
+def test_package_versions():
+    assert package_versions(['pytest.mark', 'pytest',
+                             'not_imported.module']) == \
+        {'pytest': pytest.__version__}
@@ -0,0 +1,242 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the cached module registration
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import sys
+import textwrap
+import pytest
+
+pytest.importorskip('vistrails')
+pytest.importorskip('vttools')
+from vistrails.core.modules.vistrails_module import Module  # noqa: E402
+from vistrails.core.modules.config import (IPort, OPort,  # noqa: E402
+                                           ModuleSettings)
+from nsls2 import registry  # noqa: E402
+from nsls2.registry import ModuleRegistry, describe, make_stub  # noqa: E402
+
+MODULES_YAML = b'autowrap_func: []\n'
+FUNC = {'func_name': 'scale', 'module_path': 'regtest_lib',
+        'namespace': 'core'}
+HAND_BUILT = textwrap.dedent('''
+    from vistrails.core.modules.vistrails_module import Module
+    from vistrails.core.modules.config import IPort, OPort
+
+
+    class Counter(Module):
+        """Counts"""
+        _input_ports = [IPort(name="start", signature="basic:Integer")]
+        _output_ports = [OPort(name="count", signature="basic:Integer")]
+
+        def is_cacheable(self):
+            return False
+
+        def compute(self):
+            self.set_output("count", self.get_input("start") + 1)
+
+
+    def vistrails_modules():
+        return [Counter]
+    ''')
+
+
+class Value(object):
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+class Scale(Module):
+    """Doubles x"""
+    _settings = ModuleSettings(namespace='core')
+    _input_ports = [IPort(name='x', signature='basic:Float')]
+    _output_ports = [OPort(name='y', signature='basic:Float')]
+
+    def compute(self):
+        self.set_output('y', self.double(self.get_input('x')))
+
+    def double(self, x):
+        return 2 * x
+
+
+@pytest.fixture
+def libraries(tmpdir, monkeypatch):
+    """
+    An autowrapped library and a hand-built module on sys.path, with
+    wrap_function recording what it wraps
+    """
+    tmpdir.join('regtest_lib.py').write('def scale(x):\n    return 2 * x\n')
+    tmpdir.join('regtest_mods.py').write(HAND_BUILT)
+    monkeypatch.syspath_prepend(str(tmpdir))
+    wrapped = []
+
+    def wrap_function(**func_dict):
+        wrapped.append(func_dict['func_name'])
+        return Scale
+    monkeypatch.setattr(registry.wrap_lib, 'wrap_function', wrap_function)
+    yield tmpdir, wrapped
+    sys.modules.pop('regtest_mods', None)
+
+
+def run(module_class, **inputs):
+    module = module_class()
+    for port, value in inputs.items():
+        module.set_input_port(port, Value(value))
+    module.compute()
+    return module.outputPorts
+
+
+def test_stub_loads_on_first_compute():
+    loads = []
+
+    def load():
+        loads.append(1)
+        return Scale
+    stub = make_stub(describe(Scale), load)
+    assert stub.__name__ == 'Scale'
+    assert stub.__doc__ == Scale.__doc__
+    assert [p.name for p in stub._input_ports] == ['x']
+    assert [p.name for p in stub._output_ports] == ['y']
+    assert stub._settings.namespace == 'core'
+    assert loads == []
+    assert run(stub, x=1.5) == {'y': 3.0}
+    assert run(stub, x=2.0) == {'y': 4.0}
+    assert loads == [1]
+    # the attributes of the real class were copied onto the stub
+    assert stub().double(3) == 6
+
+
+def test_stub_loads_on_any_method():
+    class Uncached(Scale):
+        def is_cacheable(self):
+            return False
+    loads = []
+    stub = make_stub(describe(Uncached),
+                     lambda: loads.append(1) or Uncached)
+    assert stub().is_cacheable() is False
+    assert loads == [1]
+
+
+def test_methods_missing_from_the_real_class_fall_back_to_module():
+    description = describe(Scale)
+    description['methods'].append('is_cacheable')
+    stub = make_stub(description, lambda: Scale)
+    assert stub().is_cacheable() == Module().is_cacheable()
+
+
+def test_describe_refuses_static_methods():
+    class PortType(Module):
+        @staticmethod
+        def validate(x):
+            return True
+    with pytest.raises(TypeError):
+        describe(PortType)
+
+
+def test_cached_functions_are_stubs(libraries, tmpdir):
+    _, wrapped = libraries
+    path = str(tmpdir.join('cache.json'))
+    first = ModuleRegistry(MODULES_YAML, [FUNC], path=path)
+    assert first.wrap_function(FUNC) is Scale
+    first.save()
+    second = ModuleRegistry(MODULES_YAML, [FUNC], path=path)
+    stub = second.wrap_function(FUNC)
+    assert stub is not Scale
+    assert wrapped == ['scale']
+    assert run(stub, x=3.0) == {'y': 6.0}
+    assert wrapped == ['scale', 'scale']
+
+
+def test_hand_built_modules_are_imported_on_first_use(libraries, tmpdir):
+    path = str(tmpdir.join('cache.json'))
+    first = ModuleRegistry(MODULES_YAML, [], [('regtest_mods', None)],
+                           path=path)
+    [counter] = first.import_modules('regtest_mods', None)
+    assert counter.__module__ == 'regtest_mods'
+    first.save()
+    del sys.modules['regtest_mods']
+    second = ModuleRegistry(MODULES_YAML, [], [('regtest_mods', None)],
+                            path=path)
+    [stub] = second.import_modules('regtest_mods', None)
+    assert stub.__name__ == 'Counter'
+    assert 'regtest_mods' not in sys.modules
+    assert stub().is_cacheable() is False
+    assert 'regtest_mods' in sys.modules
+    assert run(stub, start=1) == {'count': 2}
+
+
+@pytest.mark.parametrize('change', ['yaml', 'library', 'hand_built'])
+def test_cache_is_stale_when_its_inputs_change(libraries, tmpdir, change):
+    _, wrapped = libraries
+    path = str(tmpdir.join('cache.json'))
+    imports = [('regtest_mods', None)]
+    first = ModuleRegistry(MODULES_YAML, [FUNC], imports, path=path)
+    first.wrap_function(FUNC)
+    first.import_modules('regtest_mods', None)
+    first.save()
+    assert ModuleRegistry(MODULES_YAML, [FUNC], imports,
+                          path=path).entries
+
+    modules_yaml = MODULES_YAML
+    if change == 'yaml':
+        modules_yaml += b'# edited\n'
+    else:
+        name = 'regtest_lib.py' if change == 'library' else 'regtest_mods.py'
+        module_file = str(tmpdir.join(name))
+        mtime = os.path.getmtime(module_file) + 10
+        os.utime(module_file, (mtime, mtime))
+    stale = ModuleRegistry(modules_yaml, [FUNC], imports, path=path)
+    assert stale.key != first.key
+    assert stale.entries == {}
+    # wrapped again and the cache rewritten
+    assert stale.wrap_function(FUNC) is Scale
+    assert wrapped == ['scale', 'scale']
+    stale.save()
+    assert ModuleRegistry(modules_yaml, [FUNC], imports,
+                          path=path).entries
+
+
+def test_empty_path_turns_the_cache_off(libraries):
+    _, wrapped = libraries
+    for _ in range(2):
+        off = ModuleRegistry(MODULES_YAML, [FUNC], path='')
+        assert off.wrap_function(FUNC) is Scale
+        off.save()
+    assert wrapped == ['scale', 'scale']
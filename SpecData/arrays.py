@@ -0,0 +1,69 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Port type for NumPy arrays passed between SpecData modules
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from vistrails.core.modules.vistrails_module import Module
+from vistrails.core.modules.config import ModuleSettings
+
+
+class NDArray(Module):
+    """
+        Port type of arrays: ndarrays, their views, memory maps and lazy
+        image stacks. The object on the port is handed to the next module
+        as is, with its own shape and dtype, where basic:List ports may
+        turn it into a list.
+    """
+    _settings = ModuleSettings(abstract=True)
+
+    @staticmethod
+    def validate(x):
+        return hasattr(x, 'shape') and hasattr(x, 'dtype')
+
+
+def readonly_view(arr):
+    """
+        Read-only view of an ndarray, so that a module writing to its input
+        cannot change the array it was taken from, whether the array owns
+        its data or not. Other objects are returned as they are.
+    """
+    if not isinstance(arr, np.ndarray):
+        return arr
+    view = arr.view()
+    view.flags.writeable = False
+    return view
@@ -0,0 +1,164 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Batch loading of dark corrected scans from one SPEC file
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import collections
+import os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from pyspec.ccd.transformations import FileProcessor
+from .cache import ScanCache
+from .precision import DOUBLE
+from .prefetch import decode_stack, spec_file_lock
+
+# master darks, keyed by spec file, ccd path and exposure setting
+master_darks = ScanCache(1024 * 2 ** 20)
+
+# number of scans loaded concurrently
+DEFAULT_WORKERS = 4
+
+
+def frame_exposures(scan, n_frames):
+    """
+    Exposure setting of each frame of a scan, from its 'Seconds' counter.
+    None for every frame if the scan does not record it.
+    """
+    seconds = getattr(scan, 'Seconds', None)
+    if seconds is None:
+        return [None] * n_frames
+    return [round(float(t), 6) for t in np.ravel(seconds)[:n_frames]]
+
+
+class ScanSeries(object):
+    """
+    Dark corrected image stacks of several scans of one SPEC file
+
+    Iterating yields (scan_no, stack) pairs in the order of scan_numbers.
+    Scans are read on a thread pool, decompression and I/O release the
+    GIL, but at most n_workers scans are loading or waiting to be
+    consumed at any time, so the series is never held in memory at once.
+
+    Darks are subtracted in place using one master dark per exposure
+    setting: the mean of the dark images of the first scan that used the
+    setting. Master darks are kept in master_darks and shared by all
+    later scans with the same setting.
+
+    Parameters
+    ----------
+    sf : pyspec.spec.SpecDataFile
+        Opened SPEC file
+    scan_numbers : sequence
+        Scans to load
+    has_dark : bool, optional
+        Whether to subtract darks
+    n_workers : int, optional
+        Size of the thread pool and of the read-ahead window
+    precision : precision.Precision, optional
+        dtype policy of the stacks
+    """
+    def __init__(self, sf, scan_numbers, has_dark=True,
+                 n_workers=DEFAULT_WORKERS, precision=DOUBLE):
+        self.sf = sf
+        self.scan_numbers = list(scan_numbers)
+        self.has_dark = has_dark
+        self.n_workers = max(int(n_workers), 1)
+        self.precision = precision
+        # pyspec scans share the file handle of the SpecDataFile, and so
+        # does the scan prefetcher
+        self._sf_lock = spec_file_lock(sf)
+
+    def __len__(self):
+        return len(self.scan_numbers)
+
+    def __iter__(self):
+        pool = ThreadPool(self.n_workers)
+        pending = collections.deque()
+        todo = iter(self.scan_numbers)
+
+        def submit():
+            for scan_no in todo:
+                pending.append((scan_no,
+                                pool.apply_async(self.load, (scan_no,))))
+                return
+
+        try:
+            for _ in range(self.n_workers):
+                submit()
+            while pending:
+                scan_no, result = pending.popleft()
+                stack = result.get()
+                submit()
+                yield scan_no, stack
+        finally:
+            pool.terminate()
+
+    def load(self, scan_no):
+        """
+        Dark corrected, monitor normalised stack of one scan
+        """
+        with self._sf_lock:
+            scan = self.sf[scan_no]
+            fp = FileProcessor(spec=scan)
+        loader = self.precision.frame_loader(fp, dark=self.has_dark)
+        n_frames = len(loader)
+        if self.has_dark:
+            exposures = frame_exposures(scan, n_frames)
+            darks = self._master_darks(loader, exposures)
+            loader.dark_for = lambda i: darks[exposures[i]]
+            loader.dtype = self.precision.frame_dtype_for(loader)
+        # the scans themselves are already loaded in parallel
+        return decode_stack(loader, n_workers=1)
+
+    def _master_darks(self, loader, exposures):
+        darks = {}
+        for exposure in set(exposures):
+            key = (os.path.abspath(self.sf.filename),
+                   getattr(self.sf, 'ccdpath', None), exposure)
+            master = master_darks.get(key)
+            if master is None:
+                names = set(tuple(n) if isinstance(n, list) else n
+                            for n, e in zip(loader.darkfilenames, exposures)
+                            if e == exposure and n is not None)
+                images = [loader.read_dark(list(n) if isinstance(n, tuple)
+                                           else n) for n in names]
+                images = [img for img in images if img is not None]
+                if images:
+                    master = np.mean(images, axis=0)
+                    master_darks.put(key, master)
+            darks[exposure] = master
+        return darks
@@ -0,0 +1,248 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Process-wide cache of opened SPEC files, scans and image stacks
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import collections
+import hashlib
+import logging
+import os
+import threading
+import types
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# default budget, can be overridden with the SPECDATA_CACHE_MB env variable
+DEFAULT_CACHE_MB = 2048
+
+# bytes at the end of a SPEC file hashed into the keys of its scans
+_STAMP_BYTES = 4096
+
+
+def nbytes_of(*objs, **kwargs):
+    """
+    Best effort estimate of the memory held by arrays in objs
+
+    ndarrays count with their nbytes, lists/tuples/dicts are walked and
+    any other object contributes the arrays found in its __dict__, down to
+    max_depth levels (default 3) so that back references such as
+    scan -> SpecDataFile do not pull in unrelated data. Arrays reachable
+    through several objects are counted once.
+    """
+    max_depth = kwargs.pop('max_depth', 3)
+    seen = set()
+    total = 0
+    todo = [(obj, 0) for obj in objs]
+    while todo:
+        obj, depth = todo.pop()
+        if obj is None or id(obj) in seen or depth > max_depth or \
+                isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, np.ndarray):
+            # views share the memory of their base
+            base = obj
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            if base is not obj:
+                todo.append((base, depth))
+            else:
+                total += obj.nbytes
+        elif isinstance(obj, (list, tuple)):
+            todo.extend((o, depth + 1) for o in obj)
+        elif isinstance(obj, dict):
+            todo.extend((o, depth + 1) for o in obj.values())
+        elif hasattr(obj, '__dict__'):
+            todo.extend((o, depth + 1) for o in vars(obj).values())
+    return total
+
+
+def _text_nbytes(*texts):
+    return sum(len(t) for t in texts if isinstance(t, (bytes, type(''))))
+
+
+def spec_file_nbytes(sf):
+    """
+    Estimate of the memory held by an opened pyspec SpecDataFile: its
+    scan offset index, its header and the scans it has parsed, which it
+    keeps for as long as it is open (data arrays, per column arrays and
+    header lines)
+    """
+    # a dict entry with two small ints is about 100 bytes
+    total = 100 * len(getattr(sf, 'findex', None) or ())
+    total += _text_nbytes(getattr(sf, 'header', None))
+    for scan in list((getattr(sf, 'scandata', None) or {}).values()):
+        total += nbytes_of(getattr(scan, 'data', None),
+                           getattr(scan, 'scandata', None))
+        total += _text_nbytes(getattr(scan, 'header', None),
+                              getattr(scan, 'comments', None))
+    return total
+
+
+class ScanCache(object):
+    """
+    Thread safe LRU cache with a byte budget
+
+    Parameters
+    ----------
+    max_bytes : int
+        Entries are evicted, least recently used first, once the summed
+        size of all entries exceeds this budget
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, nbytes=None):
+        """
+        Store value under key. nbytes defaults to nbytes_of(value).
+        """
+        if nbytes is None:
+            nbytes = nbytes_of(value)
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+    def update_nbytes(self, key, nbytes=None):
+        """
+        Re-account an entry whose value has grown, e.g. a lazy stack that
+        was loaded into memory after it was cached
+        """
+        with self._lock:
+            if key not in self._entries:
+                return
+            value, old = self._entries[key]
+            if nbytes is None:
+                nbytes = nbytes_of(value)
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes - old
+            self._evict()
+
+    def discard(self, key):
+        """
+        Remove key if it is cached
+        """
+        with self._lock:
+            self._discard(key)
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = int(max_bytes)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Dictionary of the cache counters
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def _evict(self):
+        # the most recent entry is kept even if it alone exceeds the budget
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            key, (value, size) = self._entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+            logger.debug('evicted %s (%d bytes) from the scan cache',
+                         key, size)
+
+
+def file_stamp(path):
+    """
+    Size of a file and a hash of its last bytes, as the scan index checks
+    them. Unlike the mtime it changes with a rewrite however quick and
+    whatever the timestamps say, and not when the file is only touched.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - _STAMP_BYTES, 0))
+        return size, hashlib.sha1(f.read()).hexdigest()
+
+
+def scan_key(spec_path, ccd_path, scan_no, *extra):
+    """
+    Cache and prefetch key of a scan: the path and file_stamp of the SPEC
+    file, the CCD folder and the scan number, so that a rewritten or
+    extended file never returns stale scans.
+    """
+    spec_path = os.path.abspath(spec_path)
+    return (spec_path, file_stamp(spec_path), ccd_path, scan_no) + extra
+
+
+scan_cache = ScanCache(
+    int(os.environ.get('SPECDATA_CACHE_MB', DEFAULT_CACHE_MB)) * 2 ** 20)
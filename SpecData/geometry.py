@@ -0,0 +1,266 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Six-circle diffractometer geometry for converting CCD pixels to HKL
+
+Angles follow the conventions of H. You, J. Appl. Cryst. 32 (1999) 614,
+the same ones pyspec's ccdToQ uses: the beam runs along y, the detector
+arm is rotated by delta and gamma (nu) and the sample by mu, theta (eta),
+chi and phi.  Q is expressed in units of 2 pi / wavelength.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from .cache import ScanCache
+
+# direction tables of recently used detector configurations
+direction_tables = ScanCache(256 * 2 ** 20)
+
+
+def _rot_x(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def _rot_y(a):
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def _rot_z(a):
+    # left handed about z, as DELTA, ETA and PHI are defined by You
+    c, s = np.cos(a), np.sin(a)
+    return np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+
+class Detector(object):
+    """
+    Area detector on the delta/gamma arm of a six-circle diffractometer
+
+    Parameters
+    ----------
+    size_x, size_y : int
+        Number of pixels along the first (delta) and second (gamma) axis
+    pix_size_x, pix_size_y : float
+        Pixel size, in the units of dist
+    cen_x, cen_y : float
+        Pixel that the arm points at
+    dist : float
+        Sample to detector distance
+    """
+    def __init__(self, size_x, size_y, pix_size_x, pix_size_y, cen_x, cen_y,
+                 dist):
+        self.size_x = int(size_x)
+        self.size_y = int(size_y)
+        self.pix_size_x = float(pix_size_x)
+        self.pix_size_y = float(pix_size_y)
+        self.cen_x = float(cen_x)
+        self.cen_y = float(cen_y)
+        self.dist = float(dist)
+
+    @classmethod
+    def from_ccd_size(cls, ccd_size, dist=355.0):
+        """
+        Detector of the given shape with the 2048 x 13.5 um chip, binned
+        down to ccd_size, and centred on the middle pixel
+        """
+        size_x, size_y = ccd_size
+        return cls(size_x, size_y,
+                   0.0135 * 2048 / size_x, 0.0135 * 2048 / size_y,
+                   size_x / 2.0, size_y / 2.0, dist)
+
+    @property
+    def shape(self):
+        return (self.size_x, self.size_y)
+
+    def key(self):
+        """
+        Hashable description of the detector configuration
+        """
+        return (self.size_x, self.size_y, self.pix_size_x, self.pix_size_y,
+                self.cen_x, self.cen_y, self.dist)
+
+    def pixel_directions(self, keep=None):
+        """
+        Unit vectors from the sample to each pixel, in the frame of the
+        detector arm (delta = gamma = 0)
+
+        Parameters
+        ----------
+        keep : ndarray, optional
+            2D boolean array, only pixels where it is True are returned
+
+        Returns
+        -------
+        ndarray
+            (3, n_pixels) array, pixels in C order of the frame
+        """
+        i, j = np.indices(self.shape, dtype=np.float64)
+        if keep is not None:
+            i, j = i[keep], j[keep]
+        x = -(i.ravel() - self.cen_x) * self.pix_size_x
+        z = -(j.ravel() - self.cen_y) * self.pix_size_y
+        y = np.full(x.shape, self.dist)
+        d = np.vstack([x, y, z])
+        return d / np.sqrt((d * d).sum(axis=0))
+
+
+def frame_transform(angles, ub, wavelength):
+    """
+    Affine map from arm-frame pixel directions to HKL for one frame
+
+    Parameters
+    ----------
+    angles : sequence
+        delta, theta, chi, phi, mu, gamma in degrees, as returned by
+        pyspec's SpecScan.getSIXCAngles()
+    ub : ndarray
+        3 x 3 orientation matrix
+    wavelength : float
+        Wavelength in Angstrom
+
+    Returns
+    -------
+    A, b : ndarray
+        hkl = A . d + b for a pixel direction d
+    """
+    delta, theta, chi, phi, mu, gamma = np.radians(angles)
+    k = 2 * np.pi / wavelength
+    arm = _rot_x(gamma).dot(_rot_z(delta))
+    sample = _rot_x(mu).dot(_rot_z(theta)).dot(_rot_y(chi)).dot(_rot_z(phi))
+    to_hkl = np.linalg.inv(ub).dot(sample.T) * k
+    return to_hkl.dot(arm), -to_hkl[:, 1]
+
+
+def cached_pixel_directions(detector, keep=None):
+    """
+    Detector.pixel_directions(keep), computed once per detector
+    configuration and mask and then shared by all frames and scans
+
+    The table does not depend on the energy or on any angle, these only
+    enter through the 3 x 3 frame_transform of each frame.
+    """
+    key = (detector.key(),
+           None if keep is None else (keep.shape,
+                                      np.packbits(keep).tobytes()))
+    directions = direction_tables.get(key)
+    if directions is None:
+        directions = direction_tables.put(key,
+                                          detector.pixel_directions(keep))
+    return directions
+
+
+def frame_hkl(detector, angles, ub, wavelength, keep=None):
+    """
+    HKL of every (kept) pixel of one frame as an (n_pixels, 3) array
+    """
+    A, b = frame_transform(angles, ub, wavelength)
+    d = cached_pixel_directions(detector, keep)
+    return (A.dot(d) + b[:, np.newaxis]).T
+
+
+class DetectorMask(object):
+    """
+    Pixels of an area detector that take part in gridding
+
+    The mask is a single 2D array that applies to every frame of a scan.
+    Pixels outside it are dropped before any per-pixel work is done.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of a detector frame
+    crop : sequence, optional
+        [top, left, bottom, right] number of pixels removed at each edge
+    roi : sequence, optional
+        [x_min, x_max, y_min, y_max], only pixels inside this rectangle
+        are kept
+    bad_pixels : ndarray, optional
+        2D array, pixels where it is nonzero are excluded
+    """
+    def __init__(self, shape, crop=None, roi=None, bad_pixels=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.crop = list(crop) if crop is not None else [0, 0, 0, 0]
+        self.roi = list(roi) if roi is not None else None
+        keep = np.zeros(self.shape, dtype=bool)
+        keep[self.crop[0]:self.shape[0] - self.crop[2],
+             self.crop[1]:self.shape[1] - self.crop[3]] = True
+        if self.roi is not None:
+            in_roi = np.zeros(self.shape, dtype=bool)
+            in_roi[self.roi[0]:self.roi[1], self.roi[2]:self.roi[3]] = True
+            keep &= in_roi
+        if bad_pixels is not None:
+            bad_pixels = np.asarray(bad_pixels)
+            if bad_pixels.shape != self.shape:
+                raise ValueError('bad pixel mask of shape {0} does not match '
+                                 'the detector shape {1}'
+                                 ''.format(bad_pixels.shape, self.shape))
+            keep &= bad_pixels == 0
+        self.keep = keep
+
+    @property
+    def n_pixels(self):
+        """
+        Number of pixels kept
+        """
+        return int(np.count_nonzero(self.keep))
+
+    def keeps_all(self):
+        return self.n_pixels == self.keep.size
+
+    def key(self):
+        """
+        Hashable description of the mask
+        """
+        return (self.shape, np.packbits(self.keep).tobytes())
+
+    def apply(self, frames):
+        """
+        Kept pixels of a frame (n_pixels,) or stack (n_frames, n_pixels)
+        """
+        frames = np.asarray(frames)
+        if frames.shape[-2:] != self.shape:
+            raise ValueError('frames of shape {0} do not match the detector '
+                             'shape {1}'.format(frames.shape[-2:],
+                                                self.shape))
+        return frames[..., self.keep]
+
+    def masked_stack(self, n_frames):
+        """
+        pyspec style mask, True where a pixel is excluded, for a stack of
+        n_frames. This is a broadcast view of the 2D mask and does not
+        allocate a frames x rows x cols array.
+        """
+        return np.broadcast_to(~self.keep, (n_frames,) + self.shape)
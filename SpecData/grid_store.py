@@ -0,0 +1,273 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Content addressed on-disk store of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import numpy as np
+from .fileio import replace
+from .sparse import SparseGrid
+logger = logging.getLogger(__name__)
+
+# defaults, can be overridden with the SPECDATA_GRID_STORE and
+# SPECDATA_GRID_STORE_MB env variables
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'userpackages', 'grids')
+DEFAULT_STORE_MB = 10240
+
+_DENSE_FIELDS = ('masked_data', 'std_dev', 'occupancy', 'raw_data')
+_SPARSE_FIELDS = ('index', 'occupancy', 'mean', 'std_err')
+_AXES = ('h_axis', 'k_axis', 'l_axis')
+# keys made by grid_key
+_KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# part of every key, bump when the content of stored grids changes
+# 2: axes are lower voxel edges
+STORE_VERSION = 2
+
+
+def grid_key(**identity):
+    """
+    Content hash of everything a gridded volume depends on
+
+    The values must be JSON serialisable, ndarrays are hashed by content.
+    """
+    def default(obj):
+        if isinstance(obj, np.ndarray):
+            return [obj.dtype.str, obj.shape,
+                    hashlib.sha1(np.ascontiguousarray(obj)).hexdigest()]
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, bytes):
+            return hashlib.sha1(obj).hexdigest()
+        raise TypeError('cannot hash {0!r}'.format(obj))
+    identity = dict(identity, store_version=STORE_VERSION)
+    text = json.dumps(identity, sort_keys=True, default=default)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _dense_meshes(axes):
+    """
+    X, Y, Z meshes as broadcast views of the axis vectors, no copies
+    """
+    shape = tuple(len(a) for a in axes)
+    return [np.broadcast_to(axes[0][:, np.newaxis, np.newaxis], shape),
+            np.broadcast_to(axes[1][np.newaxis, :, np.newaxis], shape),
+            np.broadcast_to(axes[2][np.newaxis, np.newaxis, :], shape)]
+
+
+class GridStore(object):
+    """
+    Gridded volumes stored as .npy files, one directory per content key
+
+    Stored volumes are memory-mapped when they are read back, so a hit
+    costs neither gridding time nor memory until the data is used. The
+    store is capped at max_bytes, least recently used entries go first.
+
+    Parameters
+    ----------
+    root : str, optional
+        Directory of the store
+    max_bytes : int, optional
+        Size cap of the store
+    """
+    def __init__(self, root=None, max_bytes=None):
+        if root is None:
+            root = os.environ.get('SPECDATA_GRID_STORE', DEFAULT_STORE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('SPECDATA_GRID_STORE_MB',
+                                           DEFAULT_STORE_MB)) * 2 ** 20
+        self.root = root
+        self.max_bytes = int(max_bytes)
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        Stored volume of key, None if there is none
+
+        Returns
+        -------
+        SparseGrid or tuple
+            The dense tuple is (X, Y, Z, I, E, N, raw), with X, Y, Z
+            broadcast views of the axis vectors
+        """
+        path = self._path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        # the mtime of meta.json is the last use, for eviction
+        os.utime(meta_path, None)
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        axes = [np.array(load(name)) for name in _AXES]
+        if meta['kind'] == 'sparse':
+            return SparseGrid(axes, *[load(name) for name in _SPARSE_FIELDS],
+                              min_occupancy=meta['min_occupancy'])
+        I, E, N, raw = [load(name) for name in _DENSE_FIELDS]
+        return tuple(_dense_meshes(axes)) + (I, E, N, raw)
+
+    def put(self, key, grid, **info):
+        """
+        Store a SparseGrid or a dense (X, Y, Z, I, E, N, raw) tuple
+
+        info is saved with the entry and shows up in entries()
+        """
+        if isinstance(grid, SparseGrid):
+            arrays = dict(zip(_SPARSE_FIELDS, [grid.index, grid.occupancy,
+                                               grid.mean, grid.std_err]))
+            axes = grid.axes
+            meta = {'kind': 'sparse', 'min_occupancy': grid.min_occupancy}
+        else:
+            X, Y, Z, I, E, N, raw = grid
+            arrays = dict(zip(_DENSE_FIELDS, [I, E, N, raw]))
+            axes = [X[:, 0, 0], Y[0, :, 0], Z[0, 0, :]]
+            meta = {'kind': 'dense'}
+        arrays.update(zip(_AXES, axes))
+        meta['nbytes'] = int(sum(np.asarray(a).nbytes
+                                 for a in arrays.values()))
+        meta['created'] = time.time()
+        meta['info'] = info
+        if meta['nbytes'] > self.max_bytes:
+            logger.info('grid %s is larger than the store, not saved', key)
+            return
+        try:
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+            tmp_path = tempfile.mkdtemp(dir=self.root, suffix='.tmp')
+            for name, arr in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'),
+                        np.asarray(arr))
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.isdir(self._path(key)):
+                shutil.rmtree(tmp_path)
+            else:
+                replace(tmp_path, self._path(key))
+        except (IOError, OSError) as err:
+            logger.warning('could not store grid %s: %s', key, err)
+            return
+        self._evict(keep=key)
+
+    def entries(self):
+        """
+        List of dicts describing the stored volumes, most recent first
+        """
+        out = []
+        if not os.path.isdir(self.root):
+            return out
+        for key in os.listdir(self.root):
+            meta_path = os.path.join(self._path(key), 'meta.json')
+            try:
+                with open(meta_path, 'r') as f:
+                    meta = json.load(f)
+                last_used = os.path.getmtime(meta_path)
+            except (IOError, OSError, ValueError):
+                continue
+            out.append({'key': key, 'kind': meta['kind'],
+                        'nbytes': meta['nbytes'],
+                        'created': meta['created'],
+                        'last_used': last_used,
+                        'info': meta.get('info', {})})
+        out.sort(key=lambda e: e['last_used'], reverse=True)
+        return out
+
+    def total_bytes(self):
+        return sum(e['nbytes'] for e in self.entries())
+
+    def purge(self, key=None):
+        """
+        Remove one entry, or all of them when key is None
+
+        Only keys made by grid_key or listed by entries() are accepted,
+        and only directories directly inside the store are removed.
+
+        Returns
+        -------
+        int
+            Number of entries removed
+
+        Raises
+        ------
+        ValueError
+            If key is not the key of a stored entry
+        """
+        if key is None:
+            return sum(self._remove(e['key']) for e in self.entries())
+        if not _KEY_RE.match(key) and \
+                key not in [e['key'] for e in self.entries()]:
+            raise ValueError("'{0}' is not a grid store key".format(key))
+        path = os.path.realpath(self._path(key))
+        if os.path.dirname(path) != os.path.realpath(self.root):
+            raise ValueError("grid store entry '{0}' is outside {1}"
+                             "".format(key, self.root))
+        if not self._remove(key):
+            raise ValueError("no grid stored under key '{0}'".format(key))
+        return 1
+
+    def _remove(self, key):
+        path = self._path(key)
+        if not os.path.isdir(path) or os.path.islink(path):
+            return 0
+        shutil.rmtree(path, ignore_errors=True)
+        return 1
+
+    def _evict(self, keep=None):
+        entries = self.entries()
+        total = sum(e['nbytes'] for e in entries)
+        for entry in reversed(entries):
+            if total <= self.max_bytes:
+                break
+            if entry['key'] == keep:
+                continue
+            self._remove(entry['key'])
+            total -= entry['nbytes']
+
+
+grid_store = GridStore()
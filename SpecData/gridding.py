@@ -0,0 +1,425 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+NumPy engine for binning pixel HKL coordinates onto a regular grid
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from .geometry import frame_transform, cached_pixel_directions
+from .stack import iter_blocks
+
+# number of frames binned per np.bincount pass
+DEFAULT_FRAMES_PER_CHUNK = 8
+
+# size budget of automatically sized grids
+DEFAULT_AUTO_GRID_MB = 512
+
+# (n_frames, n_pixels) intensities shared with the gridding worker processes
+_worker_pixels = None
+
+
+def grid_axes(qmin, qmax, bins):
+    """
+    Axis vectors of a grid, matching the meshes pyspec's getGridMesh
+    returns: the lower edge qmin + i * (qmax - qmin) / n of each voxel i,
+    the same voxels voxel_indices bins into
+
+    Returns
+    -------
+    list of ndarray
+        One vector of bins[i] lower voxel edges along each axis
+    """
+    return [lo + np.arange(n) * ((hi - lo) / n)
+            for lo, hi, n in zip(qmin, qmax, bins)]
+
+
+def axis_range(values, lo, hi):
+    """
+    [start, stop) indices of the voxels of an axis that overlap [lo, hi]
+
+    values are the lower voxel edges of grid_axes, so the voxel holding
+    lo starts at or below it.
+    """
+    start = max(int(np.searchsorted(values, lo, side='right')) - 1, 0)
+    return start, int(np.searchsorted(values, hi, side='right'))
+
+
+def voxel_indices(hkl, qmin, qmax, bins):
+    """
+    Flat (C order) voxel index of each point in hkl
+
+    Parameters
+    ----------
+    hkl : ndarray
+        (N, 3) array of coordinates
+    qmin, qmax : sequence
+        Lower and upper edge of the grid along each axis
+    bins : sequence
+        Number of voxels along each axis
+
+    Returns
+    -------
+    idx : ndarray
+        Flat voxel index of the points that fall inside the grid
+    inside : ndarray
+        Boolean mask of those points
+    """
+    qmin = np.asarray(qmin, dtype=np.float64)
+    qmax = np.asarray(qmax, dtype=np.float64)
+    bins = np.asarray(bins, dtype=np.intp)
+    pos = np.floor((hkl - qmin) * (bins / (qmax - qmin))).astype(np.intp)
+    inside = np.all((pos >= 0) & (pos < bins), axis=1)
+    pos = pos[inside]
+    idx = (pos[:, 0] * bins[1] + pos[:, 1]) * bins[2] + pos[:, 2]
+    return idx, inside
+
+
+class GridAccumulator(object):
+    """
+    Running sums of intensity, intensity**2 and occupancy on a 3D grid
+
+    Points can be added in any order and accumulators built from disjoint
+    parts of a scan can be merged, the result does not depend on either.
+
+    Parameters
+    ----------
+    qmin, qmax : sequence
+        Lower and upper edge of the grid along H, K and L
+    bins : sequence
+        Number of voxels along H, K and L
+    """
+    def __init__(self, qmin, qmax, bins):
+        self.qmin = [float(q) for q in qmin]
+        self.qmax = [float(q) for q in qmax]
+        self.bins = [int(b) for b in bins]
+        n_voxels = int(np.prod(self.bins))
+        self.sum = np.zeros(n_voxels, dtype=np.float64)
+        self.sum_sq = np.zeros(n_voxels, dtype=np.float64)
+        self.occupancy = np.zeros(n_voxels, dtype=np.int64)
+        self.out_of_bounds = 0
+
+    def add(self, hkl, intensity):
+        """
+        Bin points with coordinates hkl (N x 3) and the given intensities
+        """
+        # 16-bit frames would overflow in intensity ** 2
+        intensity = np.ravel(intensity).astype(np.float64, copy=False)
+        idx, inside = voxel_indices(hkl, self.qmin, self.qmax, self.bins)
+        intensity = intensity[inside]
+        self.out_of_bounds += inside.size - idx.size
+        n_voxels = self.sum.size
+        if 4 * idx.size >= n_voxels:
+            # as many points as voxels, full length bincounts are cheapest
+            self.sum += np.bincount(idx, weights=intensity,
+                                    minlength=n_voxels)
+            self.sum_sq += np.bincount(idx, weights=intensity * intensity,
+                                       minlength=n_voxels)
+            self.occupancy += np.bincount(idx, minlength=n_voxels)
+            return
+        # a chunk touches a small part of a large grid, only the touched
+        # voxels are summed and updated
+        voxels, inverse = np.unique(idx, return_inverse=True)
+        inverse = np.ravel(inverse)
+        self.sum[voxels] += np.bincount(inverse, weights=intensity)
+        self.sum_sq[voxels] += np.bincount(inverse,
+                                           weights=intensity * intensity)
+        self.occupancy[voxels] += np.bincount(inverse)
+
+    def merge(self, other):
+        """
+        Add the sums of another accumulator with the same grid
+        """
+        if (other.qmin, other.qmax, other.bins) != \
+                (self.qmin, self.qmax, self.bins):
+            raise ValueError('cannot merge accumulators of different grids')
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.occupancy += other.occupancy
+        self.out_of_bounds += other.out_of_bounds
+        return self
+
+    def result(self, min_occupancy=0):
+        """
+        Gridded data in the layout of pyspec's ImageProcessor.getGrid()
+
+        Parameters
+        ----------
+        min_occupancy : int, optional
+            Voxels hit fewer times than this are zeroed in I and E
+
+        Returns
+        -------
+        X, Y, Z : ndarray
+            Meshes of the H, K and L coordinates
+        I : ndarray
+            Mean intensity, masked on occupancy
+        E : ndarray
+            Standard error, sqrt(sum(I**2)) / N as in pyspec's ctrans
+        N : ndarray
+            Occupancy
+        raw : ndarray
+            Mean intensity without the occupancy mask
+        """
+        shape = tuple(self.bins)
+        occupancy = self.occupancy.reshape(shape)
+        hit = occupancy > 0
+        raw = np.zeros(shape)
+        raw[hit] = self.sum.reshape(shape)[hit] / occupancy[hit]
+        std_err = np.zeros(shape)
+        std_err[hit] = (np.sqrt(self.sum_sq.reshape(shape)[hit]) /
+                        occupancy[hit])
+        keep = occupancy >= min_occupancy
+        X, Y, Z = np.meshgrid(*grid_axes(self.qmin, self.qmax, self.bins),
+                              indexing='ij')
+        return X, Y, Z, raw * keep, std_err * keep, occupancy, raw
+
+
+def tree_reduce(accumulators):
+    """
+    Merge accumulators pairwise, level by level, into a single one
+    """
+    accumulators = list(accumulators)
+    if not accumulators:
+        raise ValueError('nothing to reduce')
+    while len(accumulators) > 1:
+        merged = [a.merge(b) for a, b in zip(accumulators[::2],
+                                              accumulators[1::2])]
+        if len(accumulators) % 2:
+            merged.append(accumulators[-1])
+        accumulators = merged
+    return accumulators[0]
+
+
+def bin_frames(acc, frames, angles, ub, wavelength, detector, keep=None,
+               frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK):
+    """
+    Convert frames to HKL and bin them into acc
+
+    The pixel direction table of the detector is computed once (see
+    geometry.cached_pixel_directions), so the HKL of all pixels of a chunk
+    of frames comes from a single batched matrix multiply.
+
+    Parameters
+    ----------
+    acc : GridAccumulator
+        Accumulator to add to
+    frames : ndarray or LazyImageStack
+        (n_frames, rows, cols) stack, or (n_frames, n_pixels) intensities
+        of the pixels selected by keep
+    angles : ndarray
+        (n_frames, 6) six-circle angles of each frame
+    ub : ndarray
+        Orientation matrix
+    wavelength : float
+        Wavelength in Angstrom
+    detector : geometry.Detector
+        Detector geometry
+    keep : ndarray, optional
+        2D mask of the pixels to bin
+    frames_per_chunk : int, optional
+        Frames converted and binned per pass
+    """
+    directions = cached_pixel_directions(detector, keep)
+    angles = np.atleast_2d(angles)
+    for start, block in iter_blocks(frames, frames_per_chunk):
+        A, b = zip(*[frame_transform(a, ub, wavelength)
+                     for a in angles[start:start + len(block)]])
+        hkl = np.matmul(np.array(A), directions) + \
+            np.array(b)[:, :, np.newaxis]
+        if block.ndim == 3:
+            block = block[:, keep] if keep is not None else \
+                block.reshape(len(block), -1)
+        acc.add(hkl.transpose(0, 2, 1).reshape(-1, 3), block)
+
+
+def hkl_extent(angles, ub, wavelength, detector, keep=None,
+               frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK):
+    """
+    Lowest and highest H, K and L reached by the pixels selected by keep
+    over all frames, from the same batched transform as bin_frames
+
+    Returns
+    -------
+    lo, hi : ndarray
+        Per axis minimum and maximum
+    """
+    directions = cached_pixel_directions(detector, keep)
+    angles = np.atleast_2d(angles)
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    for start in range(0, len(angles), frames_per_chunk):
+        A, b = zip(*[frame_transform(a, ub, wavelength)
+                     for a in angles[start:start + frames_per_chunk]])
+        hkl = np.matmul(np.array(A), directions) + \
+            np.array(b)[:, :, np.newaxis]
+        lo = np.minimum(lo, hkl.min(axis=(0, 2)))
+        hi = np.maximum(hi, hkl.max(axis=(0, 2)))
+    return lo, hi
+
+
+def auto_bins(qmin, qmax, max_voxels, voxel_size=None):
+    """
+    Bins along H, K and L of a grid over [qmin, qmax] with at most
+    max_voxels voxels
+
+    With a voxel_size the bins are the ones of that (isotropic) voxel,
+    made coarser only if they exceed max_voxels. Otherwise voxels are
+    cubes of the size that uses up max_voxels, axes without extent or
+    narrower than one voxel get a single bin and leave their share to the
+    others.
+    """
+    extent = np.asarray(qmax, dtype=np.float64) - np.asarray(qmin)
+    max_voxels = max(int(max_voxels), 1)
+    if voxel_size:
+        bins = np.maximum(np.ceil(extent / voxel_size), 1).astype(int)
+        if np.prod(bins) <= max_voxels:
+            return [int(b) for b in bins]
+    bins = np.ones(3, dtype=int)
+    free = extent > 0
+    while free.any():
+        side = (np.prod(extent[free]) / max_voxels) ** (1. / free.sum())
+        fit = extent / side
+        narrow = free & (fit < 1)
+        if not narrow.any():
+            # rounding can leave a voxel that exactly fits just below one
+            bins[free] = np.maximum(np.floor(fit[free]), 1)
+            break
+        free &= ~narrow
+    return [int(b) for b in bins]
+
+
+def auto_grid(angles, ub, wavelength, detector, keep=None,
+              memory_bytes=DEFAULT_AUTO_GRID_MB * 2 ** 20, bytes_per_voxel=80,
+              voxel_size=None, min_occupancy=1):
+    """
+    Bounds and bins of a grid fitted to the data of a scan
+
+    The bounds are the HKL extent of the kept pixels (see hkl_extent).
+    The number of voxels is capped by the memory budget of the dense
+    volume and by the number of measured points divided by
+    min_occupancy, finer grids would be mostly empty.
+
+    Returns
+    -------
+    qmin, qmax, bins : list
+
+    Raises
+    ------
+    ValueError
+        When there are no frames or keep selects no pixel
+    """
+    n_points = len(np.atleast_2d(angles)) * \
+        cached_pixel_directions(detector, keep).shape[1]
+    if n_points == 0:
+        raise ValueError('No measured point to fit the grid to')
+    lo, hi = hkl_extent(angles, ub, wavelength, detector, keep)
+    # points on the upper edge must fall inside the last voxel
+    pad = np.maximum((hi - lo) * 1e-6, 1e-9)
+    lo, hi = lo - pad, hi + pad
+    max_voxels = min(memory_bytes // bytes_per_voxel,
+                     n_points // max(min_occupancy, 1))
+    bins = auto_bins(lo, hi, max_voxels, voxel_size)
+    return [float(q) for q in lo], [float(q) for q in hi], bins
+
+
+def _init_worker(shared, shape, dtype):
+    global _worker_pixels
+    _worker_pixels = np.frombuffer(shared, dtype=dtype).reshape(shape)
+
+
+def _grid_frames(task):
+    (start, stop, angles, ub, wavelength, detector, keep, qmin, qmax, bins,
+     frames_per_chunk, accumulator) = task
+    acc = accumulator(qmin, qmax, bins)
+    bin_frames(acc, _worker_pixels[start:stop], angles, ub, wavelength,
+               detector, keep, frames_per_chunk)
+    return acc
+
+
+def grid_parallel(frames, angles, ub, wavelength, detector, qmin, qmax, bins,
+                  n_workers=1, frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK,
+                  keep=None, accumulator=GridAccumulator):
+    """
+    Grid a stack of frames, optionally with a process pool
+
+    With more than one worker the frames are split into n_workers
+    contiguous blocks. The pixels selected by keep are copied once into
+    shared memory, in the dtype of the frames, which the workers read
+    directly, so only the partial accumulators travel between processes.
+    The partials are merged with tree_reduce.
+
+    Parameters are those of bin_frames, plus the grid definition of
+    GridAccumulator, the number of worker processes and the accumulator
+    class (GridAccumulator or sparse.SparseGridAccumulator).
+
+    Returns
+    -------
+    accumulator
+    """
+    n_frames = len(frames)
+    n_workers = max(min(int(n_workers), n_frames), 1)
+    if n_workers == 1:
+        acc = accumulator(qmin, qmax, bins)
+        bin_frames(acc, frames, angles, ub, wavelength, detector, keep,
+                   frames_per_chunk)
+        return acc
+
+    n_pixels = int(np.count_nonzero(keep)) if keep is not None else \
+        int(np.prod(frames.shape[1:]))
+    shape = (n_frames, n_pixels)
+    dtype = np.dtype(frames.dtype)
+    shared = RawArray(ctypes.c_char, n_frames * n_pixels * dtype.itemsize)
+    pixels = np.frombuffer(shared, dtype=dtype).reshape(shape)
+    for start, block in iter_blocks(frames, frames_per_chunk):
+        pixels[start:start + len(block)] = \
+            block[:, keep] if keep is not None else \
+            block.reshape(len(block), -1)
+    angles = np.atleast_2d(angles)
+    bounds = np.linspace(0, n_frames, n_workers + 1).astype(int)
+    tasks = [(int(lo), int(hi), angles[lo:hi], ub, wavelength, detector,
+              keep, qmin, qmax, bins, frames_per_chunk, accumulator)
+             for lo, hi in zip(bounds[:-1], bounds[1:])]
+    pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                initargs=(shared, shape, dtype.str))
+    try:
+        partials = pool.map(_grid_frames, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return tree_reduce(partials)
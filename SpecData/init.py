@@ -33,10 +33,37 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from vistrails.core.modules.vistrails_module import Module, ModuleError
-from vistrails.core.modules.config import IPort, OPort
+from vistrails.core.modules.config import IPort, OPort, ModuleSettings
 from pyspec.ccd.transformations import FileProcessor, ImageProcessor
 from pyspec.spec import SpecDataFile
 import numpy as np
+import os
+from .stack import LazyImageStack
+from .scan_index import IndexedSpecDataFile
+from .cache import scan_cache, scan_key, nbytes_of, spec_file_nbytes
+from .gridding import (grid_parallel, GridAccumulator, auto_grid,
+                       DEFAULT_FRAMES_PER_CHUNK, DEFAULT_AUTO_GRID_MB)
+from .sparse import SparseGrid, SparseGridAccumulator
+from .grid_store import grid_store, grid_key
+from .slicing import GridSlicer
+from .pyramid import GridPyramid
+from .geometry import Detector, DetectorMask
+from .streaming import get_stream
+from .reduce import reduce_stack, stack_percentiles, roi_sums
+from .batch import ScanSeries, DEFAULT_WORKERS
+from .prefetch import (prefetcher, decode_stack, spec_file_lock,
+                       DEFAULT_PREFETCH_SCANS)
+from .metrics import instrument
+from .arrays import NDArray, readonly_view
+from .precision import get_precision, DOUBLE
+from .slabs import grid_out_of_core
+
+# default number of detector pixels cropped from the
+# [top, left, bottom, right] edges
+CCD_CROP = [5, 5, 0, 0]
+
+# voxels with less than this number of hits are masked in the grids
+OCCUPANCY_MASK = 10
 
 
 class SpecFile(Module):
@@ -46,9 +73,10 @@ class SpecFile(Module):
         ]
 
     _output_ports = [
-        OPort(name="spec_img_stack", signature="basic:List"),
+        OPort(name="spec_img_stack", signature="gov.nsls2.spec.SpecData:NDArray"),
         OPort(name="spec_metadata", signature="basic:Dictionary"),
-        OPort(name="spec_file", signature="gov.nsls2.spec.SpecData:SpecFile")
+        OPort(name="spec_file", signature="gov.nsls2.spec.SpecData:SpecFile"),
+        OPort(name="cache_stats", signature="basic:Dictionary"),
         ]
 
 
@@ -64,25 +92,160 @@ class SpecFile(Module):
 
         print spec_file_root
         print data_folder_path
-        sf = SpecDataFile(spec_file_root, ccdpath=data_folder_path)
-        scan = sf[scan_no]
-
-        fp = FileProcessor(spec=scan)
-
-        fp.process()
-        arr_2d_stack = fp.getImage()
+        if spec_params.cache_mb is not None:
+            scan_cache.set_max_bytes(spec_params.cache_mb * 2 ** 20)
+        self.cache_key = scan_key(spec_file_root, data_folder_path, scan_no,
+                                  spec_params.lazy_stack,
+                                  spec_params.precision)
+        cached = scan_cache.get(self.cache_key)
+        if cached is None:
+            cached = prefetcher.take(self.cache_key)
+            if cached is None:
+                try:
+                    cached = self.load_scan(spec_params)
+                except ValueError as e:
+                    raise ModuleError(self, str(e))
+            if spec_params.use_cache:
+                scan_cache.put(self.cache_key, cached,
+                               nbytes=nbytes_of(cached[2:]))
+        sf, scan, fp, arr_2d_stack = cached
+        self.prefetch(spec_params)
 
         self.set_output("spec_img_stack", arr_2d_stack)
         self.set_output("spec_file", self)
+        self.set_output("cache_stats", scan_cache.stats())
+        self.params = spec_params
+        self.img_stack = arr_2d_stack
         self.fp = fp
         self.sf = sf
         self.scan = scan
 
+    def load_scan(self, spec_params, scan_no=None):
+        """
+            Open the spec file and read one scan, reusing an already opened
+            SpecDataFile from the scan cache when there is one
+
+            scan_no defaults to the scan of spec_params. This also runs on
+            the prefetch thread and must not touch the module's state.
+        """
+        if scan_no is None:
+            scan_no = spec_params.scan_number
+        spec_file_root = spec_params.spec_file_root
+        data_folder_path = spec_params.data_folder_path
+        file_key = scan_key(spec_file_root, data_folder_path, None)
+        sf = scan_cache.get(file_key)
+        if sf is None:
+            if spec_params.use_scan_index:
+                sf = IndexedSpecDataFile(spec_file_root,
+                                         ccdpath=data_folder_path)
+            else:
+                sf = SpecDataFile(spec_file_root, ccdpath=data_folder_path)
+            if spec_params.use_cache:
+                # the processors and stacks of the scans are accounted in
+                # their own entries, the parsed scans in this one
+                scan_cache.put(file_key, sf, nbytes=spec_file_nbytes(sf))
+        with spec_file_lock(sf):
+            scan = sf[scan_no]
+            fp = FileProcessor(spec=scan)
+            if spec_params.use_cache:
+                # the file keeps every scan it parsed
+                scan_cache.update_nbytes(file_key, spec_file_nbytes(sf))
+
+        precision = get_precision(spec_params.precision)
+        if spec_params.lazy_stack:
+            # frames are decoded when a downstream module indexes them
+            arr_2d_stack = LazyImageStack.from_loader(
+                precision.frame_loader(fp))
+        elif spec_params.decode_workers > 1 or precision is not DOUBLE:
+            # the stack FileProcessor.process() builds, decoded in parallel
+            # and in the dtypes of the precision policy
+            arr_2d_stack = decode_stack(precision.frame_loader(fp),
+                                        n_workers=spec_params.decode_workers)
+            fp.images = arr_2d_stack
+        else:
+            fp.process()
+            arr_2d_stack = fp.getImage()
+        return sf, scan, fp, arr_2d_stack
+
+    def prefetch(self, spec_params):
+        """
+            Start loading the scans likely to be opened next in the
+            background: the ones in prefetch_scans, or the next scan number
+        """
+        if spec_params.prefetch_scans is not None:
+            scan_numbers = spec_params.prefetch_scans
+        elif spec_params.prefetch:
+            scan_numbers = [spec_params.scan_number + 1]
+        else:
+            scan_numbers = []
+        group = (os.path.abspath(spec_params.spec_file_root),
+                 spec_params.data_folder_path)
+        keys = [scan_key(spec_params.spec_file_root,
+                         spec_params.data_folder_path, scan_no,
+                         spec_params.lazy_stack, spec_params.precision)
+                for scan_no in scan_numbers]
+        # scans of this file that are no longer wanted stop loading
+        prefetcher.retain(group, keys)
+        if not keys:
+            return
+        prefetcher.set_max_scans(spec_params.prefetch_buffer)
+        for scan_no, key in zip(scan_numbers, keys):
+            if key not in scan_cache:
+                prefetcher.prefetch(key, self.load_scan,
+                                    (spec_params, scan_no), group=group)
+
+    def get_processor(self):
+        """
+            FileProcessor with all images loaded. Lazy stacks are only read
+            into memory here, when a module needs the full stack.
+        """
+        if getattr(self.fp, 'images', None) is None:
+            if self.params.precision != DOUBLE.name:
+                # FileProcessor.process() would decode in float64
+                self.fp.images = np.asarray(self.img_stack)
+            else:
+                self.fp.process()
+            scan_cache.update_nbytes(self.cache_key,
+                                     nbytes_of(self.fp, self.fp.images))
+        return self.fp
+
+    def release(self):
+        """
+            Drop the scan, its processor and its image stack. The scan cache
+            keeps its own reference for as long as the entry fits in its
+            budget.
+        """
+        self.fp = self.sf = self.scan = self.img_stack = None
+
+    def clear(self):
+        # VisTrails is discarding this module, consumers are done with it
+        self.release()
+        Module.clear(self)
+
 class SpecFileParams(Module):
     _input_ports = [
         IPort(name="spec_file_root", label="Spec File Root", signature="basic:String"),
         IPort(name="data_folder_path", label="Data Folder Path", signature="basic:String"),
         IPort(name="scan_number", label="Scan number", signature="basic:Integer"),
+        IPort(name="lazy_stack", label="Load frames on demand",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="use_scan_index", label="Use persistent scan index",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="use_cache", label="Keep scans in the scan cache",
+              signature="basic:Boolean", default=True, optional=True),
+        IPort(name="cache_mb", label="Scan cache budget in MB",
+              signature="basic:Integer", optional=True),
+        IPort(name="decode_workers", label="Threads decoding the frames",
+              signature="basic:Integer", default=1, optional=True),
+        IPort(name="prefetch", label="Load the next scan in the background",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="prefetch_scans", label="Scans to load in the background",
+              signature="basic:List", optional=True),
+        IPort(name="prefetch_buffer", label="Scans kept by the prefetcher",
+              signature="basic:Integer", default=DEFAULT_PREFETCH_SCANS,
+              optional=True),
+        IPort(name="precision", label="Precision (double or single)",
+              signature="basic:String", default=DOUBLE.name, optional=True),
         ]
     _output_ports = [
         OPort(name="spec_file_params", signature="gov.nsls2.spec.SpecData:SpecFileParams"),
@@ -91,6 +254,20 @@ class SpecFileParams(Module):
         self.spec_file_root = self.get_input("spec_file_root")
         self.data_folder_path = self.get_input("data_folder_path")
         self.scan_number = self.get_input("scan_number")
+        self.lazy_stack = self.force_get_input("lazy_stack", False)
+        self.use_scan_index = self.force_get_input("use_scan_index", False)
+        self.use_cache = self.force_get_input("use_cache", True)
+        self.cache_mb = self.force_get_input("cache_mb", None)
+        self.decode_workers = self.force_get_input("decode_workers", 1)
+        self.prefetch = self.force_get_input("prefetch", False)
+        self.prefetch_scans = self.force_get_input("prefetch_scans", None)
+        self.prefetch_buffer = self.force_get_input("prefetch_buffer",
+                                                    DEFAULT_PREFETCH_SCANS)
+        self.precision = self.force_get_input("precision", DOUBLE.name)
+        try:
+            get_precision(self.precision)
+        except ValueError as e:
+            raise ModuleError(self, str(e))
         self.set_output("spec_file_params", self)
 
 class Gridder(Module):
@@ -99,53 +276,179 @@ class Gridder(Module):
               signature="gov.nsls2.spec.SpecData:GridderParams"),
         ]
     _output_ports = [
-        OPort(name="x_mesh", signature="basic:List"),
-        OPort(name="y_mesh", signature="basic:List"),
-        OPort(name="z_mesh", signature="basic:List"),
-        OPort(name="masked_data", signature="basic:List"),
-        OPort(name="raw_data", signature="basic:List"),
-        OPort(name="occupancy", signature="basic:List"),
-        OPort(name="std_dev", signature="basic:List"),
+        OPort(name="x_mesh", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="y_mesh", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="z_mesh", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="masked_data", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="raw_data", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="occupancy", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="std_dev", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="sparse_grid", signature="basic:List"),
+        OPort(name="pyramid_levels", signature="basic:Integer"),
         OPort(name="gridder", signature="gov.nsls2.spec.SpecData:Gridder"),
         ]
     def compute(self):
         self.gridder_params = self.get_input("gridder_params")
         spec_file = self.gridder_params.spec_file
-        ip = ImageProcessor(spec_file.fp)
         self.planes = ['HK', '']
-        hkl_dims = self.gridder_params.hkl_dims
+        # the extent of the grid, which the plots label their axes with
+        self.hkl_dims = hkl_dims = list(self.gridder_params.hkl_dims)
 
-        ccd_crop = [5, 5, 0, 0]
-        ccd_size = spec_file.fp.images[0].shape
-        det_size_x = ccd_size[0]
-        det_size_y = ccd_size[1]
-        det_pix_size_x = 0.0135 * 2048 / det_size_x
-        det_pix_size_y = 0.0135 * 2048 / det_size_y
-        det_x0 = det_size_x / 2.0
-        det_y0 = det_size_y / 2.0
+        ccd_size = spec_file.img_stack.shape[1:]
+        detector = self.gridder_params.get_detector(ccd_size)
+        try:
+            detector_mask = self.gridder_params.get_detector_mask(ccd_size)
+        except ValueError as e:
+            raise ModuleError(self, str(e))
 
-        ip.setSpecScan(spec_file.scan)
-        ip.setDetectorPos(355.0, 0)
-
-        # sample orientation matrix is stored in spec file so this flag is enough
-        ip.setFrameMode('hkl')
-
-        ip.setDetectorProp(det_pix_size_x, det_pix_size_y, det_size_x, det_size_y, det_x0, det_y0)
-        if ccd_crop != [0, 0, 0, 0]:
-            ip.setDetectorMask(self.makeMask(spec_file.fp, ccd_crop, ccd_size))
-
-        ip.setGridSize([hkl_dims[0], hkl_dims[2], hkl_dims[4]], \
-                       [hkl_dims[1], hkl_dims[3], hkl_dims[5]],
-                       self.gridder_params.bins_arr)
-        ip.process()
+        qmin = [hkl_dims[0], hkl_dims[2], hkl_dims[4]]
+        qmax = [hkl_dims[1], hkl_dims[3], hkl_dims[5]]
+        bins = self.gridder_params.bins_arr
 
         # masks any voxels with less than this number of hits
-        ip.setGridMaskOnOccu(10)
-
-        self.ip = ip
+        occu_mask = OCCUPANCY_MASK
+
+        if self.gridder_params.out_of_core:
+            # these would read the whole volume into memory
+            for option in ('sparse', 'persist_grid', 'pyramid'):
+                if getattr(self.gridder_params, option):
+                    raise ModuleError(self, "{0} is not supported with "
+                                            "out-of-core gridding"
+                                            "".format(option))
+
+        grid = None
+        if self.gridder_params.persist_grid:
+            key = self.grid_key(spec_file, detector, detector_mask,
+                                occu_mask)
+            grid = grid_store.get(key)
+        if grid is None:
+            grid = self.make_grid(spec_file, detector, detector_mask,
+                                  qmin, qmax, bins, occu_mask)
+            # gridding sums in float64, the outputs are stored in the
+            # dtypes of the pipeline's precision
+            grid = get_precision(spec_file.params.precision).grid(grid)
+            if self.gridder_params.persist_grid:
+                params = spec_file.params
+                grid_store.put(key, grid,
+                               spec_file=params.spec_file_root,
+                               scan_number=params.scan_number,
+                               bins=list(bins))
+        self.set_grid_outputs(grid, occu_mask)
+
+    def make_grid(self, spec_file, detector, detector_mask, qmin, qmax, bins,
+                  occu_mask):
+        """
+            Grid the scan with the selected backend
 
-        X, Y, Z, I, E, N = ip.getGrid()
-        raw = ip.gridData
+            Returns a SparseGrid in sparse mode and the dense
+            (X, Y, Z, I, E, N, raw) arrays otherwise
+        """
+        backend = self.gridder_params.backend
+        if backend == 'pyspec' and self.gridder_params.sparse:
+            raise ModuleError(self, "Sparse output needs the numpy backend")
+        if backend == 'pyspec' and self.gridder_params.out_of_core:
+            raise ModuleError(self, "Out-of-core gridding needs the numpy "
+                                    "backend")
+        if backend == 'pyspec':
+            ip = self.make_image_processor(spec_file, detector,
+                                           detector_mask)
+            ip.setGridSize(qmin, qmax, bins)
+            ip.process()
+            ip.setGridMaskOnOccu(occu_mask)
+            # only the gridded arrays are kept, the processor and its
+            # per-pixel HKL set go as soon as this returns
+            return tuple(ip.getGrid()) + (ip.gridData,)
+        elif backend == 'numpy' and self.gridder_params.out_of_core:
+            # frames streamed in chunks into memory-mapped slabs, in one
+            # process so that the budget holds
+            scan = spec_file.scan
+            memory_mb = self.gridder_params.memory_mb
+            self.scratch = grid_out_of_core(
+                spec_file.img_stack, scan.getSIXCAngles(), scan.UB,
+                scan.wavelength, detector, qmin, qmax, bins,
+                keep=detector_mask.keep,
+                memory_bytes=(memory_mb * 2 ** 20 if memory_mb is not None
+                              else None),
+                directory=self.gridder_params.scratch_dir)
+            return self.scratch.result(
+                min_occupancy=occu_mask,
+                precision=get_precision(spec_file.params.precision))
+        elif backend == 'numpy':
+            # only the unmasked pixels are converted to HKL and binned,
+            # with the pixel direction table shared by all frames
+            scan = spec_file.scan
+            sparse = self.gridder_params.sparse
+            acc = grid_parallel(spec_file.img_stack, scan.getSIXCAngles(),
+                                scan.UB, scan.wavelength, detector,
+                                qmin, qmax, bins,
+                                n_workers=self.gridder_params.n_workers,
+                                frames_per_chunk=self.gridder_params.frames_per_chunk,
+                                keep=detector_mask.keep,
+                                accumulator=(SparseGridAccumulator if sparse
+                                             else GridAccumulator))
+            if sparse:
+                # only the occupied voxels and the axis vectors are kept
+                return acc.sparse_result(min_occupancy=occu_mask)
+            return acc.result(min_occupancy=occu_mask)
+        else:
+            raise ModuleError(self, "Unknown gridding backend '{0}'"
+                                    "".format(backend))
+
+    def grid_key(self, spec_file, detector, detector_mask, occu_mask):
+        """
+            Content key of the grid in the grid store: the identity of the
+            scan and every parameter that changes the gridded volume
+        """
+        params = spec_file.params
+        spec_path = os.path.abspath(params.spec_file_root)
+        return grid_key(spec_file=spec_path,
+                        spec_mtime=os.path.getmtime(spec_path),
+                        ccd_path=params.data_folder_path,
+                        scan_number=params.scan_number,
+                        hkl_dims=list(self.gridder_params.hkl_dims),
+                        bins=list(self.gridder_params.bins_arr),
+                        backend=self.gridder_params.backend,
+                        sparse=self.gridder_params.sparse,
+                        detector=list(detector.key()),
+                        mask=detector_mask.keep,
+                        occupancy_mask=occu_mask,
+                        precision=params.precision)
+
+    def get_slicer(self, level=0):
+        """
+            GridSlicer of the current grid, kept so that its projections are
+            shared by every plot of this grid. Levels above 0 are the
+            down-sampled copies of the pyramid.
+        """
+        if level:
+            return self.pyramid[level]
+        if self.slicer is None:
+            self.slicer = GridSlicer.from_grid(self.sparse_grid
+                                               if self.grid is None
+                                               else self.grid)
+        return self.slicer
+
+    def set_grid_outputs(self, grid, occu_mask):
+        """
+            Set the outputs from a SparseGrid or the dense grid arrays
+        """
+        self.slicer = None
+        self.pyramid = None
+        if self.gridder_params.pyramid:
+            # level 0 shares the slicer plots of the full grid use
+            self.pyramid = GridPyramid.from_grid(grid, occu_mask)
+            self.slicer = self.pyramid[0]
+            self.set_output("pyramid_levels", len(self.pyramid))
+        if isinstance(grid, SparseGrid):
+            self.grid = None
+            self.sparse_grid = grid
+            self.set_output("sparse_grid", grid)
+            self.set_output("gridder", self)
+            return
+
+        X, Y, Z, I, E, N, raw = grid
+        self.grid = (X, Y, Z, I, E, N)
+        self.sparse_grid = None
 
         self.set_output("x_mesh", X)
         self.set_output("y_mesh", Y)
@@ -156,21 +459,136 @@ class Gridder(Module):
         self.set_output("std_dev", E)
         self.set_output("gridder", self)
 
+    def make_image_processor(self, spec_file, detector, detector_mask):
+        """
+            pyspec ImageProcessor set up for this scan and detector
+        """
+        fp = spec_file.get_processor()
+        ip = ImageProcessor(fp)
+        ip.setSpecScan(spec_file.scan)
+        ip.setDetectorPos(detector.dist, 0)
+
+        # sample orientation matrix is stored in spec file so this flag is enough
+        ip.setFrameMode('hkl')
 
+        ip.setDetectorProp(detector.pix_size_x, detector.pix_size_y,
+                           detector.size_x, detector.size_y,
+                           detector.cen_x, detector.cen_y)
+        if not detector_mask.keeps_all():
+            ip.setDetectorMask(detector_mask.masked_stack(len(fp.images)))
+        return ip
 
-    def makeMask(self, fp, ccdcrop, ccdsize):
+    def release(self):
         """
-            image. Sets pixel range specified from the boundries to 0
+            Drop the grid, its slicers and the parameters, which hold on to
+            the SpecFile
         """
-        mask = np.ones(fp.images.shape, dtype=np.bool)
-        mask[:, ccdcrop[0]:ccdsize[0] - ccdcrop[2], ccdcrop[1]:ccdsize[1] - ccdcrop[3]] = 0
-        unMaskedSize = mask[:, ccdcrop[0]:ccdsize[0] - ccdcrop[2], ccdcrop[1]:ccdsize[1] - ccdcrop[3]].shape
-        return mask
+        self.grid = self.sparse_grid = None
+        self.slicer = self.pyramid = None
+        self.gridder_params = None
+        if getattr(self, 'scratch', None) is not None:
+            self.scratch.close()
+            self.scratch = None
+
+    def clear(self):
+        self.release()
+        Module.clear(self)
+
+
+
+class StreamingGridder(Gridder):
+    """
+        Gridder for scans that are still running. The grid is kept between
+        executions and each execution only bins the frames that were
+        written since the previous one. Set h_min ... l_max on the
+        GridderParams to cover the whole scan, as the range of the frames
+        written so far is too small for the rest of it. out_of_bounds
+        counts the pixels that fell outside the grid.
+    """
+    _input_ports = [
+        IPort(name="reset", label="Start gridding from scratch",
+              signature="basic:Boolean", default=False, optional=True),
+        ]
+    _output_ports = [
+        OPort(name="n_frames", signature="basic:Integer"),
+        OPort(name="out_of_bounds", signature="basic:Integer"),
+        ]
+
+    def is_cacheable(self):
+        # the scan grows between executions even if the inputs do not
+        return False
+
+    def compute(self):
+        self.gridder_params = self.get_input("gridder_params")
+        spec_file = self.gridder_params.spec_file
+        spec_params = spec_file.params
+        self.planes = ['HK', '']
+        self.hkl_dims = hkl_dims = list(self.gridder_params.hkl_dims)
+
+        ccd_size = spec_file.img_stack.shape[1:]
+        try:
+            detector_mask = self.gridder_params.get_detector_mask(ccd_size)
+        except ValueError as e:
+            raise ModuleError(self, str(e))
+
+        stream = get_stream(spec_params.spec_file_root,
+                            spec_params.data_folder_path,
+                            spec_params.scan_number,
+                            [hkl_dims[0], hkl_dims[2], hkl_dims[4]],
+                            [hkl_dims[1], hkl_dims[3], hkl_dims[5]],
+                            self.gridder_params.bins_arr,
+                            self.gridder_params.get_detector(ccd_size),
+                            detector_mask.keep,
+                            reset=self.force_get_input("reset", False))
+        stream.update()
+        precision = get_precision(spec_params.precision)
+        self.set_grid_outputs(
+            precision.grid(stream.accumulator.result(
+                min_occupancy=OCCUPANCY_MASK)), OCCUPANCY_MASK)
+        self.set_output("n_frames", stream.n_frames)
+        self.set_output("out_of_bounds", stream.accumulator.out_of_bounds)
+
+class GridStoreManager(Module):
+    """
+        Lists the gridded volumes Gridder stored on disk and purges them
+    """
+    _input_ports = [
+        IPort(name="purge_key", label="Key of the entry to remove",
+              signature="basic:String", optional=True),
+        IPort(name="purge_all", label="Remove all entries",
+              signature="basic:Boolean", default=False, optional=True),
+        ]
+    _output_ports = [
+        OPort(name="entries", signature="basic:List"),
+        OPort(name="total_bytes", signature="basic:Integer"),
+        OPort(name="n_purged", signature="basic:Integer"),
+        ]
+
+    def is_cacheable(self):
+        return False
+
+    def compute(self):
+        n_purged = 0
+        if self.force_get_input("purge_all", False):
+            n_purged = grid_store.purge()
+        elif self.has_input("purge_key"):
+            try:
+                n_purged = grid_store.purge(self.get_input("purge_key"))
+            except ValueError as e:
+                raise ModuleError(self, str(e))
+        entries = grid_store.entries()
+        self.set_output("entries", entries)
+        self.set_output("total_bytes", sum(e['nbytes'] for e in entries))
+        self.set_output("n_purged", n_purged)
 
 class GridderParams(Module):
     """ 
         GridderParams is just a package for the parameters required for gridding a
         non-regular set of points
+
+        hkl_dims is the extent every gridder bins into: the padded scan
+        range, or the fitted grid with auto_grid, with h_min ... l_max
+        taking precedence where they are set.
     """
     _input_ports = [
         IPort(name="spec_file", label="Spec File", signature="gov.nsls2.spec.SpecData:SpecFile"),
@@ -180,9 +598,41 @@ class GridderParams(Module):
         IPort(name="k_max", label="Maximum value for K", signature="basic:Float", optional=True),
         IPort(name="l_min", label="Minimum value for L", signature="basic:Float", optional=True),
         IPort(name="l_max", label="Maximum value for L", signature="basic:Float", optional=True),
-        IPort(name="bins_x", label="Number of bins in x", signature="basic:Integer"),
-        IPort(name="bins_y", label="Number of bins in y", signature="basic:Integer"),
-        IPort(name="bins_z", label="Number of bins in z", signature="basic:Integer"),
+        IPort(name="bins_x", label="Number of bins in x", signature="basic:Integer", optional=True),
+        IPort(name="bins_y", label="Number of bins in y", signature="basic:Integer", optional=True),
+        IPort(name="bins_z", label="Number of bins in z", signature="basic:Integer", optional=True),
+        IPort(name="backend", label="Gridding backend (pyspec or numpy)",
+              signature="basic:String", default="pyspec", optional=True),
+        IPort(name="frames_per_chunk", label="Frames binned per pass",
+              signature="basic:Integer", default=DEFAULT_FRAMES_PER_CHUNK,
+              optional=True),
+        IPort(name="n_workers", label="Gridding processes (numpy backend)",
+              signature="basic:Integer", default=1, optional=True),
+        IPort(name="ccd_crop", label="Pixels cropped at [top, left, bottom, right]",
+              signature="basic:List", optional=True),
+        IPort(name="roi", label="Detector ROI [x_min, x_max, y_min, y_max]",
+              signature="basic:List", optional=True),
+        IPort(name="bad_pixels", label="2D mask of excluded pixels",
+              signature="gov.nsls2.spec.SpecData:NDArray", optional=True),
+        IPort(name="sparse", label="Keep only occupied voxels (numpy backend)",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="persist_grid", label="Reuse grids stored on disk",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="pyramid", label="Build down-sampled levels for plotting",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="out_of_core", label="Grid into memory-mapped slabs (numpy backend)",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="memory_mb", label="Out-of-core working memory in MB",
+              signature="basic:Integer", optional=True),
+        IPort(name="scratch_dir", label="Directory of the memory-mapped grids",
+              signature="basic:String", optional=True),
+        IPort(name="auto_grid", label="Fit bounds and bins to the scan",
+              signature="basic:Boolean", default=False, optional=True),
+        IPort(name="grid_memory_mb", label="Size of an automatic grid in MB",
+              signature="basic:Integer", default=DEFAULT_AUTO_GRID_MB,
+              optional=True),
+        IPort(name="voxel_size", label="Voxel size of an automatic grid",
+              signature="basic:Float", optional=True),
         ]
     _output_ports = [
         OPort(name="gridder_params", signature="gov.nsls2.spec.SpecData:GridderParams"),
@@ -210,6 +660,38 @@ class GridderParams(Module):
         #=======================================================================
         return hkl_dims
 
+    def get_detector(self, ccd_size):
+        """
+            Detector geometry of frames of ccd_size
+        """
+        return Detector.from_ccd_size(ccd_size, dist=355.0)
+
+    def fit_grid(self):
+        """
+            hkl_dims and bins_arr fitted to the unmasked pixels of the
+            whole scan: the grid fits in grid_memory_mb, has voxels of
+            voxel_size if they fit, and is no finer than the data fills
+            to the occupancy mask on average
+        """
+        scan = self.spec_file.scan
+        ccd_size = self.spec_file.img_stack.shape[1:]
+        precision = get_precision(self.spec_file.params.precision)
+        qmin, qmax, bins = auto_grid(
+            scan.getSIXCAngles(), scan.UB, scan.wavelength,
+            self.get_detector(ccd_size),
+            keep=self.get_detector_mask(ccd_size).keep,
+            memory_bytes=self.grid_memory_mb * 2 ** 20,
+            bytes_per_voxel=precision.voxel_nbytes(),
+            voxel_size=self.voxel_size, min_occupancy=OCCUPANCY_MASK)
+        return [qmin[0], qmax[0], qmin[1], qmax[1], qmin[2], qmax[2]], bins
+
+    def get_detector_mask(self, ccd_size):
+        """
+            2D mask of the detector pixels to grid, shared by all frames
+        """
+        return DetectorMask(ccd_size, crop=self.ccd_crop, roi=self.roi,
+                            bad_pixels=self.bad_pixels)
+
     def compute(self):
         self.spec_file = self.get_input("spec_file")
         if self.spec_file is not None:
@@ -228,86 +710,151 @@ class GridderParams(Module):
             self.l_min = self.get_input("l_min")
         if self.has_input("l_max"):
             self.l_max = self.get_input("l_max")
-
-        self.bins_x = self.get_input("bins_x")
-        self.bins_y = self.get_input("bins_y")
-        self.bins_z = self.get_input("bins_z")
+        # bounds given on the ports, None where the scan range is used
+        self.hkl_bounds = [self.force_get_input(name, None) for name in
+                           ("h_min", "h_max", "k_min", "k_max", "l_min",
+                            "l_max")]
+
+        self.backend = self.force_get_input("backend", "pyspec")
+        self.frames_per_chunk = self.force_get_input(
+            "frames_per_chunk", DEFAULT_FRAMES_PER_CHUNK)
+        self.n_workers = self.force_get_input("n_workers", 1)
+        self.ccd_crop = self.force_get_input("ccd_crop", CCD_CROP)
+        self.roi = self.force_get_input("roi", None)
+        self.bad_pixels = self.force_get_input("bad_pixels", None)
+        self.sparse = self.force_get_input("sparse", False)
+        self.persist_grid = self.force_get_input("persist_grid", False)
+        self.pyramid = self.force_get_input("pyramid", False)
+        self.out_of_core = self.force_get_input("out_of_core", False)
+        self.memory_mb = self.force_get_input("memory_mb", None)
+        self.scratch_dir = self.force_get_input("scratch_dir", None)
+        self.auto_grid = self.force_get_input("auto_grid", False)
+        self.grid_memory_mb = self.force_get_input("grid_memory_mb",
+                                                   DEFAULT_AUTO_GRID_MB)
+        self.voxel_size = self.force_get_input("voxel_size", None)
 
         if self.hkl_dims is None:
             self.hkl_dims = [self.h_min, self.h_max,
                          self.k_min, self.k_max,
                          self.l_min, self.l_max]
 
-        self.bins_arr = [self.bins_x, self.bins_y, self.bins_z]
+        if self.auto_grid:
+            # replaces the padded scan range and the bins ports
+            try:
+                self.hkl_dims, self.bins_arr = self.fit_grid()
+            except ValueError as e:
+                raise ModuleError(self, str(e))
+            self.bins_x, self.bins_y, self.bins_z = self.bins_arr
+        else:
+            self.bins_x = self.get_input("bins_x")
+            self.bins_y = self.get_input("bins_y")
+            self.bins_z = self.get_input("bins_z")
+            self.bins_arr = [self.bins_x, self.bins_y, self.bins_z]
+        # bounds given on the ports take precedence over the scan range and
+        # the fitted grid, the gridders, the grid store and the plots all
+        # read the merged extent
+        self.hkl_dims = [dim if bound is None else bound for dim, bound in
+                         zip(self.hkl_dims, self.hkl_bounds)]
         self.set_output("gridder_params", self)
 
+    def clear(self):
+        self.spec_file = self.bad_pixels = None
+        Module.clear(self)
+
 class PlotGridded(Module):
     _input_ports = [
         IPort(name="gridder", label="Gridder instance",
               signature="gov.nsls2.spec.SpecData:Gridder"),
+        IPort(name="plane", label="Plane to plot (HK, HL or KL)",
+              signature="basic:String", optional=True),
+        IPort(name="h_range", label="[min, max] of H",
+              signature="basic:List", optional=True),
+        IPort(name="k_range", label="[min, max] of K",
+              signature="basic:List", optional=True),
+        IPort(name="l_range", label="[min, max] of L",
+              signature="basic:List", optional=True),
+        IPort(name="display_size", label="[width, height] of the plot in pixels",
+              signature="basic:List", optional=True),
         ]
 
     _output_ports = [
         OPort(name="x", signature="basic:List"),
         OPort(name="y", signature="basic:List"),
         OPort(name="z", signature="basic:List"),
+        OPort(name="dz", signature="basic:List"),
+        OPort(name="line_x", signature="basic:List"),
+        OPort(name="line_z", signature="basic:List"),
         OPort(name="title", signature="basic:String"),
         OPort(name="x_label", signature="basic:String"),
         OPort(name="y_label", signature="basic:String"),
+        OPort(name="level", signature="basic:Integer"),
         ]
 
     def compute(self):
         gridder = self.get_input("gridder")
-        ip = gridder.ip
-        hkl_range = gridder.gridder_params.hkl_dims
-        planes = gridder.planes
+        # the extent the gridder binned into, with the bounds and the
+        # fitted grid of its GridderParams applied
+        hkl_range = list(gridder.hkl_dims)
+        # the slab along the third axis and the in-plane extent can be
+        # narrowed down without touching the gridder
+        for i, port in enumerate(["h_range", "k_range", "l_range"]):
+            if self.has_input(port):
+                hkl_range[2 * i:2 * i + 2] = self.get_input(port)
+        plane = self.force_get_input("plane", gridder.planes[0]).upper()
+        if len(plane) != 2 or not set(plane) < set('HKL') or \
+                plane[0] == plane[1]:
+            raise ModuleError(self, "Invalid plane '{0}'".format(plane))
+        level = self.get_level(gridder, plane, hkl_range)
         x, y, z, dz, lx, lz, dlz, limits, labels, titles = \
-            self.get_xyz(ip.getGrid(), planes[0], hkl_range)
+            self.get_xyz(gridder.get_slicer(level), plane, hkl_range)
 
         self.set_output("x", x)
         self.set_output("y", y)
         self.set_output("z", z)
+        self.set_output("dz", dz)
+        self.set_output("line_x", lx)
+        self.set_output("line_z", lz)
         self.set_output("x_label", labels[0])
         self.set_output("y_label", labels[1])
         self.set_output("title", titles[0])
+        self.set_output("level", level)
 
-    # this is probably subtracting a planar background
-    # email vivek and ask him what the heck is going on
-    def get_xyz(self, fullGrid, plane, hkl_dims):
+    def get_level(self, gridder, plane, hkl_range):
+        """
+            Pyramid level to plot: the coarsest one with at least one bin
+            per display pixel in the plotted range, full resolution without
+            a pyramid or a display size
+        """
+        if gridder.pyramid is None or not self.has_input("display_size"):
+            return 0
+        ranges = [hkl_range[2 * i:2 * i + 2] for i in range(3)]
+        return gridder.pyramid.level_for(['HKL'.find(p) for p in plane],
+                                         ranges,
+                                         self.get_input("display_size"))
+
+    def get_xyz(self, slicer, plane, hkl_dims):
+        """
+            Slab through a gridded volume, averaged along the axis normal to
+            plane, plus the line cut along plane[0]
+
+            slicer is a GridSlicer. Bounds are located with searchsorted and
+            x, y and lx are views of the axis vectors, so a new slice of an
+            already gridded volume only costs the average over the slab.
+        """
         HKL = axis3 = 'HKL'
         for i in plane: axis3 = axis3.replace(i, '')
+        axis = HKL.find(axis3)
 
         hkl_range = [ [hkl_dims[0], hkl_dims[1]],
                       [hkl_dims[2], hkl_dims[3]],
                       [hkl_dims[4], hkl_dims[5]] ]
-        H = fullGrid[0][:, 0, 0]
-        K = fullGrid[1][0, :, 0]
-        L = fullGrid[2][0, 0, :]
-
-        H_Inds = [np.where(H >= hkl_range[0][0])[0][0], np.where(H <= hkl_range[0][1])[0][-1] + 1]
-        K_Inds = [np.where(K >= hkl_range[1][0])[0][0], np.where(K <= hkl_range[1][1])[0][-1] + 1]
-        L_Inds = [np.where(L >= hkl_range[2][0])[0][0], np.where(L <= hkl_range[2][1])[0][-1] + 1]
-
-        grid = [grid_i[H_Inds[0]:H_Inds[1], K_Inds[0]:K_Inds[1], L_Inds[0]:L_Inds[1]] for grid_i in fullGrid]
-
-        HHH = grid[0][:, :, :]
-        KKK = grid[1][:, :, :]
-        LLL = grid[2][:, :, :]
-
-        ind1 = 1 + (HKL.find(axis3) <> 0) * len(HHH[:, 0, 0])
-        ind2 = 1 + (HKL.find(axis3) <> 1) * len(HHH[0, :, 0])
-        ind3 = 1 + (HKL.find(axis3) <> 2) * len(HHH[0, 0, :])
-
-        HH = HHH[:ind1, :ind2, :ind3].squeeze()
-        KK = KKK[:ind1, :ind2, :ind3].squeeze()
-        LL = LLL[:ind1, :ind2, :ind3].squeeze()
+        box = slicer.box(hkl_range)
 
-        H = grid[0][:, 0, 0]
-        K = grid[1][0, :, 0]
-        L = grid[2][0, 0, :]
-
-        z = grid[3][:, :, :].mean(HKL.find(axis3)) * 1e3
-        dz = grid[4][:, :, :].mean(HKL.find(axis3)) * 1e3
+        # z, dz and the meshes are indexed in HKL order of the plane axes
+        z = slicer.plane('masked_data', axis, box) * 1e3
+        dz = slicer.plane('std_dev', axis, box) * 1e3
+        meshes = dict(zip([name for name in HKL if name != axis3],
+                          slicer.meshes(axis, box)))
 
         lz = z.mean(int('HKL'.find(plane[0]) < 'HKL'.find(plane[1]))) * 1e3
         dlz = np.sqrt((z ** 2).mean(int('HKL'.find(plane[0]) < 'HKL'.find(plane[1])))) * 1e3
@@ -318,13 +865,13 @@ class PlotGridded(Module):
         x_label = plane[0] + ' [r.l.u.]'
         y_label = plane[1] + ' [r.l.u.]'
 
-        axis3_range = hkl_range[HKL.find(axis3)]
+        axis3_range = hkl_range[axis]
         slice_title = ' %s=[%.3f,%.3f]' % (axis3, axis3_range[0], axis3_range[1])
         cut_title = slice_title + (' %s=[%.3f,%.3f]' % (plane[1], y_range[0], y_range[1]))
 
-        x = eval(plane[0] + plane[0])
-        y = eval(plane[1] + plane[1])
-        lx = eval(plane[0])
+        x = meshes[plane[0]]
+        y = meshes[plane[1]]
+        lx = slicer.axis_values(HKL.find(plane[0]), box)
 
         return x, y, z, dz, \
                lx, lz, dlz, \
@@ -332,33 +879,69 @@ class PlotGridded(Module):
                [x_label, y_label], \
                [slice_title, cut_title]
 
+class ScanStacks(Module):
+    """
+        Port type of the scans of a SpecFileProcessor, a batch.ScanSeries.
+        It holds no images: iterating it yields (scan_no, stack) pairs
+        and reads and dark corrects every scan again, so each module that
+        iterates it pays for loading the whole series once.
+    """
+    _settings = ModuleSettings(abstract=True)
+
+    @staticmethod
+    def validate(x):
+        return isinstance(x, ScanSeries)
+
 class SpecFileProcessor(Module):
+    """
+        Mean image of each of several scans. The scans are loaded once,
+        a few at a time, to compute the means, scan_series loads them
+        again each time it is iterated.
+    """
     _input_ports = [
         IPort(name="img_stack", label="Stack of 2D Images", \
-              signature="basic:List"),
+              signature="gov.nsls2.spec.SpecData:NDArray"),
         IPort(name="has_dark", label="Are dark files present?", \
               signature="basic:Boolean", default=True, optional=True),
         IPort(name="spec_file", label="Spec File Object", \
               signature="gov.nsls2.spec.SpecData:SpecFile"),
         IPort(name="scan_numbers", label="List of scan numbers",
               signature="basic:List"),
+        IPort(name="n_workers", label="Scans loaded concurrently",
+              signature="basic:Integer", default=DEFAULT_WORKERS,
+              optional=True),
         ]
 
     _output_ports = [
-        OPort(name="single_img_array", signature="basic:List"),
+        OPort(name="single_img_array", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="scan_series", signature="gov.nsls2.spec.SpecData:ScanStacks"),
         ]
 
     def compute(self):
-        pass
+        spec_file = self.get_input("spec_file")
+        scan_numbers = self.get_input("scan_numbers")
+        series = ScanSeries(spec_file.sf, scan_numbers,
+                            has_dark=self.force_get_input("has_dark", True),
+                            n_workers=self.force_get_input("n_workers",
+                                                           DEFAULT_WORKERS),
+                            precision=get_precision(
+                                spec_file.params.precision))
+        # one mean image per scan, the stacks themselves are dropped as
+        # soon as they are reduced
+        mean_images = [reduce_stack(stack, ['mean'])['mean']
+                       for scan_no, stack in series]
+
+        self.set_output("single_img_array", np.array(mean_images))
+        self.set_output("scan_series", series)
 
 class SpecScan(Module):
     _input_ports = [
         IPort(name="img_stack", label="Stack of 2D Images", \
-              signature="basic:List")
+              signature="gov.nsls2.spec.SpecData:NDArray")
         ]
 
     _output_ports = [
-        OPort(name="single_img_array", signature="basic:List"),
+        OPort(name="single_img_array", signature="gov.nsls2.spec.SpecData:NDArray"),
         ]
 
     def compute(self):
@@ -376,66 +959,181 @@ class SpecMetadata(Module):
 class ImageStackImageSelector(Module):
     _input_ports = [
         IPort(name="img_stack", label="Stack of 2D Images", \
-              signature="basic:List"),
+              signature="gov.nsls2.spec.SpecData:NDArray"),
         IPort(name="img_no", label="Desired Image Number", \
               signature="basic:Integer"),
         ]
 
     _output_ports = [
-        OPort(name="2D_img", signature="basic:List"),
+        OPort(name="2D_img", signature="gov.nsls2.spec.SpecData:NDArray"),
         ]
 
     def compute(self):
         img_stack = self.get_input("img_stack")
-        print "Image Stack class: {0}".format(img_stack.__class__)
         img_no = self.get_input("img_no")
-        single_img = img_stack[img_no]
+        if not -len(img_stack) <= img_no < len(img_stack):
+            raise ModuleError(self, "Image {0} is outside the stack of {1} "
+                                    "images".format(img_no, len(img_stack)))
+        # a view into the stack, not a copy of the frame
+        single_img = readonly_view(img_stack[img_no])
         self.set_output("2D_img", single_img)
 
-class ImageStackSum(Module):
+class ImageStackROIs(Module):
+    """
+        Sum and mean of many rectangular ROIs on every frame of a stack,
+        from one summed-area table per frame
+    """
     _input_ports = [
         IPort(name="img_stack", label="Stack of 2D Images", \
+              signature="gov.nsls2.spec.SpecData:NDArray"),
+        IPort(name="rois", label="ROIs, [x_min, x_max, y_min, y_max] each",
               signature="basic:List"),
+        IPort(name="frames_per_chunk", label="Frames read per chunk",
+              signature="basic:Integer", optional=True),
+        IPort(name="n_workers", label="Threads building the tables",
+              signature="basic:Integer", default=1, optional=True),
         ]
 
     _output_ports = [
-        OPort(name="2D_img", signature="basic:List"),
+        OPort(name="roi_sums", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="roi_means", signature="gov.nsls2.spec.SpecData:NDArray"),
         ]
 
     def compute(self):
         img_stack = self.get_input("img_stack")
-        #=======================================================================
-        # img_stack_np = (numpy.ndarray) img_stack
-        #=======================================================================
+        kwargs = {'n_workers': self.force_get_input("n_workers", 1)}
+        if self.has_input("frames_per_chunk"):
+            kwargs['frames_per_chunk'] = self.get_input("frames_per_chunk")
+        try:
+            sums, means = roi_sums(img_stack, self.get_input("rois"),
+                                   **kwargs)
+        except ValueError as e:
+            raise ModuleError(self, str(e))
+        self.set_output("roi_sums", sums)
+        self.set_output("roi_means", means)
+
+class ImageStackReducer(Module):
+    """
+        Base of the single statistic stack reductions. The stack is read in
+        chunks of frames, so lazy stacks are never loaded as a whole.
+    """
+    _settings = ModuleSettings(abstract=True)
+    _input_ports = [
+        IPort(name="img_stack", label="Stack of 2D Images", \
+              signature="gov.nsls2.spec.SpecData:NDArray"),
+        ]
 
-        img_sum = img_stack[0]
-        total_images = 0
-        for i in range(1, len(img_stack)):
-            img_sum.__add__(img_stack[i])
-            total_images += 1
+    _output_ports = [
+        OPort(name="2D_img", signature="gov.nsls2.spec.SpecData:NDArray"),
+        ]
+
+    statistic = None
+
+    def compute(self):
+        img_stack = self.get_input("img_stack")
+        try:
+            reduced = reduce_stack(img_stack, [self.statistic])
+        except ValueError as e:
+            raise ModuleError(self, str(e))
+        self.set_output("2D_img", reduced[self.statistic])
 
-        img_sum.__mul__(1 / total_images)
+class ImageStackSum(ImageStackReducer):
+    statistic = 'sum'
+
+class ImageStackMean(ImageStackReducer):
+    statistic = 'mean'
+
+class ImageStackMax(ImageStackReducer):
+    statistic = 'max'
+
+class ImageStackMin(ImageStackReducer):
+    statistic = 'min'
+
+class ImageStackVariance(ImageStackReducer):
+    statistic = 'var'
+
+class ImageStackPercentile(ImageStackReducer):
+    _input_ports = [
+        IPort(name="percentile", label="Percentile (0-100)",
+              signature="basic:Float", default=50.0, optional=True),
+        ]
+
+    def compute(self):
+        img_stack = self.get_input("img_stack")
+        percentile = self.force_get_input("percentile", 50.0)
+        try:
+            reduced = stack_percentiles(img_stack, percentile)
+        except ValueError as e:
+            raise ModuleError(self, str(e))
+        self.set_output("2D_img", reduced[float(percentile)])
+
+class ImageStackStatistics(Module):
+    """
+        Several statistics of an image stack, computed while reading the
+        stack only once
+    """
+    _input_ports = [
+        IPort(name="img_stack", label="Stack of 2D Images", \
+              signature="gov.nsls2.spec.SpecData:NDArray"),
+        IPort(name="statistics", label="Statistics (sum, mean, max, min, var, std)",
+              signature="basic:List", optional=True),
+        IPort(name="percentiles", label="Percentiles (0-100)",
+              signature="basic:List", optional=True),
+        ]
+
+    _output_ports = [
+        OPort(name="sum", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="mean", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="max", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="min", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="variance", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="std_dev", signature="gov.nsls2.spec.SpecData:NDArray"),
+        OPort(name="percentiles", signature="basic:Dictionary"),
+        ]
+
+    # statistic name -> output port
+    port_names = {'sum': 'sum', 'mean': 'mean', 'max': 'max', 'min': 'min',
+                  'var': 'variance', 'std': 'std_dev'}
+
+    def compute(self):
+        img_stack = self.get_input("img_stack")
+        statistics = self.force_get_input("statistics", ['mean'])
+        percentiles = self.force_get_input("percentiles", None)
+        try:
+            reduced = reduce_stack(img_stack, statistics, percentiles)
+        except ValueError as err:
+            raise ModuleError(self, str(err))
+        for name in statistics:
+            self.set_output(self.port_names[name], reduced[name])
+        if percentiles:
+            self.set_output("percentiles", reduced['percentile'])
 
-        self.set_output("2D_img", img_sum)
 class SwapAxes(Module):
     _input_ports = [
         IPort(name="axis1", label="Axis to swap", signature="basic:Integer"),
         IPort(name="axis2", label="Axis to swap", signature="basic:Integer"),
         IPort(name="ndarray", label="ndarray to swap the axes of",
-              signature="basic:List"),
+              signature="gov.nsls2.spec.SpecData:NDArray"),
                     ]
     _output_ports = [
-        OPort(name="swapped_ndarray", signature="basic:List"),
+        OPort(name="swapped_ndarray", signature="gov.nsls2.spec.SpecData:NDArray"),
                     ]
     def compute(self):
         axis1 = self.get_input("axis1")
         axis2 = self.get_input("axis2")
-        ndarray = self.get_input("ndarray")
-        swapped_ndarray = np.swapaxes(ndarray, axis1, axis2)
+        ndarray = np.asarray(self.get_input("ndarray"))
+        # swapaxes only changes the strides, the data is shared
+        swapped_ndarray = readonly_view(np.swapaxes(ndarray, axis1, axis2))
         self.set_output("swapped_ndarray", swapped_ndarray)
 
 # Defining the module names
-_modules = [SpecFile, SpecScan, SpecMetadata, ImageStackImageSelector, \
-            ImageStackSum, SpecFileProcessor, SpecFileParams, \
-            Gridder, GridderParams, PlotGridded, SwapAxes
+_modules = [NDArray, ScanStacks, SpecFile, SpecScan, SpecMetadata, ImageStackImageSelector, \
+            ImageStackROIs, ImageStackReducer, ImageStackSum, ImageStackMean, ImageStackMax, \
+            ImageStackMin, ImageStackVariance, ImageStackPercentile, \
+            ImageStackStatistics, SpecFileProcessor, SpecFileParams, \
+            Gridder, GridderParams, PlotGridded, SwapAxes, StreamingGridder, \
+            GridStoreManager
             ]
+
+# metrics output port and opt-in metering of every compute()
+instrument(_modules)
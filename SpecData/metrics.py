@@ -0,0 +1,233 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Opt-in execution metrics of the SpecData modules
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from vistrails.core.modules.vistrails_module import Module
+from vistrails.core.modules.config import OPort
+from .cache import nbytes_of
+logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+METRICS_PORT = OPort(name="metrics", signature="basic:Dictionary")
+
+
+def peak_rss():
+    """
+    Peak resident set size of the process in bytes, 0 where unknown
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def io_counters():
+    """
+    (bytes read from storage, bytes read through read calls) of the process
+
+    Taken from /proc/self/io. Elsewhere only the first is estimated, from
+    the block input operations of getrusage.
+    """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            fields = dict(line.split(':') for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['rchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+    if resource is None:
+        return 0, 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_inblock * 512, 0
+
+
+def describe_value(value):
+    """
+    Shape, dtype and size of an array-like port value, the type otherwise
+    """
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        return {'type': type(value).__name__,
+                'shape': [int(n) for n in value.shape],
+                'dtype': str(value.dtype),
+                'nbytes': int(getattr(value, 'nbytes', 0))}
+    description = {'type': type(value).__name__}
+    if isinstance(value, (list, tuple, dict)) or \
+            hasattr(value, 'nbytes'):
+        description['nbytes'] = int(getattr(value, 'nbytes', None) or
+                                    nbytes_of(value, max_depth=1))
+    return description
+
+
+class MetricsRecorder(object):
+    """
+    Where module metrics go
+
+    Every record is logged as JSON on this module's logger and, when path
+    is set, appended as one JSON line to path. SPECDATA_METRICS turns
+    recording on: '1' only logs, any other value is the path of the
+    metrics file.
+
+    Parameters
+    ----------
+    enabled : bool
+        Collect metrics at all
+    path : str, optional
+        JSON lines file the records are appended to
+    """
+    def __init__(self, enabled=False, path=None):
+        self.enabled = enabled
+        self.path = path
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environ(cls):
+        setting = os.environ.get('SPECDATA_METRICS', '')
+        if not setting or setting == '0':
+            return cls()
+        return cls(True, None if setting == '1' else setting)
+
+    def record(self, entry):
+        line = json.dumps(entry, sort_keys=True)
+        logger.info(line)
+        if self.path is None:
+            return
+        with self._lock:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(line + '\n')
+            except (IOError, OSError) as err:
+                logger.warning('could not write metrics to %s: %s',
+                               self.path, err)
+
+
+recorder = MetricsRecorder.from_environ()
+
+
+def _input_values(module):
+    values = {}
+    for name, connectors in module.inputPorts.items():
+        try:
+            values[name] = describe_value(connectors[0].get_raw())
+        except Exception:
+            # upstream output that is not there, reported by compute()
+            continue
+    return values
+
+
+def _output_values(module):
+    return dict((name, describe_value(value))
+                for name, value in module.outputPorts.items()
+                if name not in ('self', METRICS_PORT.name))
+
+
+def metered(compute):
+    """
+    Wrap a compute() so that every call is measured while the recorder is
+    enabled, and the record is set on the metrics output port
+
+    Wall and CPU time, peak RSS growth and disk reads are process wide, so
+    modules running concurrently share them.
+    """
+    @functools.wraps(compute)
+    def wrapper(self):
+        if not recorder.enabled or getattr(self, '_metering', False):
+            return compute(self)
+        self._metering = True
+        inputs = _input_values(self)
+        rss = peak_rss()
+        read_bytes, read_chars = io_counters()
+        wall = time.time()
+        cpu = cpu_time()
+        entry = {'module': type(self).__name__,
+                 'module_id': getattr(self, 'moduleInfo', {}).get('moduleId'),
+                 'timestamp': wall,
+                 'inputs': inputs}
+        try:
+            result = compute(self)
+        except Exception as err:
+            entry['error'] = repr(err)
+            raise
+        finally:
+            self._metering = False
+            end_bytes, end_chars = io_counters()
+            entry.update({'wall_s': time.time() - wall,
+                          'cpu_s': cpu_time() - cpu,
+                          'peak_rss_delta_bytes': peak_rss() - rss,
+                          'read_bytes': end_bytes - read_bytes,
+                          'read_chars': end_chars - read_chars,
+                          'outputs': _output_values(self)})
+            recorder.record(entry)
+        self.set_output('metrics', entry)
+        return result
+    wrapper.metered = True
+    return wrapper
+
+
+def instrument(modules):
+    """
+    Meter the compute() of every module class in modules and give each of
+    them a metrics output port, inherited by subclasses. Port types,
+    which never compute anything, are left alone.
+    """
+    for cls in sorted(modules, key=lambda c: len(c.__mro__)):
+        own = cls.__mro__[:cls.__mro__.index(Module)]
+        if not any('compute' in vars(klass) for klass in own):
+            continue
+        compute = cls.__dict__.get('compute')
+        if compute is not None and not getattr(compute, 'metered', False):
+            cls.compute = metered(compute)
+        inherited = [port for klass in cls.__mro__
+                     for port in klass.__dict__.get('_output_ports', [])
+                     if port.name == METRICS_PORT.name]
+        if not inherited:
+            cls._output_ports = (list(cls.__dict__.get('_output_ports', []))
+                                 + [METRICS_PORT])
+    return modules
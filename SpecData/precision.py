@@ -0,0 +1,150 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Numeric precision policies of the SpecData pipelines
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from .sparse import SparseGrid
+from .stack import ProcessorFrameLoader
+
+
+def compact_occupancy(occupancy):
+    """
+    occupancy in the smallest unsigned integer type that holds its maximum
+    """
+    occupancy = np.asarray(occupancy)
+    top = int(occupancy.max()) if occupancy.size else 0
+    return occupancy.astype(np.min_scalar_type(max(top, 0)), copy=False)
+
+
+class Precision(object):
+    """
+    dtypes a pipeline keeps its frames and gridded volumes in
+
+    Sums over pixels and voxels are accumulated in float64 whatever the
+    policy, only what is stored and handed between modules changes.
+
+    Parameters
+    ----------
+    name : str
+        Name of the policy, the value of the precision ports
+    frame_dtype : numpy.dtype
+        dtype of frames that are dark subtracted, normalized or summed
+    output_dtype : numpy.dtype
+        dtype of the gridded intensities, errors and meshes
+    native_frames : bool
+        Frames that are read as they are keep the dtype of the CCD files,
+        16-bit for our detectors
+    compact_occupancy : bool
+        Store the occupancy in the smallest unsigned type that holds it
+    """
+    def __init__(self, name, frame_dtype, output_dtype, native_frames,
+                 compact_occupancy):
+        self.name = name
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.output_dtype = np.dtype(output_dtype)
+        self.native_frames = native_frames
+        self.compact_occupancy = compact_occupancy
+
+    def __repr__(self):
+        return 'Precision({0!r})'.format(self.name)
+
+    def frame_loader(self, fp, **kwargs):
+        """
+        ProcessorFrameLoader decoding frames of fp in this precision
+        """
+        loader = ProcessorFrameLoader(fp, **kwargs)
+        loader.dtype = self.frame_dtype_for(loader)
+        return loader
+
+    def frame_dtype_for(self, loader):
+        """
+        dtype a ProcessorFrameLoader should decode in, None for the dtype
+        of the files. Call again after changing the loader's darks.
+        """
+        if self.native_frames and not loader.modifies_frames():
+            return None
+        return self.frame_dtype
+
+    def grid(self, grid):
+        """
+        Gridder result, a SparseGrid or the dense (X, Y, Z, I, E, N, raw)
+        arrays, in the output dtypes of this policy
+        """
+        if isinstance(grid, SparseGrid):
+            return SparseGrid(grid.axes, grid.index,
+                              self.occupancy(grid.occupancy),
+                              self.values(grid.mean),
+                              self.values(grid.std_err),
+                              grid.min_occupancy)
+        X, Y, Z, I, E, N, raw = grid
+        X, Y, Z, I, E, raw = [self.values(v) for v in (X, Y, Z, I, E, raw)]
+        return X, Y, Z, I, E, self.occupancy(N), raw
+
+    def voxel_nbytes(self):
+        """
+        Bytes per voxel of a dense Gridder result, together with the
+        float64 sums it is accumulated in
+        """
+        # sum, sum_sq and occupancy, the occupancy output at its widest
+        return 3 * 8 + 8 + 6 * self.output_dtype.itemsize
+
+    def values(self, arr):
+        return np.asarray(arr).astype(self.output_dtype, copy=False)
+
+    def occupancy(self, occupancy):
+        if self.compact_occupancy:
+            return compact_occupancy(occupancy)
+        return occupancy
+
+
+DOUBLE = Precision('double', np.float64, np.float64, native_frames=False,
+                   compact_occupancy=False)
+SINGLE = Precision('single', np.float32, np.float32, native_frames=True,
+                   compact_occupancy=True)
+PRECISIONS = {p.name: p for p in (DOUBLE, SINGLE)}
+
+
+def get_precision(name):
+    """
+    Precision policy by name, 'double' (the default) or 'single'
+    """
+    try:
+        return PRECISIONS[name or DOUBLE.name]
+    except KeyError:
+        raise ValueError("unknown precision '{0}', expected one of {1}"
+                         "".format(name, sorted(PRECISIONS)))
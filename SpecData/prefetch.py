@@ -0,0 +1,204 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Parallel frame decoding and background prefetching of scans
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import collections
+import logging
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
+import numpy as np
+logger = logging.getLogger(__name__)
+
+# threads decoding the frames of one scan
+DEFAULT_DECODE_WORKERS = 4
+
+# scans held by the prefetcher at any time
+DEFAULT_PREFETCH_SCANS = 2
+
+# dropped with their SpecDataFile, so a long session does not pile them up
+_sf_locks = weakref.WeakKeyDictionary()
+_sf_locks_lock = threading.Lock()
+
+
+def spec_file_lock(sf):
+    """
+    Lock serialising reads of one SpecDataFile: pyspec scans are read
+    through the single file handle of their SpecDataFile
+    """
+    with _sf_locks_lock:
+        lock = _sf_locks.get(sf)
+        if lock is None:
+            lock = _sf_locks[sf] = threading.Lock()
+        return lock
+
+
+def decode_stack(loader, n_workers=DEFAULT_DECODE_WORKERS):
+    """
+    All frames of a ProcessorFrameLoader as one (n_frames, rows, cols)
+    stack
+
+    Frames are decoded on a pool of n_workers threads, decompression and
+    file I/O release the GIL. The first frame is decoded up front, which
+    also decodes the dark image most scans share. A loader without frames
+    raises ValueError.
+    """
+    if len(loader) == 0:
+        raise ValueError('Cannot build an image stack from a scan without '
+                         'frames')
+    first = loader(0)
+    stack = np.empty((len(loader),) + first.shape, dtype=first.dtype)
+    stack[0] = first
+
+    def decode(i):
+        stack[i] = loader(i)
+
+    if n_workers <= 1 or len(loader) < 3:
+        for i in range(1, len(loader)):
+            decode(i)
+        return stack
+    pool = ThreadPool(n_workers)
+    try:
+        pool.map(decode, range(1, len(loader)))
+    finally:
+        pool.terminate()
+    return stack
+
+
+class ScanPrefetcher(object):
+    """
+    Loads scans the user is likely to open next on a background thread
+
+    At most max_scans scans are buffered: requesting another one drops the
+    oldest, whether it finished loading or not. take() hands a buffered
+    scan over and removes it from the buffer, waiting for it if it is
+    still loading, which is never slower than starting the load again.
+
+    Dropped scans are cancelled: a load that has not started yet is
+    skipped, one that is running finishes and is discarded. retain()
+    drops the scans of a group, e.g. of one SPEC file, that left the
+    window of scans to prefetch.
+
+    Parameters
+    ----------
+    max_scans : int, optional
+        Size of the buffer
+    """
+    def __init__(self, max_scans=DEFAULT_PREFETCH_SCANS):
+        self.max_scans = max(int(max_scans), 1)
+        self._pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set_max_scans(self, max_scans):
+        with self._lock:
+            self.max_scans = max(int(max_scans), 1)
+            self._trim(self.max_scans)
+
+    def prefetch(self, key, load, args=(), group=None):
+        """
+        Start load(*args) in the background unless key is already buffered
+        """
+        with self._lock:
+            if key in self._pending:
+                return
+            self._trim(self.max_scans - 1)
+            if self._pool is None:
+                # one scan at a time, each one decodes on its own pool
+                self._pool = ThreadPool(1)
+            cancelled = threading.Event()
+            result = self._pool.apply_async(_unless_cancelled,
+                                            (cancelled, load, args))
+            self._pending[key] = (result, cancelled, group)
+
+    def retain(self, group, keys):
+        """
+        Drop the scans of group whose keys are not in keys
+        """
+        keys = set(keys)
+        with self._lock:
+            for key, (_, _, g) in list(self._pending.items()):
+                if g == group and key not in keys:
+                    self._drop(key)
+
+    def take(self, key):
+        """
+        The result of the load buffered under key, None if there is none or
+        it failed
+        """
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is None:
+            return None
+        result = entry[0]
+        try:
+            return result.get()
+        except Exception as err:
+            # the foreground load reports the error, if it happens again
+            logger.info('prefetching %s failed: %s', key, err)
+            return None
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._pending):
+                self._drop(key)
+
+    def _trim(self, n):
+        while len(self._pending) > max(n, 0):
+            self._drop(next(iter(self._pending)))
+
+    def _drop(self, key):
+        _, cancelled, _ = self._pending.pop(key)
+        cancelled.set()
+        logger.debug('dropped prefetched scan %s', key)
+
+
+def _unless_cancelled(cancelled, load, args):
+    if cancelled.is_set():
+        return None
+    return load(*args)
+
+
+# prefetched scans of all SpecFile modules
+prefetcher = ScanPrefetcher()
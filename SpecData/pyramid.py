@@ -0,0 +1,191 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Multi-resolution pyramids of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from .sparse import SparseGrid
+from .slicing import GridSlicer
+
+# levels stop once every axis is down to this many bins
+DEFAULT_MIN_BINS = 8
+
+
+def _coarse_axis(values):
+    """
+    Axis values of the merged voxels. Values are lower voxel edges, as in
+    gridding.grid_axes, so a pair of voxels starts at the first of them.
+    """
+    return np.asarray(values)[::2]
+
+
+def _block_sum(volume):
+    """
+    Sum of 2 x 2 x 2 blocks of a 3D array, odd axes are padded with zeros
+    """
+    pad = [(0, n % 2) for n in volume.shape]
+    if any(p[1] for p in pad):
+        volume = np.pad(volume, pad, mode='constant')
+    h, k, l = [n // 2 for n in volume.shape]
+    return volume.reshape(h, 2, k, 2, l, 2).sum(axis=(1, 3, 5))
+
+
+def _weighted(sums, sums_sq, weights):
+    """
+    Occupancy weighted mean and standard error from the running sums
+    """
+    hit = weights > 0
+    mean = np.zeros(weights.shape)
+    std_err = np.zeros(weights.shape)
+    mean[hit] = sums[hit] / weights[hit]
+    std_err[hit] = np.sqrt(sums_sq[hit]) / weights[hit]
+    return mean, std_err
+
+
+class GridPyramid(object):
+    """
+    Mipmap style stack of down-sampled copies of a gridded volume
+
+    Level 0 is the full grid and every level halves the number of bins
+    along each axis. Voxels are merged with occupancy weights: the mean is
+    sum(I * N) / sum(N) and the standard error sqrt(sum((E * N)**2)) /
+    sum(N) over the voxels that passed the occupancy mask, which is exactly
+    what gridding the scan onto the coarser grid would give. Sparse grids
+    stay sparse at every level.
+
+    Parameters
+    ----------
+    levels : sequence of GridSlicer
+        Slicers from the finest to the coarsest level
+    """
+    def __init__(self, levels):
+        self.levels = list(levels)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __getitem__(self, level):
+        return self.levels[level]
+
+    @classmethod
+    def from_grid(cls, grid, min_occupancy=0, min_bins=DEFAULT_MIN_BINS):
+        """
+        Pyramid of a Gridder result, a SparseGrid or a dense
+        (X, Y, Z, I, E, N) tuple
+
+        Parameters
+        ----------
+        grid : SparseGrid or tuple
+            Full resolution grid, the first level
+        min_occupancy : int, optional
+            Occupancy mask the dense grid was built with, voxels below it
+            do not contribute to coarser levels
+        min_bins : int, optional
+            No level is built once an axis would drop below this many bins
+        """
+        levels = [GridSlicer.from_grid(grid)]
+        if isinstance(grid, SparseGrid):
+            build = cls._sparse_levels
+        else:
+            build = cls._dense_levels
+        levels.extend(build(grid, min_occupancy, min_bins))
+        return cls(levels)
+
+    @staticmethod
+    def _dense_levels(grid, min_occupancy, min_bins):
+        X, Y, Z, I, E, N = grid[:6]
+        axes = [X[:, 0, 0], Y[0, :, 0], Z[0, 0, :]]
+        # sums in float64 and int64, levels come out in the grid's dtype
+        dtype = np.asarray(I).dtype
+        occupancy = np.asarray(N, dtype=np.int64)
+        weights = occupancy * (occupancy >= min_occupancy)
+        sums = np.asarray(I, dtype=np.float64) * weights
+        sums_sq = (np.asarray(E, dtype=np.float64) * weights) ** 2
+        while min(len(a) for a in axes) >= 2 * min_bins:
+            axes = [_coarse_axis(a) for a in axes]
+            occupancy, weights, sums, sums_sq = [
+                _block_sum(v) for v in (occupancy, weights, sums, sums_sq)]
+            mean, std_err = _weighted(sums, sums_sq, weights)
+            yield GridSlicer(axes, volumes={'masked_data': mean.astype(dtype),
+                                            'std_dev': std_err.astype(dtype),
+                                            'occupancy': occupancy})
+
+    @staticmethod
+    def _sparse_levels(grid, min_occupancy, min_bins):
+        axes = grid.axes
+        coords = grid.coords()
+        dtype = grid.mean.dtype
+        occupancy = grid.occupancy.astype(np.int64)
+        weights = occupancy * (occupancy >= grid.min_occupancy)
+        sums = grid.field('masked_data') * weights
+        sums_sq = (grid.field('std_dev') * weights) ** 2
+        while min(len(a) for a in axes) >= 2 * min_bins:
+            axes = [_coarse_axis(a) for a in axes]
+            shape = tuple(len(a) for a in axes)
+            flat = np.ravel_multi_index([c // 2 for c in coords], shape)
+            index, inverse = np.unique(flat, return_inverse=True)
+            inverse = np.ravel(inverse)
+            occupancy, weights, sums, sums_sq = [
+                np.bincount(inverse, weights=v)
+                for v in (occupancy, weights, sums, sums_sq)]
+            occupancy = occupancy.astype(np.int64)
+            coords = np.unravel_index(index, shape)
+            mean, std_err = _weighted(sums, sums_sq, weights)
+            yield GridSlicer(axes, sparse_grid=SparseGrid(
+                axes, index, occupancy, mean.astype(dtype),
+                std_err.astype(dtype)))
+
+    def level_for(self, axes, ranges, display_shape):
+        """
+        Coarsest level that still has at least display_shape bins across
+        ranges, level 0 when even the full grid is coarser than that
+
+        Parameters
+        ----------
+        axes : sequence of int
+            In-plane axes of the view
+        ranges : sequence
+            [lo, hi] per axis (H, K, L), None for the whole axis
+        display_shape : sequence of int
+            Number of display pixels along each of axes
+        """
+        for level in range(len(self.levels) - 1, 0, -1):
+            box = self.levels[level].box(ranges)
+            if all(box[a][1] - box[a][0] >= n
+                   for a, n in zip(axes, display_shape)):
+                return level
+        return 0
@@ -0,0 +1,340 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Single pass, chunked reductions over image stacks
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import tempfile
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from .slabs import scratch_dir
+from .stack import iter_blocks
+
+# statistics StackReducer can compute in one pass
+STATISTICS = ('sum', 'mean', 'max', 'min', 'var', 'std')
+
+# frames read per chunk
+DEFAULT_FRAMES_PER_CHUNK = 16
+
+# memory allowed for the pixel slabs sorted by stack_percentiles
+DEFAULT_PERCENTILE_BYTES = 512 * 2 ** 20
+
+
+class StackReducer(object):
+    """
+    Running per-pixel statistics of a stack, fed one chunk at a time
+
+    All accumulators are float64, whatever the dtype of the frames. The
+    variance is merged chunk by chunk with the pairwise update of Chan,
+    Golub and LeVeque, which stays accurate for long stacks.
+
+    Parameters
+    ----------
+    frame_shape : tuple
+        Shape of one frame
+    statistics : sequence
+        Names from STATISTICS
+    """
+    def __init__(self, frame_shape, statistics):
+        unknown = set(statistics) - set(STATISTICS)
+        if unknown:
+            raise ValueError('unknown statistics {0}, choose from {1}'
+                             ''.format(sorted(unknown), STATISTICS))
+        self.statistics = tuple(statistics)
+        self.count = 0
+        self._need_moments = bool(set(self.statistics) &
+                                  set(['sum', 'mean', 'var', 'std']))
+        self._need_m2 = bool(set(self.statistics) & set(['var', 'std']))
+        self._mean = np.zeros(frame_shape) if self._need_moments else None
+        self._m2 = np.zeros(frame_shape) if self._need_m2 else None
+        self._max = None
+        self._min = None
+
+    def add(self, block):
+        """
+        Add a (n_frames, rows, cols) block of frames
+        """
+        n = len(block)
+        if n == 0:
+            return
+        if self._need_moments:
+            block64 = block.astype(np.float64, copy=False)
+            mean_b = block64.mean(axis=0)
+            total = self.count + n
+            delta = mean_b - self._mean
+            if self._need_m2:
+                m2_b = ((block64 - mean_b) ** 2).sum(axis=0)
+                self._m2 += m2_b + delta ** 2 * (self.count * n / total)
+            self._mean += delta * (n / total)
+        if 'max' in self.statistics:
+            block_max = block.max(axis=0).astype(np.float64)
+            self._max = block_max if self._max is None else \
+                np.maximum(self._max, block_max)
+        if 'min' in self.statistics:
+            block_min = block.min(axis=0).astype(np.float64)
+            self._min = block_min if self._min is None else \
+                np.minimum(self._min, block_min)
+        self.count += n
+
+    def result(self):
+        """
+        Dictionary of statistic name -> 2D array
+        """
+        if self.count == 0:
+            raise ValueError('cannot reduce an empty stack')
+        out = {}
+        for name in self.statistics:
+            if name == 'sum':
+                out[name] = self._mean * self.count
+            elif name == 'mean':
+                out[name] = self._mean.copy()
+            elif name == 'var':
+                out[name] = self._m2 / self.count
+            elif name == 'std':
+                out[name] = np.sqrt(self._m2 / self.count)
+            elif name == 'max':
+                out[name] = self._max
+            elif name == 'min':
+                out[name] = self._min
+        return out
+
+
+def _percentiles(q):
+    qs = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    if qs.size == 0 or not np.all((qs >= 0) & (qs <= 100)):
+        raise ValueError('percentiles must be between 0 and 100, got {0}'
+                         ''.format(np.atleast_1d(q).tolist()))
+    return qs
+
+
+def stack_percentiles(stack, q, max_bytes=DEFAULT_PERCENTILE_BYTES):
+    """
+    Per-pixel percentiles of a stack
+
+    The stack is processed in slabs of detector rows that fit in
+    max_bytes, and each slab is reduced with np.partition (a partial
+    sort) rather than a full sort. Slicing an ndarray or memmap only reads
+    the slab itself. A lazy stack larger than max_bytes is decoded once
+    into a temporary memory-mapped file in slabs.scratch_dir() and sliced
+    from there, rather than decoded again for every slab.
+
+    Parameters
+    ----------
+    stack : ndarray or LazyImageStack
+        (n_frames, rows, cols) stack
+    q : float or sequence of float
+        Percentiles, between 0 and 100
+    max_bytes : int, optional
+        Memory budget for one slab
+
+    Returns
+    -------
+    dict
+        percentile -> 2D array
+
+    Raises
+    ------
+    ValueError
+        If a percentile is outside [0, 100] or the stack is empty
+    """
+    qs = _percentiles(q)
+    n_frames, rows, cols = stack.shape
+    if n_frames == 0:
+        raise ValueError('cannot reduce an empty stack')
+    rows_per_slab = max(int(max_bytes // (n_frames * cols * 8)), 1)
+    if rows_per_slab >= rows or isinstance(stack, np.ndarray):
+        return _slab_percentiles(stack, qs, rows_per_slab)
+    with tempfile.TemporaryFile(prefix='specdata_percentile_',
+                                dir=scratch_dir()) as f:
+        decoded = np.memmap(f, dtype=stack.dtype, mode='w+',
+                            shape=stack.shape)
+        for start, block in iter_blocks(stack, DEFAULT_FRAMES_PER_CHUNK):
+            decoded[start:start + len(block)] = block
+        return _slab_percentiles(decoded, qs, rows_per_slab)
+
+
+def _slab_percentiles(stack, qs, rows_per_slab):
+    n_frames, rows, cols = stack.shape
+    # linear interpolation between the two closest ranks, as np.percentile
+    ranks = qs / 100.0 * (n_frames - 1)
+    lo = np.floor(ranks).astype(int)
+    hi = np.minimum(lo + 1, n_frames - 1)
+    kth = np.unique(np.concatenate([lo, hi]))
+    out = dict((float(p), np.empty((rows, cols))) for p in qs)
+    for r0 in range(0, rows, rows_per_slab):
+        r1 = min(r0 + rows_per_slab, rows)
+        slab = np.asarray(stack[:, r0:r1], dtype=np.float64)
+        slab = np.partition(slab, kth, axis=0)
+        for p, rank, i, j in zip(qs, ranks, lo, hi):
+            out[float(p)][r0:r1] = slab[i] + (slab[j] - slab[i]) * (rank - i)
+    return out
+
+
+def reduce_stack(stack, statistics=('mean',), percentiles=None,
+                 frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK,
+                 max_bytes=DEFAULT_PERCENTILE_BYTES):
+    """
+    Several per-pixel statistics of a stack from a single chunked pass
+
+    Parameters
+    ----------
+    stack : ndarray or LazyImageStack
+        (n_frames, rows, cols) stack
+    statistics : sequence, optional
+        Names from STATISTICS
+    percentiles : sequence, optional
+        Percentiles to compute as well, see stack_percentiles
+    frames_per_chunk : int, optional
+        Frames read per chunk
+    max_bytes : int, optional
+        Memory budget of the percentile slabs
+
+    Returns
+    -------
+    dict
+        Statistic name -> 2D array, with the percentiles under
+        'percentile' as a dict of percentile -> 2D array
+    """
+    if not hasattr(stack, 'shape'):
+        stack = np.asarray(stack)
+    if percentiles is not None and len(percentiles):
+        # before the statistics pass, not after it
+        _percentiles(percentiles)
+    out = {}
+    if statistics:
+        reducer = StackReducer(stack.shape[1:], statistics)
+        for start, block in iter_blocks(stack, frames_per_chunk):
+            reducer.add(block)
+        out.update(reducer.result())
+    if percentiles is not None and len(percentiles):
+        out['percentile'] = stack_percentiles(stack, percentiles, max_bytes)
+    return out
+
+
+def _rois(rois, rows, cols):
+    """
+    ROIs as an (n_rois, 4) integer array, raises ValueError unless each
+    one is a non-empty rectangle inside the rows x cols frames
+    """
+    rois = np.asarray(rois)
+    if rois.ndim == 1 and rois.size == 4:
+        rois = rois[np.newaxis]
+    if rois.ndim != 2 or rois.shape[1] != 4 or len(rois) == 0:
+        raise ValueError('ROIs must be a list of [x_min, x_max, y_min, '
+                         'y_max], got {0}'.format(rois.tolist()))
+    rois = rois.astype(np.intp)
+    x0, x1, y0, y1 = rois.T
+    bad = (x0 < 0) | (x1 > rows) | (x0 >= x1) | \
+        (y0 < 0) | (y1 > cols) | (y0 >= y1)
+    if np.any(bad):
+        raise ValueError('ROIs {0} are empty, inverted or outside the '
+                         '{1} x {2} frames'.format(rois[bad].tolist(),
+                                                   rows, cols))
+    return rois
+
+
+def _roi_table_sums(block, rois):
+    # summed-area table with a leading row and column of zeros, so that
+    # every rectangle is four lookups
+    n, rows, cols = block.shape
+    table = np.zeros((n, rows + 1, cols + 1))
+    np.cumsum(np.cumsum(block, axis=1, dtype=np.float64), axis=2,
+              out=table[:, 1:, 1:])
+    x0, x1, y0, y1 = rois.T
+    return (table[:, x1, y1] - table[:, x0, y1] -
+            table[:, x1, y0] + table[:, x0, y0])
+
+
+def roi_sums(stack, rois, frames_per_chunk=DEFAULT_FRAMES_PER_CHUNK,
+             n_workers=1):
+    """
+    Sum and mean of rectangular ROIs on every frame of a stack
+
+    One summed-area table is built per frame, after which each ROI costs
+    four lookups per frame whatever its size, so hundreds of ROIs cost
+    little more than one. The stack is read in chunks of frames, and with
+    n_workers > 1 the tables of n_workers chunks are built at a time on a
+    thread pool (numpy releases the GIL in cumsum).
+
+    Parameters
+    ----------
+    stack : ndarray or LazyImageStack
+        (n_frames, rows, cols) stack
+    rois : sequence
+        [x_min, x_max, y_min, y_max] per ROI, with the pixels
+        [x_min:x_max, y_min:y_max] as in the ROI of DetectorMask. Each
+        must be non-empty and inside the frames.
+    frames_per_chunk : int, optional
+        Frames read per chunk
+    n_workers : int, optional
+        Threads building the tables
+
+    Returns
+    -------
+    sums, means : ndarray
+        (n_frames, n_rois) arrays
+
+    Raises
+    ------
+    ValueError
+        If a ROI is empty, inverted or reaches outside the frames
+    """
+    if not hasattr(stack, 'shape'):
+        stack = np.asarray(stack)
+    n_frames, rows, cols = stack.shape
+    # before any frame is read
+    rois = _rois(rois, rows, cols)
+    area = (rois[:, 1] - rois[:, 0]) * (rois[:, 3] - rois[:, 2])
+    sums = np.empty((n_frames, len(rois)))
+    blocks = iter_blocks(stack, frames_per_chunk)
+    if n_workers <= 1:
+        for start, block in blocks:
+            sums[start:start + len(block)] = _roi_table_sums(block, rois)
+    else:
+        pool = ThreadPool(n_workers)
+        try:
+            # at most n_workers chunks are held in memory at a time
+            while True:
+                window = [b for _, b in zip(range(n_workers), blocks)]
+                if not window:
+                    break
+                for (start, block), out in zip(window, pool.map(
+                        lambda b: _roi_table_sums(b[1], rois), window)):
+                    sums[start:start + len(block)] = out
+        finally:
+            pool.close()
+            pool.join()
+    return sums, sums / area
@@ -0,0 +1,243 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Persistent scan-number -> byte-offset index for SPEC data files
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import hashlib
+import json
+import logging
+import os
+from pyspec.spec import SpecDataFile
+from .fileio import write_json
+logger = logging.getLogger(__name__)
+
+# bump whenever the layout of the sidecar file changes
+INDEX_VERSION = 1
+# number of bytes before the end of the indexed region that are hashed to
+# detect a file that was rewritten rather than appended to
+_TAIL_BYTES = 4096
+
+
+def _default_cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'userpackages',
+                        'spec_index')
+
+
+class SpecScanIndex(object):
+    """
+    On-disk index of the '#S' blocks of a SPEC file
+
+    The index is stored next to the SPEC file as '<spec_file>.scanidx'
+    or, when that directory is not writable, in a per-user cache
+    directory.  It records the byte offset of every scan together with the
+    scan header line, date and the motor names of the file header that
+    the scan belongs to.  The file size, mtime and a hash of the last
+    indexed bytes are stored with it so that a stale index is never used:
+    appended scans are indexed incrementally and anything else triggers a
+    full rebuild.
+
+    Parameters
+    ----------
+    spec_path : str
+        Path to the SPEC data file
+    index_path : str, optional
+        Where to keep the index. Defaults to the sidecar location.
+    """
+    def __init__(self, spec_path, index_path=None):
+        self.spec_path = os.path.abspath(spec_path)
+        if index_path is None:
+            index_path = self._default_index_path()
+        self.index_path = index_path
+        self._reset()
+
+    def _default_index_path(self):
+        sidecar = self.spec_path + '.scanidx'
+        if os.access(os.path.dirname(self.spec_path), os.W_OK):
+            return sidecar
+        digest = hashlib.sha1(self.spec_path.encode('utf-8')).hexdigest()
+        return os.path.join(_default_cache_dir(), digest + '.scanidx')
+
+    def _reset(self):
+        self.size = 0
+        self.mtime = None
+        self.indexed_to = 0
+        self.tail_hash = None
+        self.headers = []
+        self.scans = {}
+
+    def refresh(self):
+        """
+        Bring the index up to date with the SPEC file and save it
+
+        Returns
+        -------
+        self
+        """
+        stat = os.stat(self.spec_path)
+        if not self._load():
+            self._reset()
+        if self.size == stat.st_size and self.mtime == stat.st_mtime:
+            return self
+        if stat.st_size < self.indexed_to or not self._tail_matches():
+            logger.info('rebuilding scan index for %s', self.spec_path)
+            self._reset()
+        self._scan_from(self.indexed_to)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self._save()
+        return self
+
+    def offsets(self):
+        """
+        Dictionary of scan number -> byte offset of the '#S' line
+
+        If a scan number is repeated in the file the last occurrence wins.
+        """
+        return dict((scan_no, entry['offset'])
+                    for scan_no, entry in self.scans.items())
+
+    def metadata(self, scan_no):
+        """
+        Header metadata of one scan without reading the scan itself
+
+        Returns
+        -------
+        dict
+            'offset', 'command', 'date' and 'motors' of the scan
+        """
+        entry = dict(self.scans[scan_no])
+        header = entry.pop('header')
+        entry['motors'] = (list(self.headers[header]['motors'])
+                           if header is not None else [])
+        return entry
+
+    def _tail_matches(self):
+        if self.indexed_to == 0:
+            return True
+        return self._hash_tail(self.indexed_to) == self.tail_hash
+
+    def _hash_tail(self, end):
+        start = max(end - _TAIL_BYTES, 0)
+        with open(self.spec_path, 'rb') as f:
+            f.seek(start)
+            return hashlib.sha1(f.read(end - start)).hexdigest()
+
+    def _scan_from(self, offset):
+        header = len(self.headers) - 1 if self.headers else None
+        current = None
+        with open(self.spec_path, 'rb') as f:
+            f.seek(offset)
+            pos = offset
+            for line in iter(f.readline, b''):
+                if not line.endswith(b'\n'):
+                    # a line that is still being written by SPEC is picked
+                    # up on the next refresh
+                    break
+                if line.startswith(b'#F') or line.startswith(b'#E'):
+                    if line.startswith(b'#F') or header is None or \
+                            self.headers[header]['motors']:
+                        self.headers.append({'offset': pos, 'motors': []})
+                        header = len(self.headers) - 1
+                elif line.startswith(b'#O') and header is not None:
+                    motors = line.decode('latin-1').split(None, 1)
+                    if len(motors) > 1:
+                        self.headers[header]['motors'].extend(
+                            m.strip() for m in motors[1].rstrip('\r\n').split('  ')
+                            if m.strip())
+                elif line.startswith(b'#S'):
+                    fields = line.decode('latin-1').split(None, 2)
+                    scan_no = int(fields[1])
+                    current = {'offset': pos,
+                               'command': (fields[2].strip()
+                                           if len(fields) > 2 else ''),
+                               'date': None,
+                               'header': header}
+                    self.scans[scan_no] = current
+                elif line.startswith(b'#D') and current is not None and \
+                        current['date'] is None:
+                    current['date'] = line[2:].decode('latin-1').strip()
+                pos += len(line)
+        self.indexed_to = pos
+        self.tail_hash = self._hash_tail(pos) if pos else None
+
+    def _load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                stored = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if stored.get('version') != INDEX_VERSION or \
+                stored.get('spec_path') != self.spec_path:
+            return False
+        self.size = stored['size']
+        self.mtime = stored['mtime']
+        self.indexed_to = stored['indexed_to']
+        self.tail_hash = stored['tail_hash']
+        self.headers = stored['headers']
+        self.scans = dict((int(k), v) for k, v in stored['scans'].items())
+        return True
+
+    def _save(self):
+        stored = {'version': INDEX_VERSION,
+                  'spec_path': self.spec_path,
+                  'size': self.size,
+                  'mtime': self.mtime,
+                  'indexed_to': self.indexed_to,
+                  'tail_hash': self.tail_hash,
+                  'headers': self.headers,
+                  'scans': dict((str(k), v) for k, v in self.scans.items())}
+        try:
+            # concurrent readers never see a partial index
+            write_json(self.index_path, stored)
+        except (IOError, OSError) as err:
+            logger.warning('could not save scan index %s: %s',
+                           self.index_path, err)
+
+
+class IndexedSpecDataFile(SpecDataFile):
+    """
+    SpecDataFile that takes its scan offsets from a SpecScanIndex
+
+    pyspec's SpecDataFile.index() reads the entire file to find the '#S'
+    lines. This replaces that pass with the persistent index, so opening
+    a scan costs a single seek.
+    """
+    def index(self):
+        if getattr(self, 'file', None) is None:
+            self.file = open(self.filename, 'r')
+        self.scan_index = SpecScanIndex(self.filename).refresh()
+        self.findex = self.scan_index.offsets()
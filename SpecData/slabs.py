@@ -0,0 +1,230 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Out-of-core gridding into memory-mapped slabs
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import tempfile
+import numpy as np
+from .gridding import grid_axes, voxel_indices, bin_frames
+from .precision import DOUBLE
+
+# default budget, can be overridden with the SPECDATA_GRID_MB env variable
+DEFAULT_MEMORY_MB = 1024
+
+# working memory per voxel of a slab being binned: the three bincounts
+# and the three dirty accumulator pages
+BYTES_PER_VOXEL = 48
+# working memory per pixel of a chunk of frames: HKL, its transposed
+# copy, the voxel positions and the intensities
+BYTES_PER_PIXEL = 128
+
+
+def scratch_dir():
+    """
+    Directory the memory-mapped volumes are created in, SPECDATA_SCRATCH
+    or the system temporary directory
+    """
+    return os.environ.get('SPECDATA_SCRATCH') or tempfile.gettempdir()
+
+
+def default_memory_bytes():
+    return int(float(os.environ.get('SPECDATA_GRID_MB', DEFAULT_MEMORY_MB)) *
+               2 ** 20)
+
+
+class SlabGridAccumulator(object):
+    """
+    GridAccumulator whose sums live in memory-mapped files
+
+    The grid is split into slabs of whole H planes, which are contiguous
+    in the C ordered files. Each add() sorts its points by slab and bins
+    them one touched slab at a time, so the memory in use is one chunk of
+    points plus one slab of bincounts, whatever the number of bins. The
+    files are unlinked as soon as they are mapped where the OS allows it,
+    the disk space goes with the last array that maps them.
+
+    Parameters
+    ----------
+    qmin, qmax, bins : sequence
+        Grid definition, as for GridAccumulator
+    memory_bytes : int, optional
+        Working memory budget, half of it for a slab. Defaults to
+        SPECDATA_GRID_MB.
+    directory : str, optional
+        Where the files are created, defaults to scratch_dir()
+    """
+    def __init__(self, qmin, qmax, bins, memory_bytes=None, directory=None):
+        self.qmin = [float(q) for q in qmin]
+        self.qmax = [float(q) for q in qmax]
+        self.bins = [int(b) for b in bins]
+        if memory_bytes is None:
+            memory_bytes = default_memory_bytes()
+        self.memory_bytes = int(memory_bytes)
+        plane = self.bins[1] * self.bins[2]
+        self.slab_rows = int(min(max(self.memory_bytes // 2 //
+                                     (BYTES_PER_VOXEL * plane), 1),
+                                 self.bins[0]))
+        self.slab_voxels = self.slab_rows * plane
+        self.directory = directory or scratch_dir()
+        # files that could not be unlinked while mapped
+        self._paths = []
+        n_voxels = int(np.prod(self.bins))
+        self.sum = self._scratch('sum', np.float64, n_voxels)
+        self.sum_sq = self._scratch('sum_sq', np.float64, n_voxels)
+        self.occupancy = self._scratch('occupancy', np.int64, n_voxels)
+        self.out_of_bounds = 0
+        self.slab_passes = 0
+
+    def frames_per_chunk(self, n_pixels):
+        """
+        Frames of n_pixels binned per pass within the other half of the
+        memory budget
+        """
+        return int(max(self.memory_bytes // 2 //
+                       (BYTES_PER_PIXEL * max(n_pixels, 1)), 1))
+
+    def add(self, hkl, intensity):
+        """
+        Bin points with coordinates hkl (N x 3) and the given intensities
+        """
+        intensity = np.ravel(intensity).astype(np.float64, copy=False)
+        idx, inside = voxel_indices(hkl, self.qmin, self.qmax, self.bins)
+        intensity = intensity[inside]
+        self.out_of_bounds += inside.size - idx.size
+        if idx.size == 0:
+            return
+        slab = idx // self.slab_voxels
+        order = np.argsort(slab, kind='mergesort')
+        idx, slab, intensity = idx[order], slab[order], intensity[order]
+        bounds = np.flatnonzero(np.diff(slab)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, idx.size]):
+            start = int(slab[lo]) * self.slab_voxels
+            stop = min(start + self.slab_voxels, self.sum.size)
+            local = idx[lo:hi] - start
+            values = intensity[lo:hi]
+            n = stop - start
+            self.sum[start:stop] += np.bincount(local, weights=values,
+                                                minlength=n)
+            self.sum_sq[start:stop] += np.bincount(local,
+                                                   weights=values * values,
+                                                   minlength=n)
+            self.occupancy[start:stop] += np.bincount(local, minlength=n)
+            self.slab_passes += 1
+
+    def result(self, min_occupancy=0, precision=DOUBLE):
+        """
+        Gridded data in the layout of GridAccumulator.result(), with the
+        volumes memory-mapped and written one slab at a time in the dtypes
+        of precision. The meshes are read-only broadcast views of the axes.
+        """
+        shape = tuple(self.bins)
+        dtype = precision.output_dtype
+        occupancy = self.occupancy.reshape(shape)
+        if precision.compact_occupancy:
+            occupancy_dtype = np.min_scalar_type(
+                int(occupancy.max()) if occupancy.size else 0)
+        else:
+            occupancy_dtype = occupancy.dtype
+        I, E, raw = [self._scratch(name, dtype, shape)
+                     for name in ('masked_data', 'std_dev', 'raw_data')]
+        N = self._scratch('grid_occupancy', occupancy_dtype, shape)
+        sums = self.sum.reshape(shape)
+        sums_sq = self.sum_sq.reshape(shape)
+        for start in range(0, shape[0], self.slab_rows):
+            rows = slice(start, start + self.slab_rows)
+            occu = np.asarray(occupancy[rows])
+            hit = occu > 0
+            mean = np.zeros(occu.shape)
+            std_err = np.zeros(occu.shape)
+            mean[hit] = sums[rows][hit] / occu[hit]
+            std_err[hit] = np.sqrt(sums_sq[rows][hit]) / occu[hit]
+            keep = occu >= min_occupancy
+            raw[rows] = mean
+            I[rows] = mean * keep
+            E[rows] = std_err * keep
+            N[rows] = occu
+        for arr in (I, E, raw, N):
+            arr.flush()
+        X, Y, Z = [np.broadcast_to(a.astype(dtype).reshape(
+                       [-1 if i == j else 1 for j in range(3)]), shape)
+                   for i, a in enumerate(grid_axes(self.qmin, self.qmax,
+                                                   self.bins))]
+        return X, Y, Z, I, E, N, raw
+
+    def close(self):
+        """
+        Remove the files that could not be unlinked while mapped
+        """
+        for path in self._paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._paths = []
+
+    def _scratch(self, name, dtype, shape):
+        fd, path = tempfile.mkstemp(prefix='specdata_{0}_'.format(name),
+                                    suffix='.dat', dir=self.directory)
+        os.close(fd)
+        arr = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+        try:
+            # the mapping keeps the data, the name is not needed any more
+            os.remove(path)
+        except OSError:
+            self._paths.append(path)
+        return arr
+
+
+def grid_out_of_core(frames, angles, ub, wavelength, detector, qmin, qmax,
+                     bins, keep=None, memory_bytes=None, directory=None):
+    """
+    Grid a stack of frames into a SlabGridAccumulator, streaming the
+    frames in chunks sized to the memory budget. Pair it with a lazy
+    stack so that the frames are not held in memory either.
+
+    Returns
+    -------
+    SlabGridAccumulator
+    """
+    acc = SlabGridAccumulator(qmin, qmax, bins, memory_bytes=memory_bytes,
+                              directory=directory)
+    n_pixels = int(np.count_nonzero(keep)) if keep is not None else \
+        int(np.prod(frames.shape[1:]))
+    bin_frames(acc, frames, angles, ub, wavelength, detector, keep,
+               acc.frames_per_chunk(n_pixels))
+    return acc
@@ -0,0 +1,153 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Index based slicing of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import threading
+import numpy as np
+from .gridding import axis_range
+from .sparse import SparseGrid
+
+HKL = 'HKL'
+
+
+class GridSlicer(object):
+    """
+    Planes and slabs of a gridded volume
+
+    Bounds are located with gridding.axis_range on the axis vectors,
+    sub-volumes and axis vectors are views, and the projections over the
+    full extent of an axis are computed once per field and axis and then
+    shared by every later slice. Works on dense volumes and on SparseGrid.
+
+    Parameters
+    ----------
+    axes : sequence of ndarray
+        H, K and L axis vectors
+    volumes : dict, optional
+        Field name -> dense 3D array
+    sparse_grid : SparseGrid, optional
+        Sparse volume, used for any field not in volumes
+    """
+    def __init__(self, axes, volumes=None, sparse_grid=None):
+        self.axes = [np.asarray(a) for a in axes]
+        self.shape = tuple(len(a) for a in self.axes)
+        self.volumes = dict(volumes or {})
+        self.sparse_grid = sparse_grid
+        self._projections = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_grid(cls, grid):
+        """
+        Slicer of a Gridder result, a SparseGrid or a dense
+        (X, Y, Z, I, E, N) tuple
+        """
+        if isinstance(grid, SparseGrid):
+            return cls(grid.axes, sparse_grid=grid)
+        X, Y, Z, I, E, N = grid[:6]
+        return cls([X[:, 0, 0], Y[0, :, 0], Z[0, 0, :]],
+                   volumes={'masked_data': I, 'std_dev': E, 'occupancy': N})
+
+    def box(self, ranges=None):
+        """
+        [start, stop) bin indices of the bins that overlap ranges
+
+        Parameters
+        ----------
+        ranges : sequence, optional
+            [lo, hi] per axis, None for the whole axis
+        """
+        if ranges is None:
+            ranges = [None] * 3
+        box = []
+        for values, r in zip(self.axes, ranges):
+            if r is None:
+                box.append((0, len(values)))
+            else:
+                box.append(axis_range(values, r[0], r[1]))
+        return box
+
+    def axis_values(self, axis, box):
+        """
+        View of the axis vector inside box
+        """
+        return self.axes[axis][box[axis][0]:box[axis][1]]
+
+    def meshes(self, axis, box):
+        """
+        Meshes of the two in-plane axes of a plane normal to axis, in HKL
+        order, as broadcast views of the axis vectors
+        """
+        a, b = [i for i in range(3) if i != axis]
+        u = self.axis_values(a, box)
+        v = self.axis_values(b, box)
+        shape = (len(u), len(v))
+        return (np.broadcast_to(u[:, np.newaxis], shape),
+                np.broadcast_to(v[np.newaxis, :], shape))
+
+    def projection(self, name, axis):
+        """
+        Mean of a field over the full extent of axis, cached
+        """
+        key = (name, axis)
+        with self._lock:
+            if key not in self._projections:
+                if name in self.volumes:
+                    proj = np.asarray(self.volumes[name]).mean(axis)
+                else:
+                    proj = self.sparse_grid.slab_mean(name, axis, self.box())
+                self._projections[key] = proj
+            return self._projections[key]
+
+    def plane(self, name, axis, box):
+        """
+        Mean of a field over the slab box[axis] of axis, restricted to
+        the in-plane bins of box. A slab covering the whole axis is a view
+        of the cached projection.
+        """
+        others = [i for i in range(3) if i != axis]
+        if tuple(box[axis]) == (0, self.shape[axis]):
+            proj = self.projection(name, axis)
+            return proj[box[others[0]][0]:box[others[0]][1],
+                        box[others[1]][0]:box[others[1]][1]]
+        if name in self.volumes:
+            sub = self.volumes[name][box[0][0]:box[0][1],
+                                     box[1][0]:box[1][1],
+                                     box[2][0]:box[2][1]]
+            return np.asarray(sub).mean(axis)
+        return self.sparse_grid.slab_mean(name, axis, box)
@@ -0,0 +1,237 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Sparse (coordinate list) storage of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from .gridding import axis_range, grid_axes, voxel_indices
+
+# voxels held in pending chunk sums before they are folded together
+_MIN_COMPACT = 2 ** 20
+
+
+class SparseGrid(object):
+    """
+    Occupied voxels of a regular H, K, L grid
+
+    Only voxels with a non-zero occupancy are stored, as flat (C order)
+    voxel indices with one value per field, together with the three axis
+    vectors. Memory therefore scales with the number of occupied voxels,
+    not with the number of bins.
+
+    Parameters
+    ----------
+    axes : sequence of ndarray
+        H, K and L axis vectors
+    index : ndarray
+        Sorted flat indices of the occupied voxels
+    occupancy, mean, std_err : ndarray
+        Values of the occupied voxels
+    min_occupancy : int, optional
+        Voxels hit fewer times are zero in masked_data and std_dev
+    """
+    def __init__(self, axes, index, occupancy, mean, std_err,
+                 min_occupancy=0):
+        self.axes = [np.asarray(a) for a in axes]
+        self.shape = tuple(len(a) for a in self.axes)
+        self.index = index
+        self.occupancy = occupancy
+        self.mean = mean
+        self.std_err = std_err
+        self.min_occupancy = min_occupancy
+
+    @property
+    def nnz(self):
+        return self.index.size
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.index, self.occupancy, self.mean,
+                                      self.std_err] + self.axes)
+
+    def field(self, name):
+        """
+        Values of the occupied voxels for one of the Gridder outputs:
+        'masked_data', 'raw_data', 'std_dev' or 'occupancy'
+        """
+        if name == 'raw_data':
+            return self.mean
+        if name == 'occupancy':
+            return self.occupancy
+        keep = self.occupancy >= self.min_occupancy
+        if name == 'masked_data':
+            return self.mean * keep
+        if name == 'std_dev':
+            return self.std_err * keep
+        raise ValueError("unknown field '{0}'".format(name))
+
+    def coords(self):
+        """
+        (h, k, l) index arrays of the occupied voxels
+        """
+        return np.unravel_index(self.index, self.shape)
+
+    def to_dense(self, name='masked_data'):
+        out = np.zeros(self.shape, dtype=self.field(name).dtype)
+        out.flat[self.index] = self.field(name)
+        return out
+
+    def index_range(self, axis, lo, hi):
+        """
+        [start, stop) indices of the bins of axis that overlap [lo, hi]
+        """
+        return axis_range(self.axes[axis], lo, hi)
+
+    def slab_mean(self, name, axis, box):
+        """
+        Mean of a field over one axis inside a box of bins
+
+        Parameters
+        ----------
+        name : str
+            Field, see field()
+        axis : int
+            Axis averaged over
+        box : sequence
+            [start, stop) bin indices along H, K and L
+
+        Returns
+        -------
+        ndarray
+            2D array over the two other axes, empty voxels count as zero
+            exactly as in the mean of the dense grid
+        """
+        coords = self.coords()
+        inside = np.ones(self.nnz, dtype=bool)
+        for c, (start, stop) in zip(coords, box):
+            inside &= (c >= start) & (c < stop)
+        others = [i for i in range(3) if i != axis]
+        plane_shape = [box[i][1] - box[i][0] for i in others]
+        flat = ((coords[others[0]][inside] - box[others[0]][0]) *
+                plane_shape[1] +
+                coords[others[1]][inside] - box[others[1]][0])
+        total = np.bincount(flat, weights=self.field(name)[inside],
+                            minlength=plane_shape[0] * plane_shape[1])
+        depth = max(box[axis][1] - box[axis][0], 1)
+        return (total / depth).reshape(plane_shape)
+
+
+class SparseGridAccumulator(object):
+    """
+    GridAccumulator that only stores the voxels that were hit
+
+    Each added chunk is reduced to its own occupied voxels with np.unique
+    and the chunk sums are folded together once they outgrow the stored
+    voxels, so the cost stays proportional to the occupied voxels.
+    """
+    def __init__(self, qmin, qmax, bins):
+        self.qmin = [float(q) for q in qmin]
+        self.qmax = [float(q) for q in qmax]
+        self.bins = [int(b) for b in bins]
+        self.index = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros(0)
+        self.sum_sq = np.zeros(0)
+        self.occupancy = np.zeros(0, dtype=np.int64)
+        self.out_of_bounds = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def add(self, hkl, intensity):
+        intensity = np.ravel(intensity).astype(np.float64, copy=False)
+        idx, inside = voxel_indices(hkl, self.qmin, self.qmax, self.bins)
+        intensity = intensity[inside]
+        self.out_of_bounds += inside.size - idx.size
+        if idx.size == 0:
+            return
+        voxels, inverse = np.unique(idx, return_inverse=True)
+        inverse = np.ravel(inverse)
+        self._pending.append((voxels.astype(np.int64),
+                              np.bincount(inverse, weights=intensity),
+                              np.bincount(inverse,
+                                          weights=intensity * intensity),
+                              np.bincount(inverse)))
+        self._pending_size += voxels.size
+        if self._pending_size > max(self.index.size, _MIN_COMPACT):
+            self._compact()
+
+    def merge(self, other):
+        if (other.qmin, other.qmax, other.bins) != \
+                (self.qmin, self.qmax, self.bins):
+            raise ValueError('cannot merge accumulators of different grids')
+        other._compact()
+        self._pending.append((other.index, other.sum, other.sum_sq,
+                              other.occupancy))
+        self.out_of_bounds += other.out_of_bounds
+        self._compact()
+        return self
+
+    def _compact(self):
+        if not self._pending:
+            return
+        parts = [(self.index, self.sum, self.sum_sq, self.occupancy)]
+        parts += self._pending
+        index, sums, sums_sq, occupancy = [np.concatenate(p)
+                                           for p in zip(*parts)]
+        self.index, inverse = np.unique(index, return_inverse=True)
+        inverse = np.ravel(inverse)
+        self.sum = np.bincount(inverse, weights=sums)
+        self.sum_sq = np.bincount(inverse, weights=sums_sq)
+        self.occupancy = np.bincount(inverse,
+                                     weights=occupancy).astype(np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def sparse_result(self, min_occupancy=0):
+        """
+        SparseGrid of the mean, standard error and occupancy
+        """
+        self._compact()
+        return SparseGrid(grid_axes(self.qmin, self.qmax, self.bins),
+                          self.index, self.occupancy,
+                          self.sum / self.occupancy,
+                          np.sqrt(self.sum_sq) / self.occupancy,
+                          min_occupancy)
+
+    def result(self, min_occupancy=0):
+        """
+        Dense result, in the layout of GridAccumulator.result()
+        """
+        grid = self.sparse_result(min_occupancy)
+        X, Y, Z = np.meshgrid(*grid.axes, indexing='ij')
+        return (X, Y, Z, grid.to_dense('masked_data'),
+                grid.to_dense('std_dev'), grid.to_dense('occupancy'),
+                grid.to_dense('raw_data'))
@@ -0,0 +1,308 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Lazily evaluated image stacks for the SpecData package
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import collections
+import numbers
+import os
+import threading
+import numpy as np
+
+
+class LazyImageStack(object):
+    """
+    ndarray-like stack of 2D frames that are only read when indexed
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of frames in the stack
+    frame_shape : tuple
+        Shape of a single frame
+    load_frame : callable
+        load_frame(i) returns frame i as a 2D ndarray
+    dtype : numpy.dtype, optional
+        dtype of the decoded frames
+    cache_frames : int, optional
+        Number of decoded frames kept around for repeated access
+    """
+    def __init__(self, n_frames, frame_shape, load_frame, dtype=np.float64,
+                 cache_frames=16):
+        self._n_frames = int(n_frames)
+        self._frame_shape = tuple(frame_shape)
+        self._load_frame = load_frame
+        self.dtype = np.dtype(dtype)
+        self.cache_frames = cache_frames
+        self._cache = collections.OrderedDict()
+
+    @classmethod
+    def from_processor(cls, fp, dark=True, norm=True, dtype=np.float64,
+                       cache_frames=16):
+        """
+        Build a lazy stack from a pyspec FileProcessor without calling
+        FileProcessor.process()
+        """
+        return cls.from_loader(ProcessorFrameLoader(fp, dark=dark, norm=norm,
+                                                    dtype=dtype),
+                               cache_frames=cache_frames)
+
+    @classmethod
+    def from_loader(cls, load_frame, cache_frames=16):
+        """
+        Build a lazy stack from a frame loader with a len(), such as
+        ProcessorFrameLoader. The stack takes the shape and dtype of the
+        first frame, a loader without frames raises ValueError.
+        """
+        if len(load_frame) == 0:
+            raise ValueError('Cannot build an image stack from a scan '
+                             'without frames')
+        first = load_frame(0)
+        stack = cls(len(load_frame), first.shape, load_frame,
+                    dtype=first.dtype, cache_frames=cache_frames)
+        stack._remember(0, first)
+        return stack
+
+    @property
+    def shape(self):
+        return (self._n_frames,) + self._frame_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self._n_frames
+
+    def __repr__(self):
+        return '{0}(shape={1}, dtype={2})'.format(
+            self.__class__.__name__, self.shape, self.dtype)
+
+    def __iter__(self):
+        for i in range(self._n_frames):
+            yield self.frame(i)
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self.shape, dtype=self.dtype)
+        for start, block in self.iter_chunks():
+            out[start:start + len(block)] = block
+        if dtype is not None:
+            out = out.astype(dtype, copy=False)
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key[:1]):
+            return np.asarray(self)[key]
+        frame_key, rest = key[0], key[1:]
+        if isinstance(frame_key, numbers.Integral):
+            return self.frame(frame_key)[rest]
+        indices = self._frame_indices(frame_key)
+        if len(indices) == 0:
+            return np.empty((0,) + self._frame_shape,
+                            dtype=self.dtype)[(slice(None),) + rest]
+        return np.stack([self.frame(i)[rest] for i in indices])
+
+    def frame(self, i):
+        """
+        Return frame i, decoding it if it is not in the frame cache
+        """
+        i = int(i)
+        if i < 0:
+            i += self._n_frames
+        if not 0 <= i < self._n_frames:
+            raise IndexError('frame {0} is out of range for a stack of {1} '
+                             'frames'.format(i, self._n_frames))
+        try:
+            img = self._cache.pop(i)
+        except KeyError:
+            img = np.asarray(self._load_frame(i), dtype=self.dtype)
+        self._remember(i, img)
+        return img
+
+    def iter_chunks(self, chunk_size=16):
+        """
+        Yield (start, block) pairs of at most chunk_size frames
+
+        Chunks are decoded one at a time and bypass the frame cache so that
+        a full pass over the stack does not evict frames in active use.
+        """
+        chunk_size = max(int(chunk_size), 1)
+        for start in range(0, self._n_frames, chunk_size):
+            stop = min(start + chunk_size, self._n_frames)
+            block = np.empty((stop - start,) + self._frame_shape,
+                             dtype=self.dtype)
+            for j, i in enumerate(range(start, stop)):
+                img = self._cache.get(i)
+                if img is None:
+                    img = self._load_frame(i)
+                block[j] = img
+            yield start, block
+
+    def _frame_indices(self, frame_key):
+        if isinstance(frame_key, slice):
+            return range(*frame_key.indices(self._n_frames))
+        frame_key = np.asarray(frame_key)
+        if frame_key.dtype == bool:
+            return np.flatnonzero(frame_key)
+        return frame_key.ravel()
+
+    def _remember(self, i, img):
+        if self.cache_frames <= 0:
+            return
+        self._cache[i] = img
+        while len(self._cache) > self.cache_frames:
+            self._cache.popitem(last=False)
+
+
+def iter_blocks(frames, frames_per_chunk):
+    """
+    Yield (start, block) pairs of at most frames_per_chunk frames from an
+    ndarray or a LazyImageStack
+    """
+    if hasattr(frames, 'iter_chunks'):
+        for start, block in frames.iter_chunks(frames_per_chunk):
+            yield start, block
+        return
+    for start in range(0, len(frames), frames_per_chunk):
+        yield start, np.asarray(frames[start:start + frames_per_chunk])
+
+
+class ProcessorFrameLoader(object):
+    """
+    Decode single frames the way pyspec's FileProcessor.process() does
+
+    Each frame is the sum of the images taken at a scan point, minus the
+    matching dark image, divided by the monitor value of the point.  Dark
+    images are shared between many points so they are decoded once.
+    dark_for, a callable i -> dark image, replaces the per point darks of
+    the scan, e.g. with a master dark. A dtype of None keeps the dtype of
+    the files, which is only safe when modifies_frames() is False.
+    """
+    def __init__(self, fp, dark=True, norm=True, dtype=np.float64,
+                 dark_for=None):
+        self.fp = fp
+        self.dark = dark
+        self.dark_for = dark_for
+        self.dtype = dtype
+        self.filenames = list(fp.filenames)
+        darknames = getattr(fp, 'darkfilenames', None)
+        if darknames is None:
+            darknames = [None] * len(self.filenames)
+        self.darkfilenames = list(darknames)
+        self.norm_data = None
+        norm_data = getattr(fp, 'normData', None)
+        if norm and norm_data is not None:
+            norm_data = np.asarray(norm_data, dtype=np.float64)
+            if getattr(fp, 'meanMonitor', False):
+                norm_data = norm_data / norm_data.mean()
+            self.norm_data = norm_data
+        self._darks = {}
+        # frames decoded on several threads share the dark images
+        self._dark_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def modifies_frames(self):
+        """
+        True if frames are not the raw content of a single file: several
+        files summed, a dark subtracted or a monitor normalization
+        """
+        if self.norm_data is not None:
+            return True
+        if self.dark and (self.dark_for is not None or
+                          any(d is not None for d in self.darkfilenames)):
+            return True
+        return any(isinstance(names, (list, tuple)) and len(names) > 1
+                   for names in self.filenames)
+
+    def __call__(self, i):
+        image = self.read_image(self.filenames[i])
+        if image is None:
+            raise IOError('no image files found for frame {0}: {1}'
+                          ''.format(i, self.filenames[i]))
+        if self.dark:
+            if self.dark_for is not None:
+                darkimage = self.dark_for(i)
+            elif self.darkfilenames[i] is not None:
+                darkimage = self.read_dark(self.darkfilenames[i])
+            else:
+                darkimage = None
+            if darkimage is not None:
+                image -= darkimage
+        if self.norm_data is not None:
+            image /= self.norm_data[i]
+        return image
+
+    def read_dark(self, names):
+        """
+        Dark image of one or several files, decoded only once
+        """
+        key = tuple(names) if isinstance(names, list) else names
+        with self._dark_lock:
+            if key not in self._darks:
+                self._darks[key] = self.read_image(names)
+            return self._darks[key]
+
+    def read_image(self, names):
+        """
+        Sum of the raw images in names, None if none of them exist
+        """
+        if not isinstance(names, (list, tuple)):
+            names = [names]
+        image = None
+        for name in names:
+            if not os.path.exists(name):
+                continue
+            raw = self.fp._getRawImage(name)
+            if self.dtype is not None:
+                raw = raw.astype(self.dtype)
+            if image is None:
+                image = raw
+            else:
+                image += raw
+        return image
@@ -0,0 +1,173 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Incremental gridding of scans that are still being collected
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import logging
+import os
+import threading
+import numpy as np
+from pyspec.ccd.transformations import FileProcessor
+from .cache import ScanCache
+from .gridding import GridAccumulator, bin_frames
+from .scan_index import IndexedSpecDataFile
+from .stack import LazyImageStack, ProcessorFrameLoader
+logger = logging.getLogger(__name__)
+
+# default memory of the live grids, can be overridden with the
+# SPECDATA_STREAM_MB env variable
+DEFAULT_STREAM_MB = 1024
+
+# live streams, keyed by scan and grid, shared by all StreamingGridders.
+# Least recently updated streams are dropped once their grids outgrow the
+# budget, and a scan only keeps the stream of the grid it was last
+# gridded on.
+_streams = ScanCache(
+    int(os.environ.get('SPECDATA_STREAM_MB', DEFAULT_STREAM_MB)) * 2 ** 20)
+# scan -> key of its stream in _streams
+_scan_streams = {}
+_streams_lock = threading.Lock()
+
+
+def _frame_ready(names):
+    if not isinstance(names, (list, tuple)):
+        names = [names]
+    return all(os.path.exists(name) for name in names)
+
+
+class ScanStream(object):
+    """
+    Grid accumulator of one scan that only ingests new frames
+
+    Every update() re-reads the scan through the persistent scan index,
+    which only parses the part of the SPEC file appended since the last
+    update, and bins the points whose CCD files have appeared since then.
+    The cost of an update is therefore proportional to the number of new
+    frames, not to the length of the scan.
+
+    Parameters
+    ----------
+    spec_path : str
+        SPEC data file
+    ccd_path : str
+        Folder holding the CCD images
+    scan_no : int
+        Scan to follow
+    qmin, qmax, bins : sequence
+        Grid definition, see GridAccumulator
+    detector : geometry.Detector
+        Detector geometry
+    keep : ndarray, optional
+        2D boolean array of the detector pixels to grid
+    """
+    def __init__(self, spec_path, ccd_path, scan_no, qmin, qmax, bins,
+                 detector, keep=None):
+        self.spec_path = spec_path
+        self.ccd_path = ccd_path
+        self.scan_no = scan_no
+        self.detector = detector
+        self.keep = keep
+        self.accumulator = GridAccumulator(qmin, qmax, bins)
+        self.n_frames = 0
+        self.lock = threading.Lock()
+
+    def update(self):
+        """
+        Bin the frames that became available since the last update
+
+        Returns
+        -------
+        int
+            Number of frames ingested by this call
+        """
+        with self.lock:
+            sf = IndexedSpecDataFile(self.spec_path, ccdpath=self.ccd_path)
+            scan = sf[self.scan_no]
+            angles = np.atleast_2d(scan.getSIXCAngles())
+            fp = FileProcessor(spec=scan)
+            n_ready = self.n_frames
+            n_points = min(len(angles), len(fp.filenames))
+            while n_ready < n_points and \
+                    _frame_ready(fp.filenames[n_ready]):
+                n_ready += 1
+            if n_ready == self.n_frames:
+                return 0
+            load_frame = ProcessorFrameLoader(fp)
+            first = self.n_frames
+            new_frames = LazyImageStack(n_ready - first, self.detector.shape,
+                                        lambda i: load_frame(first + i),
+                                        cache_frames=0)
+            out_of_bounds = self.accumulator.out_of_bounds
+            bin_frames(self.accumulator, new_frames, angles[first:n_ready],
+                       scan.UB, scan.wavelength, self.detector, self.keep)
+            if self.accumulator.out_of_bounds > out_of_bounds:
+                logger.warning('%d pixels of frames %d-%d of scan %s fell '
+                               'outside the grid', self.accumulator.
+                               out_of_bounds - out_of_bounds, first,
+                               n_ready - 1, self.scan_no)
+            ingested = n_ready - self.n_frames
+            self.n_frames = n_ready
+            return ingested
+
+
+def get_stream(spec_path, ccd_path, scan_no, qmin, qmax, bins, detector,
+               keep=None, reset=False):
+    """
+    The live ScanStream for this scan and grid, created on first use
+
+    A stream of the same scan on another grid is dropped.
+    """
+    keep_key = None if keep is None else \
+        (keep.shape, np.packbits(keep).tobytes())
+    scan = (os.path.abspath(spec_path), ccd_path, scan_no)
+    key = scan + (tuple(qmin), tuple(qmax), tuple(bins), detector.key(),
+                  keep_key)
+    with _streams_lock:
+        previous = _scan_streams.get(scan)
+        if previous is not None and previous != key:
+            _streams.discard(previous)
+        _scan_streams[scan] = key
+        stream = None if reset else _streams.get(key)
+        if stream is None:
+            stream = _streams.put(key, ScanStream(spec_path, ccd_path,
+                                                  scan_no, qmin, qmax, bins,
+                                                  detector, keep))
+        # forget the scans whose streams were evicted
+        for other, other_key in list(_scan_streams.items()):
+            if other_key not in _streams:
+                del _scan_streams[other]
+        return stream
@@ -0,0 +1,162 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the batch loading of dark corrected scans
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('pyspec.ccd.transformations')
+from .. import batch  # noqa: E402
+from ..batch import ScanSeries, frame_exposures, master_darks  # noqa: E402
+
+SHAPE = (4, 3)
+
+
+class Scan(object):
+    """
+    The frame and dark file names and counters of a pyspec scan
+    """
+    def __init__(self, files, darks, seconds=None, delay=0):
+        self.files = files
+        self.darks = darks
+        if seconds is not None:
+            self.Seconds = np.array(seconds, dtype=float)
+        self.delay = delay
+
+
+class FileProcessor(object):
+    """
+    FileProcessor reading the frames of a Scan from .npy files
+    """
+    def __init__(self, spec):
+        time.sleep(spec.delay)
+        self.filenames = spec.files
+        self.darkfilenames = spec.darks
+        self.normData = None
+
+    def _getRawImage(self, name):
+        return np.load(name)
+
+
+class SpecFile(object):
+    def __init__(self, filename, scans):
+        self.filename = filename
+        self.ccdpath = None
+        self.scans = scans
+
+    def __getitem__(self, scan_no):
+        return self.scans[scan_no]
+
+
+@pytest.fixture
+def spec_file(tmpdir, monkeypatch):
+    """
+    Writes images with the value of their name and builds scans of them
+    """
+    monkeypatch.setattr(batch, 'FileProcessor', FileProcessor)
+    master_darks.clear()
+
+    def image(value):
+        path = str(tmpdir.join('{0}.npy'.format(value)))
+        np.save(path, np.full(SHAPE, value, dtype=np.uint16))
+        return path
+
+    def make(scans):
+        return SpecFile(str(tmpdir.join('scans.spec')), dict(
+            (scan_no, Scan([image(f) for f in frames],
+                           [image(d) for d in darks], seconds, delay))
+            for scan_no, (frames, darks, seconds, delay)
+            in scans.items()))
+    yield make
+    master_darks.clear()
+
+
+def test_one_master_dark_per_exposure(spec_file):
+    sf = spec_file({
+        1: ([1000, 1001, 1002, 1003], [10, 20, 100, 300], [1, 1, 2, 2], 0),
+        # its own darks are ignored, the masters of scan 1 are reused
+        2: ([2000, 2001], [50, 60], [2, 1], 0)})
+    stacks = dict(ScanSeries(sf, [1, 2], n_workers=1))
+    np.testing.assert_allclose(stacks[1][:, 0, 0],
+                               [1000 - 15, 1001 - 15, 1002 - 200,
+                                1003 - 200])
+    np.testing.assert_allclose(stacks[2][:, 0, 0], [2000 - 200, 2001 - 15])
+    assert stacks[1].shape == (4,) + SHAPE
+    assert len(master_darks) == 2
+
+
+def test_scans_without_exposures_share_one_master_dark(spec_file):
+    sf = spec_file({1: ([500, 501], [10, 30], None, 0)})
+    assert frame_exposures(sf[1], 2) == [None, None]
+    [(scan_no, stack)] = list(ScanSeries(sf, [1]))
+    assert scan_no == 1
+    np.testing.assert_allclose(stack[:, 0, 0], [480, 481])
+
+
+def test_darks_are_optional(spec_file):
+    sf = spec_file({1: ([500, 501], [10, 30], [1, 1], 0)})
+    [(_, stack)] = list(ScanSeries(sf, [1], has_dark=False))
+    np.testing.assert_allclose(stack[:, 0, 0], [500, 501])
+    assert len(master_darks) == 0
+
+
+def test_series_in_the_order_of_scan_numbers(spec_file):
+    # the first scans load slowest, the series keeps the requested order
+    sf = spec_file(dict(
+        (scan_no, ([100 * scan_no], [scan_no], None, delay))
+        for scan_no, delay in [(4, 0.2), (2, 0.1), (7, 0), (1, 0), (3, 0)]))
+    loaded = []
+
+    class Recording(ScanSeries):
+        def load(self, scan_no):
+            loaded.append(scan_no)
+            return ScanSeries.load(self, scan_no)
+
+    series = Recording(sf, [4, 2, 7, 1, 3], has_dark=False, n_workers=2)
+    assert len(series) == 5
+    order = []
+    for consumed, (scan_no, stack) in enumerate(series, 1):
+        # at most n_workers scans loaded ahead of the consumer
+        assert len(loaded) <= consumed + 2
+        order.append(scan_no)
+        assert stack[0, 0, 0] == 100 * scan_no
+    assert order == [4, 2, 7, 1, 3]
+    # a second pass loads every scan again
+    assert [scan_no for scan_no, _ in series] == order
+    assert len(loaded) == 10
@@ -0,0 +1,110 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the scan cache and its size estimates
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import numpy as np
+from ..cache import (ScanCache, file_stamp, nbytes_of, scan_key,
+                     spec_file_nbytes)
+
+
+class Holder(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_nbytes_of_counts_shared_memory_once():
+    arr = np.zeros(1000)
+    obj = Holder(data=arr, view=arr[::2], more=[arr, {'a': arr[10:]}])
+    assert nbytes_of(obj) == arr.nbytes
+    assert nbytes_of(obj, np.zeros(10)) == arr.nbytes + 80
+
+
+def test_least_recently_used_entry_goes_first():
+    cache = ScanCache(300)
+    for key in 'abc':
+        cache.put(key, np.zeros(10))
+    # a is used again, b is now the oldest
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(10))
+    assert 'b' not in cache
+    assert set('acd') <= set(k for k in 'abcd' if k in cache)
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['nbytes'] == 240
+
+
+def test_entry_larger_than_the_budget_is_kept_alone():
+    cache = ScanCache(100)
+    cache.put('a', np.zeros(5))
+    cache.put('b', np.zeros(50))
+    assert len(cache) == 1 and 'b' in cache
+
+
+def test_update_nbytes_evicts_grown_entries():
+    cache = ScanCache(1000)
+    cache.put('a', None, nbytes=100)
+    cache.put('b', None, nbytes=100)
+    cache.update_nbytes('b', 950)
+    assert 'a' not in cache
+    assert cache.nbytes == 950
+
+
+def test_spec_file_nbytes():
+    scan = Holder(data=np.zeros((10, 4)), scandata={'x': np.zeros(10)},
+                  header='#S 1 ascan\n', comments='')
+    sf = Holder(findex={1: 0, 2: 500}, header='#F file\n',
+                scandata={1: scan})
+    assert spec_file_nbytes(sf) == (2 * 100 + len(sf.header) +
+                                   320 + 80 + len(scan.header))
+    assert spec_file_nbytes(Holder()) == 0
+
+
+def test_file_stamp_follows_the_content(tmpdir):
+    path = str(tmpdir.join('scan.spec'))
+    tmpdir.join('scan.spec').write('#S 1 ascan\n')
+    stamp = file_stamp(path)
+    # touching keeps the stamp, a same size rewrite with the same mtime
+    # changes it
+    os.utime(path, (0, 0))
+    assert file_stamp(path) == stamp
+    tmpdir.join('scan.spec').write('#S 2 ascan\n')
+    os.utime(path, (0, 0))
+    assert file_stamp(path) != stamp
+    key = scan_key(path, 'ccd', 2, True)
+    assert key == (path, file_stamp(path), 'ccd', 2, True)
@@ -0,0 +1,100 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the 2D detector mask
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..geometry import DetectorMask
+
+SHAPE = (6, 5)
+
+
+def test_default_keeps_every_pixel():
+    mask = DetectorMask(SHAPE)
+    assert mask.keeps_all()
+    assert mask.n_pixels == 30
+
+
+def test_crop_roi_and_bad_pixels():
+    bad = np.zeros(SHAPE, dtype=np.uint8)
+    bad[2, 2] = 1
+    bad[0, 0] = 1
+    mask = DetectorMask(SHAPE, crop=[1, 0, 1, 1], roi=[0, 4, 1, 5],
+                        bad_pixels=bad)
+    expected = np.zeros(SHAPE, dtype=bool)
+    # rows 1-4 and columns 0-3 after the crop, rows 0-3 and columns 1-4
+    # inside the ROI
+    expected[1:4, 1:4] = True
+    expected[2, 2] = False
+    np.testing.assert_array_equal(mask.keep, expected)
+    assert mask.n_pixels == 8
+    assert not mask.keeps_all()
+
+
+def test_apply_keeps_the_same_pixels_of_every_frame():
+    mask = DetectorMask(SHAPE, crop=[1, 1, 1, 1])
+    frames = np.arange(3 * 30).reshape((3,) + SHAPE)
+    kept = mask.apply(frames)
+    assert kept.shape == (3, 12)
+    np.testing.assert_array_equal(kept, frames[:, 1:5, 1:4].reshape(3, -1))
+    np.testing.assert_array_equal(mask.apply(frames[0]), kept[0])
+
+
+def test_masked_stack_is_a_view_of_the_2d_mask():
+    mask = DetectorMask(SHAPE, roi=[0, 2, 0, 2])
+    stack = mask.masked_stack(1000)
+    assert stack.shape == (1000,) + SHAPE
+    assert stack.strides[0] == 0
+    np.testing.assert_array_equal(stack[999], ~mask.keep)
+
+
+def test_keys_follow_the_kept_pixels():
+    assert DetectorMask(SHAPE).key() == DetectorMask(SHAPE).key()
+    assert DetectorMask(SHAPE).key() != \
+        DetectorMask(SHAPE, crop=[0, 0, 1, 0]).key()
+
+
+def test_bad_pixels_of_another_shape_are_refused():
+    with pytest.raises(ValueError):
+        DetectorMask(SHAPE, bad_pixels=np.zeros((5, 6)))
+
+
+@pytest.mark.parametrize('shape', [(5, 6), (3, 6, 4), (30,)])
+def test_frames_of_another_shape_are_refused(shape):
+    with pytest.raises(ValueError):
+        DetectorMask(SHAPE).apply(np.zeros(shape))
@@ -0,0 +1,137 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the on-disk store of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import numpy as np
+import pytest
+from ..grid_store import GridStore, grid_key
+from ..gridding import GridAccumulator
+from ..sparse import SparseGrid, SparseGridAccumulator
+
+
+def gridded(accumulator=GridAccumulator, bins=(4, 5, 6), seed=7):
+    rng = np.random.RandomState(seed)
+    acc = accumulator([0, 0, 0], [1, 1, 1], bins)
+    acc.add(rng.uniform(0, 1, (500, 3)), rng.uniform(0, 10, 500))
+    return acc
+
+
+def test_grid_key():
+    key = grid_key(scan=3, bins=[4, 5, 6], ub=np.eye(3))
+    assert len(key) == 40
+    assert key == grid_key(bins=[4, 5, 6], scan=3, ub=np.eye(3))
+    assert key != grid_key(scan=3, bins=[4, 5, 6], ub=2 * np.eye(3))
+
+
+def test_dense_round_trip(tmpdir):
+    store = GridStore(str(tmpdir), max_bytes=2 ** 20)
+    grid = gridded().result()
+    store.put('a' * 40, grid, scan=3)
+    loaded = store.get('a' * 40)
+    for saved, original in zip(loaded, grid):
+        np.testing.assert_array_equal(saved, original)
+    assert isinstance(loaded[3], np.memmap)
+    entries = store.entries()
+    assert [e['key'] for e in entries] == ['a' * 40]
+    assert entries[0]['info'] == {'scan': 3}
+    assert store.get('b' * 40) is None
+
+
+def test_sparse_round_trip(tmpdir):
+    store = GridStore(str(tmpdir), max_bytes=2 ** 20)
+    grid = gridded(SparseGridAccumulator).sparse_result(2)
+    store.put('c' * 40, grid)
+    loaded = store.get('c' * 40)
+    assert isinstance(loaded, SparseGrid)
+    assert loaded.min_occupancy == 2
+    for name in ('masked_data', 'std_dev', 'occupancy'):
+        np.testing.assert_array_equal(loaded.to_dense(name),
+                                      grid.to_dense(name))
+
+
+def test_least_recently_used_grids_are_evicted(tmpdir):
+    grid = gridded().result()
+    nbytes = sum(a.nbytes for a in grid[3:]) + 4 * 8 + 5 * 8 + 6 * 8
+    store = GridStore(str(tmpdir), max_bytes=2 * nbytes)
+    store.put('a' * 40, grid)
+    store.put('b' * 40, grid)
+    assert store.total_bytes() == 2 * nbytes
+    store.put('c' * 40, grid)
+    assert sorted(e['key'] for e in store.entries()) == ['b' * 40, 'c' * 40]
+
+
+def test_grid_larger_than_the_store_is_not_saved(tmpdir):
+    store = GridStore(str(tmpdir), max_bytes=100)
+    store.put('a' * 40, gridded().result())
+    assert store.entries() == []
+
+
+def test_purge(tmpdir):
+    store = GridStore(str(tmpdir), max_bytes=2 ** 20)
+    for key in ('a' * 40, 'b' * 40):
+        store.put(key, gridded().result())
+    assert store.purge('a' * 40) == 1
+    assert [e['key'] for e in store.entries()] == ['b' * 40]
+    assert store.purge() == 1
+    assert store.entries() == []
+
+
+@pytest.mark.parametrize('key', ['..', '../grids', 'a' * 39, 'A' * 40, ''])
+def test_purge_refuses_other_paths(tmpdir, key):
+    store = GridStore(str(tmpdir.join('store')), max_bytes=2 ** 20)
+    store.put('a' * 40, gridded().result())
+    with pytest.raises(ValueError):
+        store.purge(key)
+    assert len(store.entries()) == 1
+
+
+def test_purge_refuses_unknown_keys(tmpdir):
+    store = GridStore(str(tmpdir), max_bytes=2 ** 20)
+    with pytest.raises(ValueError):
+        store.purge('d' * 40)
+
+
+def test_purge_does_not_follow_links_out_of_the_store(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    outside.join('data').write('keep')
+    store = GridStore(str(tmpdir.mkdir('store')), max_bytes=2 ** 20)
+    os.symlink(str(outside), os.path.join(store.root, 'e' * 40))
+    with pytest.raises(ValueError):
+        store.purge('e' * 40)
+    assert outside.join('data').check()
@@ -0,0 +1,289 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the numpy gridder against hand computed HKL and pyspec's ctrans
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..geometry import Detector, frame_hkl
+from ..gridding import (GridAccumulator, auto_bins, auto_grid, axis_range,
+                        grid_axes, grid_parallel, voxel_indices)
+from ..sparse import SparseGridAccumulator
+
+QMIN = [-0.5, -1.0, 0.0]
+QMAX = [0.5, 1.0, 3.0]
+BINS = [5, 8, 12]
+LATTICE = 4.0
+WAVELENGTH = 1.5
+
+
+def cubic_ub(a=LATTICE):
+    return np.eye(3) * 2 * np.pi / a
+
+
+def synthetic_scan(n_frames=6, shape=(16, 12), seed=0):
+    """
+    Theta scan through the (0 0 2) reflection of a cubic crystal
+    """
+    rng = np.random.RandomState(seed)
+    theta = np.degrees(np.arcsin(WAVELENGTH / LATTICE))
+    angles = np.zeros((n_frames, 6))
+    angles[:, 0] = 2 * theta
+    angles[:, 1] = theta + np.linspace(-1, 1, n_frames)
+    angles[:, 2] = 90
+    frames = rng.poisson(100, (n_frames,) + shape).astype(np.uint16)
+    detector = Detector.from_ccd_size(shape, dist=355.0)
+    return frames, angles, detector
+
+
+def reference_grid(hkl, intensity, qmin, qmax, bins):
+    """
+    Unbuffered voxel sums with np.add.at
+    """
+    idx, inside = voxel_indices(hkl, qmin, qmax, bins)
+    intensity = np.ravel(intensity).astype(np.float64)[inside]
+    n_voxels = int(np.prod(bins))
+    total = np.zeros(n_voxels)
+    total_sq = np.zeros(n_voxels)
+    occupancy = np.zeros(n_voxels, dtype=np.int64)
+    np.add.at(total, idx, intensity)
+    np.add.at(total_sq, idx, intensity ** 2)
+    np.add.at(occupancy, idx, 1)
+    return total, total_sq, occupancy
+
+
+def test_grid_axes_are_lower_voxel_edges():
+    # pyspec's getGridMesh: Qmin + i * (Qmax - Qmin) / dQN
+    for axis, lo, hi, n in zip(grid_axes(QMIN, QMAX, BINS), QMIN, QMAX, BINS):
+        assert len(axis) == n
+        np.testing.assert_allclose(axis, lo + np.arange(n) * (hi - lo) / n)
+
+
+def test_axis_values_fall_in_their_own_voxel():
+    X, Y, Z = np.meshgrid(*grid_axes(QMIN, QMAX, BINS), indexing='ij')
+    # nudge the edges inside the voxel against rounding
+    step = (np.array(QMAX) - QMIN) / BINS
+    hkl = np.column_stack([X.ravel(), Y.ravel(), Z.ravel()]) + 1e-9 * step
+    idx, inside = voxel_indices(hkl, QMIN, QMAX, BINS)
+    assert inside.all()
+    np.testing.assert_array_equal(idx, np.arange(X.size))
+
+
+def test_axis_range_includes_partially_covered_voxels():
+    axis = grid_axes([0.0], [1.0], [10])[0]
+    # 0.25 lies in voxel 2 ([0.2, 0.3)), 0.45 in voxel 4
+    assert axis_range(axis, 0.25, 0.45) == (2, 5)
+    assert axis_range(axis, -1.0, 2.0) == (0, 10)
+
+
+@pytest.mark.parametrize('n_points', [10, 5000])
+def test_add_matches_unbuffered_sums(n_points):
+    # 10 points take the touched-voxels path, 5000 the full bincounts
+    rng = np.random.RandomState(n_points)
+    hkl = rng.uniform(-0.2, 1.2, (n_points, 3)) * \
+        (np.array(QMAX) - QMIN) + QMIN
+    # repeated points hit the same voxel several times in one chunk
+    hkl[1::2] = hkl[::2][:len(hkl[1::2])]
+    intensity = rng.uniform(0, 10, n_points)
+    acc = GridAccumulator(QMIN, QMAX, BINS)
+    acc.add(hkl, intensity)
+    total, total_sq, occupancy = reference_grid(hkl, intensity, QMIN, QMAX,
+                                                BINS)
+    np.testing.assert_allclose(acc.sum, total)
+    np.testing.assert_allclose(acc.sum_sq, total_sq)
+    np.testing.assert_array_equal(acc.occupancy, occupancy)
+    assert acc.out_of_bounds == n_points - occupancy.sum()
+
+
+def test_frame_hkl_of_bragg_pixel():
+    # with chi = 90 the scattering vector of the centre pixel lies along
+    # L, |Q| = 2 sin(theta) / wavelength in reciprocal lattice units of a
+    detector = Detector.from_ccd_size((64, 64))
+    theta = 20.0
+    hkl = frame_hkl(detector, [2 * theta, theta, 90, 0, 0, 0], cubic_ub(),
+                    WAVELENGTH)
+    centre = int(detector.cen_x) * 64 + int(detector.cen_y)
+    expected = [0, 0, 2 * LATTICE * np.sin(np.radians(theta)) / WAVELENGTH]
+    np.testing.assert_allclose(hkl[centre], expected, atol=1e-12)
+
+
+def test_frame_hkl_at_zero_angles():
+    # all circles at zero: hkl = a / wavelength * (d - y) for direction d
+    detector = Detector.from_ccd_size((8, 6))
+    hkl = frame_hkl(detector, np.zeros(6), cubic_ub(), WAVELENGTH)
+    d = detector.pixel_directions().T
+    expected = LATTICE / WAVELENGTH * (d - [0, 1, 0])
+    np.testing.assert_allclose(hkl, expected, atol=1e-12)
+
+
+def test_synthetic_scan_against_hand_computed_hkl():
+    frames, angles, detector = synthetic_scan()
+    qmin, qmax, bins = [-0.3, -0.3, 1.6], [0.3, 0.3, 2.4], [6, 6, 8]
+    hkl = np.concatenate([frame_hkl(detector, a, cubic_ub(), WAVELENGTH)
+                          for a in angles])
+    total, _, occupancy = reference_grid(hkl, frames, qmin, qmax, bins)
+    for accumulator in (GridAccumulator, SparseGridAccumulator):
+        X, Y, Z, I, E, N, raw = grid_parallel(
+            frames, angles, cubic_ub(), WAVELENGTH, detector, qmin, qmax,
+            bins, frames_per_chunk=2, accumulator=accumulator).result()
+        np.testing.assert_array_equal(N.ravel(), occupancy)
+        hit = occupancy > 0
+        assert hit.any()
+        np.testing.assert_allclose(raw.ravel()[hit],
+                                   total[hit] / occupancy[hit])
+
+
+def test_synthetic_scan_against_pyspec():
+    ctrans = pytest.importorskip('pyspec.ccd.ctrans')
+    frames, angles, detector = synthetic_scan()
+    qmin, qmax, bins = [-0.3, -0.3, 1.6], [0.3, 0.3, 2.4], [6, 6, 8]
+    # mode 4 is HKL, as in pyspec's ImageProcessor
+    tot_set = ctrans.ccdToQ(
+        angles=angles * np.pi / 180.0, mode=4,
+        ccd_size=(detector.size_x, detector.size_y),
+        ccd_pixsize=(detector.pix_size_x, detector.pix_size_y),
+        ccd_cen=(detector.cen_x, detector.cen_y), dist=detector.dist,
+        wavelength=WAVELENGTH, UBinv=np.linalg.inv(cubic_ub()))
+    tot_set[:, 3] = np.ravel(frames)
+    data, occupancy, std_err, n_out = ctrans.grid3d(tot_set, qmin, qmax,
+                                                    bins, norm=1)
+    X, Y, Z, I, E, N, raw = grid_parallel(
+        frames, angles, cubic_ub(), WAVELENGTH, detector, qmin, qmax,
+        bins).result()
+    np.testing.assert_array_equal(N, occupancy)
+    np.testing.assert_allclose(raw, data, rtol=1e-9)
+    np.testing.assert_allclose(E, std_err, rtol=1e-9)
+
+
+@pytest.mark.parametrize('accumulator', [GridAccumulator,
+                                         SparseGridAccumulator])
+@pytest.mark.parametrize('n_workers', [2, 3])
+def test_parallel_gridding_matches_serial(accumulator, n_workers):
+    frames, angles, detector = synthetic_scan(n_frames=7)
+    qmin, qmax, bins = [-0.3, -0.3, 1.6], [0.3, 0.3, 2.4], [6, 6, 8]
+    keep = np.ones(frames.shape[1:], dtype=bool)
+    keep[:3] = False
+    keep[5, 4] = False
+    for mask in (None, keep):
+        serial, parallel = [grid_parallel(
+            frames, angles, cubic_ub(), WAVELENGTH, detector, qmin, qmax,
+            bins, n_workers=workers, frames_per_chunk=2, keep=mask,
+            accumulator=accumulator).result(min_occupancy=2)
+            for workers in (1, n_workers)]
+        assert serial[5].any()
+        for s, p in zip(serial, parallel):
+            np.testing.assert_allclose(p, s, rtol=1e-12)
+
+
+@pytest.mark.parametrize('max_voxels', [1, 10, 1000, 10 ** 6])
+def test_auto_bins_fill_the_budget_with_cubes(max_voxels):
+    qmin, qmax = [0., -1., 2.], [0.5, 1., 3.]
+    bins = auto_bins(qmin, qmax, max_voxels)
+    assert 1 <= np.prod(bins) <= max_voxels
+    if max_voxels == 10 ** 6:
+        sides = (np.subtract(qmax, qmin)) / bins
+        # roughly cubic voxels that use most of the budget
+        assert sides.max() / sides.min() < 1.1
+        assert np.prod(bins) > max_voxels / 2
+
+
+def test_auto_bins_with_a_voxel_size():
+    assert auto_bins([0, 0, 0], [1, 0.5, 0.25], 10 ** 6,
+                     voxel_size=0.1) == [10, 5, 3]
+    # too fine for the budget, coarsened to fit it
+    bins = auto_bins([0, 0, 0], [1, 0.5, 0.25], 100, voxel_size=0.001)
+    assert np.prod(bins) <= 100
+
+
+@pytest.mark.parametrize('qmax', [[1., 1., 0.], [1., 0., 0.], [0., 0., 0.]])
+def test_auto_bins_of_zero_width_axes(qmax):
+    bins = auto_bins([0., 0., 0.], qmax, 1000)
+    for q, b in zip(qmax, bins):
+        assert b >= 1
+        if q == 0:
+            assert b == 1
+    assert np.prod(bins) <= 1000
+    if qmax == [1., 0., 0.]:
+        # the whole budget goes to the only axis with an extent
+        assert bins == [1000, 1, 1]
+
+
+def test_auto_grid_fits_the_scan():
+    frames, angles, detector = synthetic_scan()
+    keep = np.ones(frames.shape[1:], dtype=bool)
+    keep[:, :2] = False
+    qmin, qmax, bins = auto_grid(angles, cubic_ub(), WAVELENGTH, detector,
+                                 keep=keep, memory_bytes=80 * 500,
+                                 bytes_per_voxel=80)
+    hkl = np.concatenate([frame_hkl(detector, a, cubic_ub(), WAVELENGTH,
+                                    keep) for a in angles])
+    # tight around the data, every point inside the grid
+    extent = hkl.max(0) - hkl.min(0)
+    np.testing.assert_allclose(qmin, hkl.min(0), atol=1e-6 * extent.max())
+    np.testing.assert_allclose(qmax, hkl.max(0), atol=1e-6 * extent.max())
+    _, inside = voxel_indices(hkl, qmin, qmax, bins)
+    assert inside.all()
+    assert np.prod(bins) <= 500
+
+
+def test_auto_grid_is_no_finer_than_the_data():
+    frames, angles, detector = synthetic_scan()
+    n_points = frames.size
+    _, _, bins = auto_grid(angles, cubic_ub(), WAVELENGTH, detector,
+                           memory_bytes=2 ** 40, min_occupancy=4)
+    assert np.prod(bins) <= n_points // 4
+
+
+def test_auto_grid_of_a_single_point():
+    frames, angles, detector = synthetic_scan(n_frames=1)
+    keep = np.zeros(frames.shape[1:], dtype=bool)
+    keep[3, 4] = True
+    qmin, qmax, bins = auto_grid(angles, cubic_ub(), WAVELENGTH, detector,
+                                 keep=keep)
+    assert bins == [1, 1, 1]
+    hkl = frame_hkl(detector, angles[0], cubic_ub(), WAVELENGTH, keep)
+    _, inside = voxel_indices(hkl, qmin, qmax, bins)
+    assert inside.all()
+
+
+def test_auto_grid_without_pixels_is_refused():
+    frames, angles, detector = synthetic_scan()
+    with pytest.raises(ValueError):
+        auto_grid(angles, cubic_ub(), WAVELENGTH, detector,
+                  keep=np.zeros(frames.shape[1:], dtype=bool))
+    with pytest.raises(ValueError):
+        auto_grid(angles[:0], cubic_ub(), WAVELENGTH, detector)
@@ -0,0 +1,173 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the per-module execution metrics
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('vistrails')
+from vistrails.core.modules.vistrails_module import Module  # noqa: E402
+from vistrails.core.modules.config import IPort, OPort  # noqa: E402
+from .. import metrics  # noqa: E402
+from ..metrics import (METRICS_PORT, MetricsRecorder,  # noqa: E402
+                       describe_value, instrument)
+
+
+class Value(object):
+    """
+    Input port connection that hands a fixed value to a module
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+    def get_raw(self):
+        return self.value
+
+
+def module_classes():
+    """
+    A module, a subclass without its own compute() and a port type
+    """
+    class Scale(Module):
+        _input_ports = [IPort(name="x", signature="basic:List")]
+        _output_ports = [OPort(name="y", signature="basic:List")]
+
+        def compute(self):
+            if self.force_get_input("fail", False):
+                raise ValueError('asked to fail')
+            y = np.asarray(self.get_input("x")) * 2.
+            self.set_output("y", y)
+            return y
+
+    class Triple(Scale):
+        def compute(self):
+            return Scale.compute(self) * 1.5
+
+    class Inherits(Scale):
+        pass
+
+    class PortType(Module):
+        pass
+    return Scale, Triple, Inherits, PortType
+
+
+def run(module_class, **inputs):
+    module = module_class()
+    for port, value in inputs.items():
+        module.set_input_port(port, Value(value))
+    return module, module.compute()
+
+
+@pytest.fixture
+def recorder(tmpdir, monkeypatch):
+    path = str(tmpdir.join('metrics.jsonl'))
+    monkeypatch.setattr(metrics, 'recorder', MetricsRecorder(True, path))
+    return path
+
+
+def test_instrument_adds_one_metrics_port():
+    Scale, Triple, Inherits, PortType = instrument(module_classes())
+    assert Scale._output_ports[-1] == METRICS_PORT
+    # inherited, not added again
+    assert 'metrics' not in [p.name for p in Triple.__dict__.get(
+        '_output_ports', [])]
+    assert '_output_ports' not in vars(Inherits)
+    assert Scale.compute.metered and Triple.compute.metered
+    assert 'compute' not in vars(Inherits)
+    assert '_output_ports' not in vars(PortType)
+    # instrumenting twice changes nothing
+    compute = Scale.compute
+    instrument([Scale])
+    assert Scale.compute is compute
+    assert Scale._output_ports.count(METRICS_PORT) == 1
+
+
+def test_metered_compute_returns_its_result_and_records(recorder):
+    Scale, Triple, _, _ = instrument(module_classes())
+    module, result = run(Scale, x=[1., 2.])
+    np.testing.assert_array_equal(result, [2., 4.])
+    entry = module.outputPorts['metrics']
+    assert entry['module'] == 'Scale'
+    assert entry['wall_s'] >= 0 and entry['cpu_s'] >= 0
+    assert entry['inputs'] == {'x': {'type': 'list',
+                                     'nbytes': entry['inputs']['x']['nbytes']}}
+    assert entry['outputs']['y'] == {'type': 'ndarray', 'shape': [2],
+                                     'dtype': 'float64', 'nbytes': 16}
+    # a metered compute calling another one records once
+    module, result = run(Triple, x=[1.])
+    np.testing.assert_array_equal(result, [3.])
+    with open(recorder) as f:
+        records = [json.loads(line) for line in f]
+    assert [r['module'] for r in records] == ['Scale', 'Triple']
+
+
+def test_failed_compute_is_recorded(recorder):
+    Scale = instrument(module_classes())[0]
+    with pytest.raises(ValueError):
+        run(Scale, x=[1.], fail=True)
+    with open(recorder) as f:
+        [record] = [json.loads(line) for line in f]
+    assert 'asked to fail' in record['error']
+
+
+def test_off_by_default(monkeypatch):
+    monkeypatch.setattr(metrics, 'recorder', MetricsRecorder())
+    Scale = instrument(module_classes())[0]
+    module, result = run(Scale, x=[1.])
+    np.testing.assert_array_equal(result, [2.])
+    assert 'metrics' not in module.outputPorts
+
+
+@pytest.mark.parametrize('setting, enabled, path', [
+    ('', False, None), ('0', False, None), ('1', True, None),
+    ('/tmp/m.jsonl', True, '/tmp/m.jsonl')])
+def test_recorder_from_environ(monkeypatch, setting, enabled, path):
+    monkeypatch.setenv('SPECDATA_METRICS', setting)
+    recorder = MetricsRecorder.from_environ()
+    assert (recorder.enabled, recorder.path) == (enabled, path)
+
+
+def test_describe_value():
+    assert describe_value(np.zeros((2, 3), dtype=np.float32)) == \
+        {'type': 'ndarray', 'shape': [2, 3], 'dtype': 'float32',
+         'nbytes': 24}
+    assert describe_value(object()) == {'type': 'object'}
@@ -0,0 +1,106 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the single and double precision policies
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..gridding import GridAccumulator
+from ..precision import DOUBLE, SINGLE, compact_occupancy, get_precision
+from ..sparse import SparseGridAccumulator
+
+# float32 outputs of sums done in float64 are off by at most a few ulp
+SINGLE_RTOL = 1e-6
+
+
+def random_grid(accumulator=GridAccumulator, n_points=20000, seed=0):
+    rng = np.random.RandomState(seed)
+    acc = accumulator([0, 0, 0], [1, 1, 1], [10, 12, 14])
+    acc.add(rng.uniform(0, 1, (n_points, 3)),
+            rng.uniform(0, 60000, n_points).astype(np.uint16))
+    return acc
+
+
+@pytest.mark.parametrize('top, dtype', [
+    (0, np.uint8), (255, np.uint8), (256, np.uint16), (65535, np.uint16),
+    (65536, np.uint32), (2 ** 32, np.uint64)])
+def test_compact_occupancy_boundaries(top, dtype):
+    occupancy = np.array([0, 1, top], dtype=np.int64)
+    compact = compact_occupancy(occupancy)
+    assert compact.dtype == dtype
+    np.testing.assert_array_equal(compact, occupancy)
+
+
+def test_compact_occupancy_of_empty_grid():
+    assert compact_occupancy(np.zeros(0, dtype=np.int64)).dtype == np.uint8
+
+
+def test_single_within_tolerance_of_double():
+    double = DOUBLE.grid(random_grid().result())
+    single = SINGLE.grid(random_grid().result())
+    for d, s in zip(double, single):
+        if s.dtype.kind == 'f':
+            assert s.dtype == np.float32
+            np.testing.assert_allclose(s, d, rtol=SINGLE_RTOL)
+    # occupancy is exact, only its type shrinks
+    assert double[5].dtype == np.int64
+    assert single[5].dtype == np.uint8
+    np.testing.assert_array_equal(single[5], double[5])
+
+
+def test_single_sparse_grid():
+    double = DOUBLE.grid(random_grid(SparseGridAccumulator).sparse_result())
+    single = SINGLE.grid(random_grid(SparseGridAccumulator).sparse_result())
+    assert single.mean.dtype == single.std_err.dtype == np.float32
+    assert single.occupancy.dtype == np.uint8
+    np.testing.assert_array_equal(single.index, double.index)
+    np.testing.assert_allclose(single.mean, double.mean, rtol=SINGLE_RTOL)
+    np.testing.assert_allclose(single.std_err, double.std_err,
+                               rtol=SINGLE_RTOL)
+
+
+def test_double_keeps_arrays():
+    grid = random_grid().result()
+    for before, after in zip(grid, DOUBLE.grid(grid)):
+        assert after is before
+
+
+def test_get_precision():
+    assert get_precision(None) is DOUBLE
+    assert get_precision('single') is SINGLE
+    with pytest.raises(ValueError):
+        get_precision('half')
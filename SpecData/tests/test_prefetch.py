@@ -0,0 +1,111 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the background scan prefetcher
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import gc
+import threading
+from ..prefetch import ScanPrefetcher, _sf_locks, spec_file_lock
+
+
+class Loads(object):
+    """
+    Load function recording what it loaded, the first load waits for
+    release() so that the later ones stay queued
+    """
+    def __init__(self):
+        self.loaded = []
+        self.gate = threading.Event()
+
+    def __call__(self, name):
+        if not self.loaded:
+            self.gate.wait(10)
+        self.loaded.append(name)
+        return name
+
+    def release(self):
+        self.gate.set()
+
+
+def test_take_returns_the_load():
+    prefetcher = ScanPrefetcher(2)
+    loads = Loads()
+    loads.release()
+    prefetcher.prefetch('a', loads, ('a',))
+    assert prefetcher.take('a') == 'a'
+    assert prefetcher.take('a') is None
+
+
+def test_scans_leaving_the_window_are_not_loaded():
+    prefetcher = ScanPrefetcher(4)
+    loads = Loads()
+    for name in 'abc':
+        prefetcher.prefetch(name, loads, (name,), group='file')
+    prefetcher.prefetch('x', loads, ('x',), group='other file')
+    prefetcher.retain('file', ['a', 'c'])
+    assert 'b' not in prefetcher and 'x' in prefetcher
+    loads.release()
+    assert prefetcher.take('c') == 'c'
+    assert prefetcher.take('x') == 'x'
+    assert loads.loaded == ['a', 'c', 'x']
+
+
+def test_trimmed_scans_are_not_loaded():
+    prefetcher = ScanPrefetcher(3)
+    loads = Loads()
+    for name in 'abc':
+        prefetcher.prefetch(name, loads, (name,))
+    # a may already be loading and then finishes, b is queued and skipped
+    prefetcher.set_max_scans(1)
+    assert len(prefetcher) == 1
+    loads.release()
+    assert prefetcher.take('c') == 'c'
+    assert loads.loaded[-1:] == ['c'] and 'b' not in loads.loaded
+
+
+class FakeSpecFile(object):
+    pass
+
+
+def test_spec_file_locks_are_dropped_with_the_file():
+    sf, other = FakeSpecFile(), FakeSpecFile()
+    lock = spec_file_lock(sf)
+    assert spec_file_lock(sf) is lock
+    assert spec_file_lock(other) is not lock
+    del sf, other
+    gc.collect()
+    assert not any(isinstance(f, FakeSpecFile) for f in _sf_locks.keys())
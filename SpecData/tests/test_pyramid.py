@@ -0,0 +1,102 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the down-sampled levels of gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..gridding import GridAccumulator, grid_axes
+from ..pyramid import GridPyramid
+from ..sparse import SparseGridAccumulator
+
+QMIN, QMAX = [0, 0, 0], [1, 1, 2]
+FINE, COARSE = [16, 16, 32], [8, 8, 16]
+
+
+def points(seed=5):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 1, (20000, 3)) * QMAX, rng.uniform(0, 10, 20000)
+
+
+def grid(accumulator, bins):
+    acc = accumulator(QMIN, QMAX, bins)
+    acc.add(*points())
+    return acc
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_level_one_equals_gridding_at_half_resolution(sparse):
+    if sparse:
+        fine = grid(SparseGridAccumulator, FINE).sparse_result()
+    else:
+        fine = grid(GridAccumulator, FINE).result()
+    pyramid = GridPyramid.from_grid(fine, min_bins=4)
+    assert len(pyramid) == 3
+    level = pyramid[1]
+    for axis, expected in zip(level.axes, grid_axes(QMIN, QMAX, COARSE)):
+        np.testing.assert_allclose(axis, expected)
+    X, Y, Z, I, E, N, raw = grid(GridAccumulator, COARSE).result()
+    box = level.box()
+    # a full slab along L is the mean over L of the volume
+    for name, volume in (('masked_data', I), ('std_dev', E),
+                         ('occupancy', N)):
+        np.testing.assert_allclose(level.plane(name, 2, box),
+                                   volume.mean(2))
+
+
+def test_masked_voxels_do_not_contribute():
+    acc = grid(GridAccumulator, FINE)
+    X, Y, Z, I, E, N, raw = acc.result(min_occupancy=5)
+    pyramid = GridPyramid.from_grid((X, Y, Z, I, E, N), min_occupancy=5,
+                                    min_bins=8)
+    weights = N * (N >= 5)
+    sums = (I * weights).reshape(8, 2, 8, 2, 16, 2).sum(axis=(1, 3, 5))
+    counts = weights.reshape(8, 2, 8, 2, 16, 2).sum(axis=(1, 3, 5))
+    hit = counts > 0
+    assert not hit.all()
+    expected = np.zeros(counts.shape)
+    expected[hit] = sums[hit] / counts[hit]
+    np.testing.assert_allclose(pyramid[1].volumes['masked_data'], expected)
+
+
+def test_level_for_picks_the_coarsest_sufficient_level():
+    pyramid = GridPyramid.from_grid(grid(GridAccumulator, FINE).result(),
+                                    min_bins=4)
+    # full H and K ranges have 16, 8 and 4 bins on levels 0, 1 and 2
+    assert pyramid.level_for((0, 1), None, (4, 4)) == 2
+    assert pyramid.level_for((0, 1), None, (8, 8)) == 1
+    assert pyramid.level_for((0, 1), None, (100, 100)) == 0
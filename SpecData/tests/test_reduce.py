@@ -0,0 +1,145 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the chunked stack reductions
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..reduce import reduce_stack, roi_sums, stack_percentiles
+from ..stack import LazyImageStack
+
+
+def stack(n_frames=37, shape=(9, 7), seed=6):
+    rng = np.random.RandomState(seed)
+    return rng.poisson(1000, (n_frames,) + shape).astype(np.uint16)
+
+
+def test_statistics_match_numpy():
+    frames = stack()
+    out = reduce_stack(frames, ('sum', 'mean', 'max', 'min', 'var', 'std'),
+                       frames_per_chunk=5)
+    as_float = frames.astype(np.float64)
+    np.testing.assert_allclose(out['sum'], as_float.sum(0))
+    np.testing.assert_allclose(out['mean'], as_float.mean(0))
+    np.testing.assert_allclose(out['var'], as_float.var(0))
+    np.testing.assert_allclose(out['std'], as_float.std(0))
+    np.testing.assert_array_equal(out['max'], frames.max(0))
+    np.testing.assert_array_equal(out['min'], frames.min(0))
+
+
+@pytest.mark.parametrize('max_bytes', [1, 2 ** 20])
+def test_percentiles_match_numpy(max_bytes):
+    # one detector row per slab, or the whole stack at once
+    frames = stack()
+    q = [0, 12.5, 50, 99, 100]
+    out = stack_percentiles(frames, q, max_bytes=max_bytes)
+    for p in q:
+        np.testing.assert_allclose(out[float(p)],
+                                   np.percentile(frames, p, axis=0))
+
+
+def test_lazy_stack_is_decoded_once():
+    frames = stack()
+    decoded = []
+
+    def load(i):
+        decoded.append(i)
+        return frames[i]
+    lazy = LazyImageStack(len(frames), frames.shape[1:], load,
+                          dtype=frames.dtype, cache_frames=0)
+    # one row per slab, nine slabs
+    out = stack_percentiles(lazy, [50], max_bytes=1)
+    np.testing.assert_allclose(out[50.0], np.median(frames, axis=0))
+    assert sorted(decoded) == list(range(len(frames)))
+
+
+@pytest.mark.parametrize('q', [-1, 100.5, [50, 101], float('nan')])
+def test_percentiles_outside_0_100_are_refused(q):
+    calls = []
+    lazy = LazyImageStack(3, (2, 2), lambda i: calls.append(i) or
+                          np.zeros((2, 2)))
+    with pytest.raises(ValueError):
+        reduce_stack(lazy, ('mean',), percentiles=np.atleast_1d(q))
+    with pytest.raises(ValueError):
+        stack_percentiles(lazy, q)
+    with pytest.raises(ValueError):
+        stack_percentiles(lazy, [])
+    # refused before any frame is read
+    assert calls == []
+
+
+
+@pytest.mark.parametrize('statistic', ['sum', 'mean', 'max', 'min', 'var'])
+def test_empty_stack_is_refused(statistic):
+    with pytest.raises(ValueError):
+        reduce_stack(np.zeros((0, 9, 7)), [statistic])
+    with pytest.raises(ValueError):
+        stack_percentiles(np.zeros((0, 9, 7)), [50])
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_roi_sums_match_brute_force(n_workers):
+    frames = stack()
+    rois = [[0, 9, 0, 7], [2, 5, 1, 3], [8, 9, 6, 7]]
+    sums, means = roi_sums(frames, rois, frames_per_chunk=4,
+                           n_workers=n_workers)
+    expected = np.array([frames[:, x0:x1, y0:y1].sum(axis=(1, 2))
+                         for x0, x1, y0, y1 in rois]).T
+    np.testing.assert_allclose(sums, expected)
+    np.testing.assert_allclose(means[:, 1], expected[:, 1] / 6)
+    np.testing.assert_allclose(means[:, 2], expected[:, 2])
+
+
+@pytest.mark.parametrize('rois', [[[3, 3, 0, 7]], [[5, 2, 0, 7]],
+                                  [[5, 2, 7, 0]], [[8, 20, 6, 7]],
+                                  [[-1, 4, 0, 7]], [[20, 30, 0, 7]],
+                                  [[0, 9, 0, 7, 1]], []])
+def test_bad_roi_is_refused(rois):
+    with pytest.raises(ValueError):
+        roi_sums(stack(), rois)
+
+
+def test_rois_are_checked_before_reading():
+    calls = []
+
+    def loader(i):
+        calls.append(i)
+        return np.zeros((9, 7))
+
+    lazy = LazyImageStack(5, (9, 7), loader)
+    with pytest.raises(ValueError):
+        roi_sums(lazy, [[0, 9, 0, 7], [5, 2, 0, 7]])
+    assert calls == []
@@ -0,0 +1,106 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the persistent SPEC scan index
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import pytest
+
+pytest.importorskip('pyspec.spec')
+from ..scan_index import SpecScanIndex  # noqa: E402
+
+HEADER = ('#F test.spec\n#E 1400000000\n#D Mon Jan 01 00:00:00 2014\n'
+          '#O0 delta  theta  chi\n#O1 phi  mu  gamma\n\n')
+
+
+def scan(scan_no, command='ascan  theta 1 2  10 1'):
+    return ('#S {0} {1}\n#D Tue Jan 02 00:00:0{0} 2014\n#N 2\n#L theta  I\n'
+            '1 10\n2 20\n\n'.format(scan_no, command))
+
+
+def write(path, text, mode='w'):
+    with open(path, mode) as f:
+        f.write(text)
+    # a second write within the mtime resolution must still be seen
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+
+def test_offsets_and_metadata(tmpdir):
+    path = str(tmpdir.join('test.spec'))
+    text = HEADER + scan(1) + scan(2, 'mesh  chi 0 1 2')
+    write(path, text)
+    index = SpecScanIndex(path).refresh()
+    assert index.offsets() == {1: text.index('#S 1'), 2: text.index('#S 2')}
+    meta = index.metadata(2)
+    assert meta['command'] == 'mesh  chi 0 1 2'
+    assert meta['date'] == 'Tue Jan 02 00:00:02 2014'
+    assert meta['motors'] == ['delta', 'theta', 'chi', 'phi', 'mu', 'gamma']
+    assert os.path.exists(path + '.scanidx')
+
+
+def test_appended_scans_are_indexed_incrementally(tmpdir):
+    path = str(tmpdir.join('test.spec'))
+    write(path, HEADER + scan(1))
+    index = SpecScanIndex(path).refresh()
+    indexed_to = index.indexed_to
+    write(path, scan(2), mode='a')
+    reloaded = SpecScanIndex(path)
+    assert reloaded._load() and reloaded.indexed_to == indexed_to
+    reloaded.refresh()
+    assert sorted(reloaded.offsets()) == [1, 2]
+    assert reloaded.offsets()[2] == indexed_to
+
+
+def test_rewritten_file_is_reindexed(tmpdir):
+    path = str(tmpdir.join('test.spec'))
+    write(path, HEADER + scan(1) + scan(2))
+    SpecScanIndex(path).refresh()
+    text = HEADER + scan(7) + scan(8) + scan(9)
+    write(path, text)
+    index = SpecScanIndex(path).refresh()
+    assert sorted(index.offsets()) == [7, 8, 9]
+    assert index.offsets()[7] == text.index('#S 7')
+
+
+def test_partial_last_line_waits_for_the_next_refresh(tmpdir):
+    path = str(tmpdir.join('test.spec'))
+    write(path, HEADER + scan(1) + '#S 2 ascan')
+    index = SpecScanIndex(path).refresh()
+    assert sorted(index.offsets()) == [1]
+    write(path, '  theta 0 1 5 1\n', mode='a')
+    assert sorted(index.refresh().offsets()) == [1, 2]
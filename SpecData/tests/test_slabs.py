@@ -0,0 +1,108 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the out-of-core gridder
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from ..geometry import Detector
+from ..gridding import GridAccumulator, grid_parallel
+from ..precision import SINGLE
+from ..slabs import BYTES_PER_VOXEL, SlabGridAccumulator, grid_out_of_core
+
+QMIN, QMAX, BINS = [-1, -1, 0], [1, 1, 2], [10, 6, 5]
+
+
+def points(n_points=3000, seed=2):
+    rng = np.random.RandomState(seed)
+    hkl = rng.uniform(-0.1, 1.1, (n_points, 3)) * \
+        (np.array(QMAX) - QMIN) + QMIN
+    return hkl, rng.uniform(0, 50, n_points)
+
+
+def test_slabs_match_in_memory_grid(tmpdir):
+    # room for two H planes per slab, so the grid takes five slabs
+    memory = 2 * 2 * BYTES_PER_VOXEL * BINS[1] * BINS[2]
+    acc = SlabGridAccumulator(QMIN, QMAX, BINS, memory_bytes=memory,
+                              directory=str(tmpdir))
+    assert acc.slab_rows == 2
+    ref = GridAccumulator(QMIN, QMAX, BINS)
+    for seed in range(3):
+        hkl, intensity = points(seed=seed)
+        acc.add(hkl, intensity)
+        ref.add(hkl, intensity)
+    assert acc.slab_passes > 3
+    assert acc.out_of_bounds == ref.out_of_bounds
+    for s, r in zip(acc.result(min_occupancy=2),
+                    ref.result(min_occupancy=2)):
+        np.testing.assert_allclose(s, r)
+    acc.close()
+
+
+def test_result_in_single_precision(tmpdir):
+    acc = SlabGridAccumulator(QMIN, QMAX, BINS, directory=str(tmpdir))
+    acc.add(*points())
+    X, Y, Z, I, E, N, raw = acc.result(precision=SINGLE)
+    assert I.dtype == E.dtype == raw.dtype == X.dtype == np.float32
+    assert N.dtype == np.uint8
+    np.testing.assert_array_equal(N.ravel(), acc.occupancy)
+    acc.close()
+
+
+def test_scratch_files_are_removed(tmpdir):
+    acc = SlabGridAccumulator(QMIN, QMAX, BINS, directory=str(tmpdir))
+    acc.add(*points())
+    acc.result()
+    acc.close()
+    assert tmpdir.listdir() == []
+
+
+def test_grid_out_of_core_matches_grid_parallel(tmpdir):
+    rng = np.random.RandomState(3)
+    frames = rng.poisson(20, (5, 12, 10)).astype(np.uint16)
+    angles = np.zeros((5, 6))
+    angles[:, 0] = 40
+    angles[:, 1] = np.linspace(15, 25, 5)
+    detector = Detector.from_ccd_size((12, 10))
+    ub = np.eye(3) * 2 * np.pi / 4.0
+    qmin, qmax, bins = [1.7, -0.25, -0.1], [1.95, 0.25, 0.1], [8, 8, 8]
+    acc = grid_out_of_core(frames, angles, ub, 1.5, detector, qmin, qmax,
+                           bins, memory_bytes=4096, directory=str(tmpdir))
+    ref = grid_parallel(frames, angles, ub, 1.5, detector, qmin, qmax, bins)
+    assert ref.occupancy.sum() > 0
+    np.testing.assert_array_equal(acc.occupancy, ref.occupancy)
+    np.testing.assert_allclose(acc.sum, ref.sum)
+    acc.close()
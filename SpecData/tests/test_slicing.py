@@ -0,0 +1,95 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of slicing dense and sparse gridded volumes
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+from ..gridding import GridAccumulator
+from ..slicing import GridSlicer
+from ..sparse import SparseGridAccumulator
+
+QMIN, QMAX, BINS = [0, 0, 0], [1, 2, 3], [10, 8, 6]
+
+
+def slicers(min_occupancy=2, seed=4):
+    rng = np.random.RandomState(seed)
+    hkl = rng.uniform(0, 1, (4000, 3)) * QMAX
+    intensity = rng.uniform(0, 10, 4000)
+    dense = GridAccumulator(QMIN, QMAX, BINS)
+    sparse = SparseGridAccumulator(QMIN, QMAX, BINS)
+    for acc in (dense, sparse):
+        acc.add(hkl, intensity)
+    return (GridSlicer.from_grid(dense.result(min_occupancy)),
+            GridSlicer.from_grid(sparse.sparse_result(min_occupancy)))
+
+
+def test_box_selects_overlapping_voxels():
+    dense, sparse = slicers()
+    # H voxels are 0.1 wide, K 0.25 and L 0.5
+    ranges = [(0.25, 0.45), None, (1.2, 1.2)]
+    for slicer in (dense, sparse):
+        assert slicer.box(ranges) == [(2, 5), (0, 8), (2, 3)]
+        np.testing.assert_allclose(slicer.axis_values(0, slicer.box(ranges)),
+                                   [0.2, 0.3, 0.4])
+
+
+def test_dense_and_sparse_planes_agree():
+    dense, sparse = slicers()
+    box = dense.box([(0.2, 0.75), (0.5, 1.5), None])
+    for axis in range(3):
+        for name in ('masked_data', 'std_dev', 'occupancy'):
+            np.testing.assert_allclose(sparse.plane(name, axis, box),
+                                       dense.plane(name, axis, box))
+
+
+def test_full_slab_is_the_cached_projection():
+    dense, _ = slicers()
+    box = dense.box([(0.2, 0.75), None, (0, 3)])
+    plane = dense.plane('masked_data', 2, box)
+    projection = dense.projection('masked_data', 2)
+    assert np.shares_memory(plane, projection)
+    np.testing.assert_allclose(
+        plane, dense.volumes['masked_data'].mean(2)[2:8, :])
+
+
+def test_meshes_follow_the_box():
+    dense, _ = slicers()
+    box = dense.box([(0.2, 0.45), (0.5, 1.0), None])
+    H, K = dense.meshes(2, box)
+    assert H.shape == K.shape == (3, 3)
+    np.testing.assert_allclose(H[:, 0], [0.2, 0.3, 0.4])
+    np.testing.assert_allclose(K[0], [0.5, 0.75, 1.0])
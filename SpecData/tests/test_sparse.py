@@ -0,0 +1,107 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the sparse gridder against the dense one
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..gridding import GridAccumulator, tree_reduce
+from ..sparse import SparseGrid, SparseGridAccumulator
+
+QMIN, QMAX, BINS = [0, -1, 2], [1, 1, 3], [6, 7, 8]
+
+
+def chunks(n_chunks=4, n_points=500, seed=1):
+    rng = np.random.RandomState(seed)
+    for _ in range(n_chunks):
+        # a quarter of the points falls outside the grid
+        hkl = rng.uniform(-0.1, 1.1, (n_points, 3)) * \
+            (np.array(QMAX) - QMIN) + QMIN
+        yield hkl, rng.uniform(0, 100, n_points)
+
+
+def gridded(accumulator, data):
+    acc = accumulator(QMIN, QMAX, BINS)
+    for hkl, intensity in data:
+        acc.add(hkl, intensity)
+    return acc
+
+
+@pytest.mark.parametrize('min_occupancy', [0, 3])
+def test_sparse_result_matches_dense(min_occupancy):
+    data = list(chunks())
+    dense = gridded(GridAccumulator, data).result(min_occupancy)
+    sparse = gridded(SparseGridAccumulator, data).result(min_occupancy)
+    for d, s in zip(dense, sparse):
+        np.testing.assert_allclose(s, d)
+
+
+def test_merge_matches_single_pass():
+    data = list(chunks())
+    parts = [gridded(SparseGridAccumulator, [chunk]) for chunk in data]
+    merged = tree_reduce(parts).sparse_result()
+    single = gridded(SparseGridAccumulator, data).sparse_result()
+    np.testing.assert_array_equal(merged.index, single.index)
+    np.testing.assert_array_equal(merged.occupancy, single.occupancy)
+    np.testing.assert_allclose(merged.mean, single.mean)
+    np.testing.assert_allclose(merged.std_err, single.std_err)
+
+
+def test_only_occupied_voxels_are_stored():
+    grid = gridded(SparseGridAccumulator, chunks()).sparse_result()
+    assert isinstance(grid, SparseGrid)
+    assert np.all(grid.occupancy > 0)
+    assert np.all(np.diff(grid.index) > 0)
+    dense = grid.to_dense('occupancy')
+    assert np.count_nonzero(dense) == grid.nnz
+
+
+def test_slab_mean_matches_dense_mean():
+    grid = gridded(SparseGridAccumulator, chunks()).sparse_result(2)
+    dense = grid.to_dense('masked_data')
+    box = [(1, 5), (0, 7), (2, 6)]
+    for axis in range(3):
+        sub = dense[box[0][0]:box[0][1], box[1][0]:box[1][1],
+                    box[2][0]:box[2][1]]
+        np.testing.assert_allclose(grid.slab_mean('masked_data', axis, box),
+                                   sub.mean(axis))
+
+
+def test_merge_refuses_other_grids():
+    with pytest.raises(ValueError):
+        SparseGridAccumulator(QMIN, QMAX, BINS).merge(
+            SparseGridAccumulator(QMIN, QMAX, [6, 7, 9]))
@@ -0,0 +1,77 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the lazy image stack
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import numpy as np
+import pytest
+from ..prefetch import decode_stack
+from ..stack import LazyImageStack
+
+
+class Loader(object):
+    """
+    Frame loader over an array, recording the frames it decoded
+    """
+    def __init__(self, frames):
+        self.frames = frames
+        self.decoded = []
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __call__(self, i):
+        self.decoded.append(i)
+        return self.frames[i]
+
+
+def test_from_loader_takes_the_first_frame():
+    frames = np.arange(24, dtype=np.float32).reshape(4, 2, 3)
+    loader = Loader(frames)
+    stack = LazyImageStack.from_loader(loader)
+    assert stack.shape == (4, 2, 3) and stack.dtype == np.float32
+    np.testing.assert_array_equal(np.asarray(stack), frames)
+    # frame 0 is remembered, not decoded again
+    assert sorted(loader.decoded) == [0, 1, 2, 3]
+
+
+@pytest.mark.parametrize('build', [LazyImageStack.from_loader, decode_stack])
+def test_loader_without_frames_is_refused(build):
+    loader = Loader(np.zeros((0, 2, 3)))
+    with pytest.raises(ValueError):
+        build(loader)
+    assert loader.decoded == []
@@ -0,0 +1,80 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Tests of the registry of live scan streams
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import pytest
+
+pytest.importorskip('pyspec.ccd.transformations')
+from ..geometry import Detector  # noqa: E402
+from .. import streaming  # noqa: E402
+
+DETECTOR = Detector.from_ccd_size((8, 8))
+
+
+def stream(scan_no, qmax=1.0, reset=False):
+    return streaming.get_stream('scan.spec', 'ccd', scan_no, [0, 0, 0],
+                                [qmax] * 3, [4, 4, 4], DETECTOR, reset=reset)
+
+
+@pytest.fixture(autouse=True)
+def empty_registry(monkeypatch):
+    monkeypatch.setattr(streaming, '_streams', streaming.ScanCache(2 ** 20))
+    monkeypatch.setattr(streaming, '_scan_streams', {})
+
+
+def test_stream_is_kept_between_calls():
+    first = stream(1)
+    assert stream(1) is first
+    assert stream(1, reset=True) is not first
+
+
+def test_new_grid_drops_the_previous_stream():
+    stream(1)
+    stream(2)
+    stream(1, qmax=2.0)
+    assert len(streaming._streams) == 2
+    assert len(streaming._scan_streams) == 2
+
+
+def test_streams_are_bounded():
+    # a stream of 4 x 4 x 4 voxels holds 3 * 64 * 8 bytes
+    streaming._streams.set_max_bytes(3 * 3 * 64 * 8)
+    for scan_no in range(10):
+        stream(scan_no)
+    assert len(streaming._streams) == 3
+    assert sorted(s[2] for s in streaming._scan_streams) == [7, 8, 9]
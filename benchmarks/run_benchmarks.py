@@ -0,0 +1,317 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Benchmarks of the SpecData modules outside the VisTrails GUI
+
+Writes a synthetic scan for every (frames, detector size) point of the
+sweep and runs SpecFileParams -> SpecFile -> GridderParams -> Gridder ->
+PlotGridded and ImageStackSum on it for every bin count, calling each
+module's compute() directly. Wall time, CPU time and peak allocations of
+each compute() are written to a JSON file that can be compared across
+commits, together with the peak RSS of each sweep point. Every point runs
+in a fresh interpreter so that its peak RSS is its own, not that of the
+largest point before it:
+
+    python benchmarks/run_benchmarks.py --frames 51 201 --detector 256 512 \
+        --bins 50 100 --output results.json
+
+With --precision single the gridded outputs of every sweep point are also
+compared with those of the double precision pipeline.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import numpy as np
+from synthetic import make_dataset
+from SpecData.cache import scan_cache
+from SpecData.init import (SpecFileParams, SpecFile, GridderParams, Gridder,
+                           PlotGridded, ImageStackSum)
+from SpecData.metrics import cpu_time, peak_rss
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, only the peak RSS of each sweep point is measured
+    tracemalloc = None
+
+
+class Value(object):
+    """
+    Input port connection that hands a fixed value to a module
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+    def get_raw(self):
+        return self.value
+
+
+def make_module(cls, **inputs):
+    module = cls()
+    for port, value in inputs.items():
+        module.set_input_port(port, Value(value))
+    return module
+
+
+def profile_compute(module):
+    """
+    Run module.compute() and return its wall time, CPU time and, on
+    Python 3, the largest amount of memory allocated through Python and
+    NumPy during the call
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    wall = time.time()
+    cpu = cpu_time()
+    module.compute()
+    cpu = cpu_time() - cpu
+    wall = time.time() - wall
+    profile = {'wall_s': wall, 'cpu_s': cpu}
+    if tracemalloc is not None:
+        profile['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return profile
+
+
+def run_pipeline(dataset, bins, backend, lazy_stack, precision='double'):
+    """
+    Run the modules once on a dataset and return {module: profile} and
+    the Gridder
+    """
+    # every run starts from the files, not from an earlier run's scans
+    scan_cache.clear()
+    timings = {}
+    params = make_module(SpecFileParams,
+                         spec_file_root=dataset['spec_file'],
+                         data_folder_path=dataset['ccd_path'],
+                         scan_number=dataset['scan_numbers'][0],
+                         lazy_stack=lazy_stack, use_cache=False,
+                         precision=precision)
+    params.compute()
+    spec_file = make_module(SpecFile, spec_file_params=params)
+    timings['SpecFile'] = profile_compute(spec_file)
+
+    stack_sum = make_module(ImageStackSum, img_stack=spec_file.img_stack)
+    timings['ImageStackSum'] = profile_compute(stack_sum)
+
+    gridder_params = make_module(GridderParams, spec_file=spec_file,
+                                 bins_x=bins, bins_y=bins, bins_z=bins,
+                                 backend=backend)
+    gridder_params.compute()
+    gridder = make_module(Gridder, gridder_params=gridder_params)
+    timings['Gridder'] = profile_compute(gridder)
+
+    plot = make_module(PlotGridded, gridder=gridder)
+    timings['PlotGridded'] = profile_compute(plot)
+    return timings, gridder
+
+
+def grid_errors(reference, gridder):
+    """
+    Largest difference of each gridded output to the reference Gridder,
+    relative to the largest magnitude of the reference output
+    """
+    errors = {}
+    for port in ('masked_data', 'raw_data', 'std_dev', 'occupancy',
+                 'x_mesh'):
+        ref = np.asarray(reference.outputPorts[port], dtype=np.float64)
+        out = np.asarray(gridder.outputPorts[port], dtype=np.float64)
+        scale = np.abs(ref).max() or 1.
+        errors[port] = {'max_rel_error': float(np.abs(out - ref).max() /
+                                               scale),
+                        'dtype': str(gridder.outputPorts[port].dtype),
+                        'nbytes': int(gridder.outputPorts[port].nbytes),
+                        'reference_nbytes':
+                            int(reference.outputPorts[port].nbytes)}
+    return errors
+
+
+def run_point(dataset, bins, backend, lazy_stack, precision, repeat):
+    """
+    Profile the pipeline repeat times on one sweep point
+
+    Meant to run in a process of its own, see run_point_subprocess: the
+    peak RSS of the process is then the peak RSS of the point.
+    """
+    runs = [run_pipeline(dataset, bins, backend, lazy_stack, precision)
+            for _ in range(repeat)]
+    result = {'modules': summarize([t for t, _ in runs]),
+              'peak_rss_bytes': peak_rss()}
+    if precision != 'double':
+        # after the peak was read, the reference run does not count
+        _, reference = run_pipeline(dataset, bins, backend, lazy_stack)
+        result['accuracy'] = grid_errors(reference, runs[-1][1])
+    return result
+
+
+def run_point_subprocess(dataset, bins, args, workdir):
+    """
+    run_point in a fresh interpreter, which writes its result to a JSON
+    file in workdir. Only the paths and scan numbers of the dataset are
+    handed over, the child reads the scans from the files.
+    """
+    fd, path = tempfile.mkstemp(prefix='point_', suffix='.json',
+                                dir=workdir)
+    os.close(fd)
+    files = dict((key, dataset[key])
+                 for key in ('spec_file', 'ccd_path', 'scan_numbers'))
+    command = [sys.executable, os.path.abspath(__file__),
+               '--point', json.dumps({'dataset': files, 'bins': bins}),
+               '--backend', args.backend, '--precision', args.precision,
+               '--repeat', str(args.repeat), '--output', path]
+    if args.lazy_stack:
+        command.append('--lazy-stack')
+    try:
+        subprocess.check_call(command)
+        with open(path, 'r') as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def summarize(runs):
+    """
+    Per module minimum and median of the repeated runs
+    """
+    summary = {}
+    for module in runs[0]:
+        summary[module] = {}
+        for metric in runs[0][module]:
+            values = [run[module][metric] for run in runs]
+            summary[module][metric] = {'min': float(np.min(values)),
+                                       'median': float(np.median(values))}
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--frames', type=int, nargs='+', default=[51],
+                        help='points (frames) per scan')
+    parser.add_argument('--detector', type=int, nargs='+', default=[256],
+                        help='rows and columns of a square CCD frame')
+    parser.add_argument('--bins', type=int, nargs='+', default=[50],
+                        help='bins along each of H, K and L')
+    parser.add_argument('--backend', default='numpy',
+                        help='gridding backend, pyspec or numpy')
+    parser.add_argument('--lazy-stack', action='store_true',
+                        help='decode frames on demand')
+    parser.add_argument('--precision', default='double',
+                        help='precision policy, double or single')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per sweep point')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None,
+                        help='where to write the synthetic data, kept if '
+                             'given, a removed temporary directory if not')
+    parser.add_argument('--output', default='benchmark_results.json')
+    # internal, profile a single point in this process, see run_point
+    parser.add_argument('--point', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.point is not None:
+        point = json.loads(args.point)
+        result = run_point(point['dataset'], point['bins'], args.backend,
+                           args.lazy_stack, args.precision, args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+        return result
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='specdata_bench_')
+    results = []
+    try:
+        for n_frames in args.frames:
+            for size in args.detector:
+                root = os.path.join(workdir, 'f{0}_d{1}'.format(n_frames,
+                                                               size))
+                dataset = make_dataset(root, n_points=n_frames,
+                                       ccd_shape=(size, size),
+                                       seed=args.seed)
+                for bins in args.bins:
+                    point = {'frames': n_frames, 'detector': size,
+                             'bins': bins}
+                    result = run_point_subprocess(dataset, bins, args,
+                                                  workdir)
+                    result['params'] = point
+                    results.append(result)
+                    print(json.dumps(point), ' '.join(
+                        '{0}={1:.3f}s'.format(m, t['wall_s']['median'])
+                        for m, t in sorted(result['modules'].items())),
+                        'peak_rss={0:.1f}MB'.format(
+                            result['peak_rss_bytes'] / 2 ** 20))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'commit': git_commit(),
+              'timestamp': time.time(),
+              'python': sys.version,
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'backend': args.backend,
+              'lazy_stack': args.lazy_stack,
+              'precision': args.precision,
+              'repeat': args.repeat,
+              'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Synthetic SPEC files and Princeton SPE CCD frames for benchmarking
+
+The files follow the layout pyspec reads: a SPEC file with six-circle
+angles, UB matrix and wavelength in the #G headers, and one SPE file per
+scan point named <spec file>_<scan>-<point>_0000.spe in the CCD folder,
+plus the matching -DARK frames. Every frame is rendered from the same
+geometry the numpy gridding backend uses, with a Gaussian Bragg peak on a
+flat background and Poisson noise, so gridding the data finds the peak.
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import time
+import numpy as np
+from SpecData.geometry import Detector, frame_transform, frame_hkl
+
+# SPE header layout, see pyspec.ccd.files.PrincetonSPEFile
+SPE_DATA_START = 4100
+SPE_DTYPES = {np.dtype(np.float32): 0, np.dtype(np.int32): 1,
+              np.dtype(np.int16): 2, np.dtype(np.uint16): 3}
+
+SIXC_ANGLES = ['Delta', 'Theta', 'Chi', 'Phi', 'Mu', 'Gamma']
+
+
+def write_spe(path, frames):
+    """
+    Write frames, a (n, rows, cols) or (rows, cols) array, as a Princeton
+    SPE file
+
+    Only the header fields pyspec reads are filled in.
+    """
+    frames = np.asarray(frames)
+    if frames.ndim == 2:
+        frames = frames[np.newaxis]
+    if frames.dtype not in SPE_DTYPES:
+        raise ValueError('SPE files cannot hold {0} data'
+                         ''.format(frames.dtype))
+    n, rows, cols = frames.shape
+    header = np.zeros(SPE_DATA_START, dtype=np.uint8)
+
+    def put(offset, value, dtype):
+        raw = np.array([value], dtype=dtype).view(np.uint8)
+        header[offset:offset + raw.size] = raw
+
+    def put_text(offset, text):
+        raw = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+        header[offset:offset + raw.size] = raw
+
+    put(6, cols, '<i2')
+    put(18, rows, '<i2')
+    put(42, cols, '<i2')
+    put(656, rows, '<i2')
+    put(108, SPE_DTYPES[frames.dtype], '<i2')
+    put(1446, n, '<u4')
+    put(1510, 1, '<i2')
+    put(1488, 1, '<i2')
+    now = time.localtime()
+    put_text(20, time.strftime('%d%b%Y', now))
+    put_text(172, time.strftime('%H%M%S', now))
+    put_text(200, 'synthetic frame')
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(frames.astype(frames.dtype.newbyteorder('<')).tobytes())
+
+
+class SyntheticScan(object):
+    """
+    Geometry and intensity model of one synthetic scan
+
+    The scan rocks theta and delta together (theta / 2 theta) around
+    theta0 with chi at 90 degrees. The H, K, L columns are the HKL of the
+    central detector pixel, so GridderParams derives sensible bounds.
+
+    Parameters
+    ----------
+    n_points : int
+        Number of scan points, one CCD frame each
+    ccd_shape : tuple
+        (rows, cols) of a frame
+    lattice : float
+        Cubic lattice constant in Angstrom
+    wavelength : float
+        Wavelength in Angstrom
+    theta0, width : float
+        Centre and full range of the theta scan in degrees
+    peak_sigma : float
+        Width of the Bragg peak in r.l.u.
+    peak_counts, background, dark_level : float
+        Peak height, flat background and dark current in counts
+    """
+    def __init__(self, n_points=51, ccd_shape=(256, 256), lattice=4.0,
+                 wavelength=1.5, theta0=22.0, width=2.0, peak_sigma=0.01,
+                 peak_counts=2000.0, background=5.0, dark_level=100.0):
+        self.n_points = int(n_points)
+        self.ccd_shape = tuple(int(n) for n in ccd_shape)
+        self.wavelength = float(wavelength)
+        self.lattice = float(lattice)
+        self.ub = np.eye(3) * 2 * np.pi / self.lattice
+        theta = theta0 + np.linspace(-width / 2, width / 2, self.n_points)
+        self.angles = np.zeros((self.n_points, 6))
+        self.angles[:, 0] = 2 * theta
+        self.angles[:, 1] = theta
+        self.angles[:, 2] = 90.0
+        self.detector = Detector.from_ccd_size(self.ccd_shape, dist=355.0)
+        self.hkl = np.array([self.centre_hkl(a) for a in self.angles])
+        self.peak = self.hkl[self.n_points // 2]
+        self.peak_sigma = float(peak_sigma)
+        self.peak_counts = float(peak_counts)
+        self.background = float(background)
+        self.dark_level = float(dark_level)
+
+    def centre_hkl(self, angles):
+        """
+        HKL of the pixel the detector arm points at
+        """
+        A, b = frame_transform(angles, self.ub, self.wavelength)
+        return A.dot([0.0, 1.0, 0.0]) + b
+
+    def expected_frame(self, i):
+        """
+        Noise free counts of frame i, without the dark current
+        """
+        hkl = frame_hkl(self.detector, self.angles[i], self.ub,
+                        self.wavelength)
+        r2 = ((hkl - self.peak) ** 2).sum(axis=1)
+        counts = (self.peak_counts * np.exp(-r2 / (2 * self.peak_sigma ** 2))
+                  + self.background)
+        return counts.reshape(self.ccd_shape)
+
+    def frame(self, i, rng):
+        """
+        Raw uint16 frame i, with Poisson noise and the dark current
+        """
+        counts = rng.poisson(self.expected_frame(i) + self.dark_level)
+        return np.clip(counts, 0, 2 ** 16 - 1).astype(np.uint16)
+
+    def dark(self, rng):
+        counts = rng.poisson(np.full(self.ccd_shape, self.dark_level))
+        return np.clip(counts, 0, 2 ** 16 - 1).astype(np.uint16)
+
+
+def _spec_line(values):
+    return '  '.join('{0:.6g}'.format(v) for v in values)
+
+
+def write_spec_file(path, scans, epoch=None):
+    """
+    Write a SPEC file holding scans, a {scan number: SyntheticScan} dict
+    """
+    epoch = int(time.time() if epoch is None else epoch)
+    lines = ['#F {0}'.format(os.path.basename(path)),
+             '#E {0}'.format(epoch),
+             '#D {0}'.format(time.ctime(epoch)),
+             '#C synthetic data',
+             '#O0 ' + '  '.join(SIXC_ANGLES),
+             '']
+    columns = ['H', 'K', 'L'] + SIXC_ANGLES + ['Seconds', 'Monitor',
+                                              'Detector']
+    for scan_no in sorted(scans):
+        scan = scans[scan_no]
+        lo, hi = scan.angles[0, 1], scan.angles[-1, 1]
+        lattice = [scan.lattice] * 3 + [90.0] * 3
+        reciprocal = [2 * np.pi / scan.lattice] * 3 + [90.0] * 3
+        or_angles = list(scan.angles[0]) + list(scan.angles[-1])
+        lines += [
+            '#S {0}  th2th  {1:g} {2:g}  {3} 1'.format(
+                scan_no, lo, hi, scan.n_points - 1),
+            '#D {0}'.format(time.ctime(epoch)),
+            '#G1 ' + _spec_line(lattice + reciprocal + [0, 0, 1, 1, 0, 0] +
+                                or_angles +
+                                [scan.wavelength, scan.wavelength]),
+            '#G3 ' + _spec_line(scan.ub.ravel()),
+            '#G4 ' + _spec_line(list(scan.peak) +
+                                [scan.wavelength, 0, 0, 0, 0]),
+            '#P0 ' + _spec_line(scan.angles[0]),
+            '#N {0}'.format(len(columns)),
+            '#L ' + '  '.join(columns)]
+        for hkl, angles in zip(scan.hkl, scan.angles):
+            lines.append(_spec_line(list(hkl) + list(angles) +
+                                    [1.0, 1e5, 0]))
+        lines.append('')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def make_dataset(root, n_scans=1, n_points=51, ccd_shape=(256, 256),
+                 seed=0, darks=True, **scan_kwargs):
+    """
+    Write a SPEC file with n_scans scans and their CCD frames under root
+
+    Parameters
+    ----------
+    root : str
+        Directory for the SPEC file, frames go to root/ccd
+    n_scans, n_points : int
+        Number of scans and of points (frames) per scan
+    ccd_shape : tuple
+        (rows, cols) of a frame
+    seed : int
+        Seed of the noise, the same arguments give the same files
+    darks : bool
+        Also write the dark frame of every point
+    scan_kwargs
+        Passed to SyntheticScan
+
+    Returns
+    -------
+    dict
+        spec_file, ccd_path, scan_numbers and the SyntheticScan objects
+    """
+    rng = np.random.RandomState(seed)
+    ccd_path = os.path.join(root, 'ccd')
+    if not os.path.isdir(ccd_path):
+        os.makedirs(ccd_path)
+    spec_file = os.path.join(root, 'synthetic.spec')
+    stem = os.path.basename(spec_file)
+    scans = {}
+    for scan_no in range(1, n_scans + 1):
+        scan = SyntheticScan(n_points=n_points, ccd_shape=ccd_shape,
+                             **scan_kwargs)
+        scans[scan_no] = scan
+        for i in range(scan.n_points):
+            name = '{0}_{1:04d}-{2:04d}'.format(stem, scan_no, i)
+            write_spe(os.path.join(ccd_path, name + '_0000.spe'),
+                      scan.frame(i, rng))
+            if darks:
+                write_spe(os.path.join(ccd_path, name + '-DARK_0000.spe'),
+                          scan.dark(rng))
+    write_spec_file(spec_file, scans)
+    return {'spec_file': spec_file,
+            'ccd_path': ccd_path,
+            'scan_numbers': sorted(scans),
+            'scans': scans}
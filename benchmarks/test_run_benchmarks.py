@@ -0,0 +1,64 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+'''
+Smoke test of the benchmark harness on a tiny synthetic scan
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import json
+import pytest
+
+pytest.importorskip('vistrails')
+pytest.importorskip('pyspec.spec')
+import run_benchmarks  # noqa: E402
+
+
+@pytest.mark.parametrize('precision', ['double', 'single'])
+def test_main_on_a_tiny_dataset(tmpdir, precision):
+    output = str(tmpdir.join('results.json'))
+    report = run_benchmarks.main(['--frames', '3', '--detector', '16',
+                                  '--bins', '4', '--repeat', '1',
+                                  '--precision', precision,
+                                  '--workdir', str(tmpdir.join('data')),
+                                  '--output', output])
+    assert len(report['results']) == 1
+    result = report['results'][0]
+    assert result['params'] == {'frames': 3, 'detector': 16, 'bins': 4}
+    assert sorted(result['modules']) == ['Gridder', 'ImageStackSum',
+                                         'PlotGridded', 'SpecFile']
+    assert result['peak_rss_bytes'] > 0
+    assert ('accuracy' in result) == (precision == 'single')
+    with open(output, 'r') as f:
+        assert json.load(f)['results'] == report['results']